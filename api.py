@@ -1,10 +1,20 @@
+import asyncio
+import contextvars
+import functools
 import logging
 import os
 import re
-import tempfile
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse, Response
-from starlette.background import BackgroundTask
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+import tracing
+import xqe
 
 # 日志配置：生产环境使用 INFO，DEBUG 环境变量开启时切换为 DEBUG
 log_level = logging.DEBUG if os.environ.get("DEBUG") else logging.INFO
@@ -15,6 +25,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 上游抓取线程池：登录与爬取课表是阻塞操作，放到独立线程池中执行，
+# 避免占用事件循环，也避免缓存命中的请求排在慢请求后面
+FETCH_WORKERS = int(os.environ.get("fetch_workers", "8"))
+FETCH_QUEUE_SIZE = int(os.environ.get("fetch_queue_size", "32"))
+_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="xqe-fetch")
+_fetch_pending = 0
+metrics.gauge("xqe_fetch_queue_depth", lambda: _fetch_pending)
+
+# 启动时预处理各学校的校历与作息表，之后按文件修改时间自动重新加载
+xqe.preload_schools()
+
 app = FastAPI(
     title="XiQueEr2ICS",
     description="从喜鹊儿获取课表的工具",
@@ -22,6 +43,19 @@ app = FastAPI(
 )
 
 
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    """为被采样的请求记录各阶段耗时，通过 Server-Timing 响应头返回"""
+    trace, token = tracing.start_trace()
+    try:
+        response = await call_next(request)
+    finally:
+        header = tracing.finish_trace(trace, token)
+    if header:
+        response.headers["Server-Timing"] = header
+    return response
+
+
 def validate_student_id(student_id: str) -> bool:
     return student_id.isdigit()
 
@@ -30,8 +64,54 @@ def validate_password(password: str) -> bool:
     return bool(re.fullmatch(r'^[a-f0-9]{32}$', password))
 
 
+def is_not_modified(request: Request, validators: Dict[str, str]) -> bool:
+    """按 If-None-Match / If-Modified-Since 判断客户端缓存是否仍然有效"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or validators["etag"] in tags
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and validators.get("last_modified"):
+        try:
+            return parsedate_to_datetime(validators["last_modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def validator_headers(validators: Optional[Dict[str, str]]) -> Dict[str, str]:
+    if not validators:
+        return {}
+    headers = {"ETag": validators["etag"]}
+    if validators.get("last_modified"):
+        headers["Last-Modified"] = validators["last_modified"]
+    return headers
+
+
+async def run_fetch(func, *args, **kwargs):
+    """在上游抓取线程池中执行阻塞任务，排队数超过上限时直接返回 503"""
+    global _fetch_pending
+    if _fetch_pending >= FETCH_WORKERS + FETCH_QUEUE_SIZE:
+        logger.warning(f"Fetch queue full ({_fetch_pending} pending)")
+        raise HTTPException(status_code=503, detail="服务器繁忙，请稍后再试")
+    
+    def _release(_):
+        global _fetch_pending
+        _fetch_pending -= 1
+    
+    _fetch_pending += 1
+    # 复制上下文，使线程池中的计时记到当前请求的 Trace 上
+    future = asyncio.get_running_loop().run_in_executor(
+        _fetch_executor, contextvars.copy_context().run, functools.partial(func, *args, **kwargs)
+    )
+    future.add_done_callback(_release)
+    return await future
+
+
 @app.get("/{student_id}.ics")
 async def get_ics_file(
+    request: Request,
     student_id: str,
     pwd: str = Query(..., description="用户密码（32位小写MD5）"),
     remindTime: int = Query(30, description="提醒时间（分钟），默认为30"),
@@ -40,6 +120,7 @@ async def get_ics_file(
     term: str = Query(None, description="学期"),
     all_semesters: bool = Query(True, description="是否获取所有可用学期的课表"),
     force: bool = Query(False, description="强制重新获取，忽略缓存，获取失败时返回错误而不是带错误事件的日历"),
+    rrule: bool = Query(False, description="使用 RRULE 重复规则合并每周重复的课程，显著减小日历体积"),
     site: str = Query("", description="用于适配v1的参数，请勿使用") # v1 Adapter, do not use in v2. private parameter for @shutdown_awa
 ):
     pwd = pwd.lower()
@@ -59,42 +140,118 @@ async def get_ics_file(
     logger.info(f"Request: {student_id}, school={school_code}, all_sem={all_semesters}")
     
     try:
-        import xqe
-        result = xqe.Main(
-            username=student_id,
-            onceMd5Password=pwd,
-            remindTime=str(remindTime),
-            school_code=school_code,
-            school_year=school_year,
-            term=term,
-            all_semesters=all_semesters,
-            force=force
-        )
+        result = None
+        validators = None
+        if not force:
+            # 已有缓存的用户只读取本地数据（过期时后台刷新），走默认线程池，不与上游抓取排队
+            cached = await run_in_threadpool(
+                xqe.render_cached,
+                username=student_id,
+                remindTime=str(remindTime),
+                school_code=school_code,
+                all_semesters=all_semesters,
+                rrule=rrule,
+                not_modified=functools.partial(is_not_modified, request),
+                onceMd5Password=pwd,
+                school_year=school_year,
+                term=term
+            )
+            if cached is not None:
+                validators = cached if "etag" in cached else None
+                if cached["ics"] is None:
+                    return Response(status_code=304, headers=validator_headers(validators))
+                result = cached["ics"]
+        
+        if result is None:
+            result = await run_fetch(
+                xqe.Main,
+                username=student_id,
+                onceMd5Password=pwd,
+                remindTime=str(remindTime),
+                school_code=school_code,
+                school_year=school_year,
+                term=term,
+                all_semesters=all_semesters,
+                force=force,
+                rrule=rrule,
+                # 在线程池中排队期间其他进程完成的抓取可直接复用
+                requested_at=datetime.now()
+            )
+            # 抓取失败返回带错误事件的旧日历时缓存不新鲜，不附带校验值
+            validators = await run_in_threadpool(
+                xqe.get_cached_validators,
+                username=student_id,
+                remindTime=str(remindTime),
+                school_code=school_code,
+                all_semesters=all_semesters,
+                rrule=rrule
+            )
         
-        if isinstance(result, str) and result.startswith("BEGIN:VCALENDAR"):
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.ics', delete=False, encoding='utf-8') as temp_file:
-                temp_file.write(result)
-                temp_file_path = temp_file.name
-            
-            response = FileResponse(
-                path=temp_file_path,
-                media_type='text/calendar',
-                filename=f"{student_id}.ics",
-                headers={"Content-Disposition": f"attachment; filename={student_id}.ics"},
-                background=BackgroundTask(os.unlink, temp_file_path)
+        if isinstance(result, bytes) and result.startswith(b"BEGIN:VCALENDAR"):
+            return Response(
+                content=result,
+                media_type='text/calendar; charset=utf-8',
+                headers={"Content-Disposition": f"attachment; filename={student_id}.ics", **validator_headers(validators)}
             )
-            return response
         else:
             logger.error(f"Invalid ICS content for {student_id}")
             raise HTTPException(status_code=500, detail="未能解析ICS生成的文件-ICS内容无效")
     
     except HTTPException:
         raise
+    except xqe.LoginFailedError as e:
+        raise HTTPException(status_code=403, detail=str(e))
     except Exception as e:
         logger.error(f"Error processing request for {student_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.head("/{student_id}.ics")
+async def head_ics_file(
+    request: Request,
+    student_id: str,
+    pwd: str = Query("", description="用户密码（32位小写MD5）"),
+    remindTime: int = Query(30, description="提醒时间（分钟），默认为30"),
+    school_code: str = Query(None, description="学校代码"),
+    all_semesters: bool = Query(True, description="是否获取所有可用学期的课表"),
+    rrule: bool = Query(False, description="使用 RRULE 重复规则合并每周重复的课程，显著减小日历体积"),
+    site: str = Query("", description="用于适配v1的参数，请勿使用") # v1 Adapter, do not use in v2. private parameter for @shutdown_awa
+):
+    """只返回校验值与长度，不访问教务系统；缓存不可用时与以前一样返回空的 200"""
+    if not validate_student_id(student_id) or not validate_password(pwd.lower()):
+        return Response(status_code=200)
+    
+    if site or not school_code:
+        school_code = "12623"
+    
+    try:
+        cached = await run_in_threadpool(
+            xqe.render_cached,
+            username=student_id,
+            remindTime=str(remindTime),
+            school_code=school_code,
+            all_semesters=all_semesters,
+            rrule=rrule,
+            not_modified=functools.partial(is_not_modified, request)
+        )
+    except Exception as e:
+        logger.error(f"Error processing HEAD request for {student_id}: {e}")
+        return Response(status_code=200)
+    
+    if cached is None or "etag" not in cached:
+        return Response(status_code=200)
+    if cached["ics"] is None:
+        return Response(status_code=304, headers=validator_headers(cached))
+    
+    headers = {
+        "Content-Type": "text/calendar; charset=utf-8",
+        "Content-Disposition": f"attachment; filename={student_id}.ics",
+        "Content-Length": str(len(cached["ics"])),
+        **validator_headers(cached)
+    }
+    return Response(status_code=200, headers=headers)
+
+
 @app.get("/")
 def read_root():
     return {
@@ -103,6 +260,16 @@ def read_root():
     }
 
 
+@app.get("/status")
+def read_status():
+    return xqe.get_status()
+
+
+@app.get("/metrics")
+def read_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.api_route("/{full_path:path}", methods=["HEAD"])
 async def handle_head_request(full_path: str):
     return Response(status_code=200)
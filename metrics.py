@@ -0,0 +1,311 @@
+"""
+Prometheus 文本格式的运行指标
+
+计数器与直方图在进程内累加（一次加锁的字典更新），仪表盘（gauge）在导出时通过回调读取当前值。
+设置环境变量 metrics_dir 后，每个 worker 进程定期把自己的指标写到 <metrics_dir>/<pid>-<启动时间>-<随机数>.json，
+导出时汇总目录下所有文件：计数器与直方图累加，仪表盘只汇总仍存活的进程。
+已退出进程的文件在导出时并入 archive.json 后删除，PID 被复用也不会覆盖旧进程的累计值，计数器不会减小。
+未设置时只导出当前进程的指标。
+"""
+import atexit
+import functools
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台不加锁合并
+    fcntl = None
+
+METRICS_DIR = os.environ.get("metrics_dir", "")
+METRICS_FLUSH_SECONDS = 5
+# 无法读取 /proc 时，超过这么多个写入周期未更新的文件视为进程已退出
+METRICS_STALE_FLUSHES = 6
+ARCHIVE_NAME = "archive.json"
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+BYTES_BUCKETS = (4096, 16384, 65536, 262144, 1048576, 4194304, float("inf"))
+COUNT_BUCKETS = (10, 50, 100, 200, 500, 1000, 2000, float("inf"))
+
+# 名称: (类型, 说明, 直方图桶)
+METRICS = {
+    "xqe_cache_requests_total": ("counter", "订阅请求的缓存结果（fresh/stale/miss/force）", None),
+    "xqe_not_modified_total": ("counter", "返回 304 的条件请求", None),
+    "xqe_stale_calendar_total": ("counter", "附带提示事件的旧日历（stale：长期无法更新，login：密码被拒绝）", None),
+    "xqe_fetches_total": ("counter", "完成的教务系统抓取（changed：课表有变化）", None),
+    "xqe_login_saved_total": ("counter", "登录失败退避期内省下的登录次数", None),
+    "xqe_upstream_seconds": ("histogram", "教务系统登录与单学期课表请求耗时", SECONDS_BUCKETS),
+    "xqe_upstream_errors_total": ("counter", "教务系统请求失败（error_page：重定向到 /frame/errors/）", None),
+    "xqe_stage_seconds": ("histogram", "请求内各阶段耗时（仅采样的请求）", SECONDS_BUCKETS),
+    "xqe_ics_bytes": ("histogram", "生成的 ICS 大小", BYTES_BUCKETS),
+    "xqe_ics_events": ("histogram", "生成的 ICS 事件数", COUNT_BUCKETS),
+    "xqe_fetch_queue_depth": ("gauge", "上游抓取线程池中排队与执行中的任务数", None),
+    "xqe_refresh_queue_depth": ("gauge", "等待后台刷新的用户数", None),
+    "xqe_circuit_open": ("gauge", "教务系统熔断器是否打开", None),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_LOCK = threading.Lock()
+_COUNTERS: Dict[Tuple[str, Labels], float] = {}
+_HISTOGRAMS: Dict[Tuple[str, Labels], List[float]] = {}
+_GAUGES: Dict[str, Callable[[], object]] = {}
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    buckets = METRICS[name][2]
+    key = (name, tuple(sorted(labels.items())))
+    index = 0
+    while value > buckets[index]:
+        index += 1
+    with _LOCK:
+        data = _HISTOGRAMS.get(key)
+        if data is None:
+            # 各桶计数（非累计），最后两项为总和与次数
+            data = _HISTOGRAMS[key] = [0] * len(buckets) + [0.0, 0]
+        data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+
+def timed(name: str, **labels):
+    """把函数耗时（秒）记入直方图的装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def gauge(name: str, callback: Callable[[], object]):
+    """注册仪表盘回调，返回数值或 {labels 元组: 数值}"""
+    _GAUGES[name] = callback
+
+
+def _process_start(pid: int) -> Optional[str]:
+    """进程的启动时间（/proc/<pid>/stat 的 starttime），进程不存在或没有 /proc 时返回 None"""
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 第 2 项进程名可能包含空格与括号，从最后一个 ")" 之后的第 3 项开始数，starttime 是第 22 项
+    return stat.rsplit(")", 1)[1].split()[19]
+
+
+_INSTANCE: Tuple[int, str] = (0, "")
+
+
+def _instance() -> str:
+    """当前进程的指标文件名（不含扩展名）；fork 出的子进程会重新生成"""
+    global _INSTANCE
+    pid = os.getpid()
+    if _INSTANCE[0] != pid:
+        _INSTANCE = (pid, f"{pid}-{_process_start(pid) or 0}-{secrets.token_hex(4)}")
+    return _INSTANCE[1]
+
+
+def snapshot() -> Dict[str, list]:
+    """当前进程的全部指标，可序列化为 JSON"""
+    with _LOCK:
+        counters = [[name, list(labels), value] for (name, labels), value in _COUNTERS.items()]
+        histograms = [[name, list(labels), list(data)] for (name, labels), data in _HISTOGRAMS.items()]
+    gauges = []
+    for name, callback in list(_GAUGES.items()):
+        try:
+            value = callback()
+        except Exception:
+            continue
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        gauges.extend([name, list(labels), float(v)] for labels, v in items)
+    pid = os.getpid()
+    return {"pid": pid, "start": _process_start(pid), "counters": counters, "histograms": histograms, "gauges": gauges}
+
+
+def _write_json(path: str, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def flush():
+    """把当前进程的指标写入 metrics_dir"""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(os.path.join(METRICS_DIR, f"{_instance()}.json"), snapshot())
+
+
+def _process_alive(data: dict, path: str) -> bool:
+    """写入该文件的进程是否仍在运行：有 /proc 时比较 PID 与启动时间，否则看 PID 是否存在以及文件是否仍在更新"""
+    pid = data.get("pid", 0)
+    if data.get("start") is not None:
+        return _process_start(pid) == data["start"]
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    try:
+        return time.time() - os.path.getmtime(path) < METRICS_FLUSH_SECONDS * METRICS_STALE_FLUSHES
+    except OSError:
+        return False
+
+
+def _merge(counters: Dict[Tuple[str, Labels], float], histograms: Dict[Tuple[str, Labels], List[float]], data: dict):
+    for name, labels, value in data["counters"]:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in data["histograms"]:
+        key = (name, tuple(map(tuple, labels)))
+        merged = histograms.get(key)
+        histograms[key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+
+
+def _archive_dead(paths: List[str]):
+    """把已退出进程的计数器与直方图并入 archive.json 并删除其文件；目录级文件锁保证每个文件只合并一次"""
+    with open(os.path.join(METRICS_DIR, ".lock"), "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            archive_path = os.path.join(METRICS_DIR, ARCHIVE_NAME)
+            archive = _read_json(archive_path) or {"merged": [], "counters": [], "histograms": []}
+            counters: Dict[Tuple[str, Labels], float] = {}
+            histograms: Dict[Tuple[str, Labels], List[float]] = {}
+            _merge(counters, histograms, archive)
+            # merged 记录已合并但可能尚未删除的文件，合并后中断时不会重复累加
+            merged = set(archive["merged"])
+            for path in paths:
+                name = os.path.basename(path)
+                data = _read_json(path)
+                if name not in merged and data is not None:
+                    _merge(counters, histograms, data)
+                    merged.add(name)
+            archive = {
+                "merged": sorted(merged),
+                "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+                "histograms": [[name, list(labels), values] for (name, labels), values in histograms.items()],
+            }
+            _write_json(archive_path, archive)
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            archive["merged"] = [name for name in archive["merged"] if os.path.exists(os.path.join(METRICS_DIR, name))]
+            _write_json(archive_path, archive)
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _collect() -> Iterable[Dict[str, list]]:
+    if not METRICS_DIR:
+        yield snapshot()
+        return
+    flush()
+    live, dead = [], []
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        if os.path.basename(path) == ARCHIVE_NAME:
+            continue
+        data = _read_json(path)
+        if data is None:
+            continue
+        if _process_alive(data, path):
+            live.append(data)
+        else:
+            dead.append(path)
+    if dead:
+        try:
+            _archive_dead(dead)
+        except OSError:
+            pass
+    yield from live
+    archive = _read_json(os.path.join(METRICS_DIR, ARCHIVE_NAME))
+    if archive is not None:
+        yield {"counters": archive["counters"], "histograms": archive["histograms"], "gauges": []}
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else f"{bound:g}"
+
+
+def render() -> str:
+    """汇总所有进程的指标，输出 Prometheus 文本格式"""
+    counters: Dict[Tuple[str, Labels], float] = {}
+    gauges: Dict[Tuple[str, Labels], float] = {}
+    histograms: Dict[Tuple[str, Labels], List[float]] = {}
+    for data in _collect():
+        _merge(counters, histograms, data)
+        for name, labels, value in data["gauges"]:
+            key = (name, tuple(map(tuple, labels)))
+            gauges[key] = gauges.get(key, 0) + value
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, values):
+                    cumulative += count
+                    bucket_labels = labels + (("le", _format_bound(bound)),)
+                    lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative:g}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]:g}")
+                lines.append(f"{name}_count{_format_labels(labels)} {values[-1]:g}")
+        else:
+            source = counters if kind == "counter" else gauges
+            for (metric, labels), value in sorted(source.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def _run_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+if METRICS_DIR:
+    threading.Thread(target=_run_flusher, name="xqe-metrics", daemon=True).start()
+    atexit.register(flush)
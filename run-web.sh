@@ -6,8 +6,27 @@
 
 WEB_PORT="${web_port:-8080}"
 API_HOST="${api_host:-127.0.0.1}"
+WEB_WORKERS="${web_workers:-1}"
 
 cd "$(dirname "$0")" || exit 1
 
-echo "Starting web server on $API_HOST:$WEB_PORT..."
-python3 -m uvicorn api:app --host "$API_HOST" --port "$WEB_PORT"
\ No newline at end of file
+if [ "$WEB_WORKERS" -gt 1 ]; then
+    # Worker processes share user data through SQLite, upstream rate limit / circuit breaker
+    # state through upstream_state_dir and metrics through metrics_dir
+    if [ "${storage_backend:-sqlite}" != "sqlite" ]; then
+        echo "web_workers > 1 requires storage_backend=sqlite" >&2
+        exit 1
+    fi
+    export upstream_state_dir="${upstream_state_dir:-user/upstream}"
+    export metrics_dir="${metrics_dir:-user/metrics}"
+    mkdir -p "$upstream_state_dir"
+fi
+
+if [ -n "${metrics_dir:-}" ]; then
+    # Counters restart from zero with the server; drop files left by the previous run
+    mkdir -p "$metrics_dir"
+    rm -f "$metrics_dir"/*.json "$metrics_dir"/*.json.tmp
+fi
+
+echo "Starting web server on $API_HOST:$WEB_PORT with $WEB_WORKERS worker(s)..."
+python3 -m uvicorn api:app --host "$API_HOST" --port "$WEB_PORT" --workers "$WEB_WORKERS"
@@ -6,30 +6,68 @@ import logging
 import os
 import sys
 import hashlib
+import html
+import html.entities
 import base64
-import execjs
+import contextvars
 import re
 import json
+import struct
 import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from html.parser import HTMLParser
 from urllib.parse import parse_qs, urlparse, unquote
 from requests.exceptions import RequestException, Timeout, ConnectionError as RequestsConnectionError
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional, List, Dict, Any, Tuple
 
+try:
+    from tracing import traced
+except ImportError:  # 单独运行本模块时不计时
+    def traced(stage):
+        return lambda func: func
+
+try:
+    import metrics
+except ImportError:  # 单独运行本模块时不记录指标
+    metrics = None
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台只在进程内限流
+    fcntl = None
+
 # 配置日志
 logger = logging.getLogger(__name__)
 
 # ============ 全局缓存 ============
 _KINGO_DES_JS_CACHE = None
-_SCHOOL_CALENDAR_CACHE = None
 _CONFIG_CACHE = None
 _CALENDAR_PATH = os.path.join(os.path.dirname(__file__), 'school_calendar.json')
 _CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.json')
-_TIMETABLE_CONFIG_CACHE = None
+_TIMETABLE_PATH = os.path.join(os.path.dirname(__file__), 'timetable.json')
+# 校历与作息表按文件修改时间缓存：路径 -> (st_mtime_ns, 数据)
+_DATA_FILE_CACHE: Dict[str, Tuple[int, Any]] = {}
 _INIT_LOCK = threading.Lock()
+SCHOOL_CODE = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _count_error(kind: str):
+    if metrics is not None:
+        metrics.inc("xqe_upstream_errors_total", school=SCHOOL_CODE, kind=kind)
+
+
+def _timed(op: str):
+    """把登录、学期课表请求的耗时记入 xqe_upstream_seconds"""
+    if metrics is None:
+        return lambda func: func
+    return metrics.timed("xqe_upstream_seconds", school=SCHOOL_CODE, op=op)
 
 
 def _init_logging():
@@ -50,23 +88,46 @@ def load_config() -> Dict[str, Any]:
         with _INIT_LOCK:
             if _CONFIG_CACHE is None:
                 with open(_CONFIG_PATH, 'r', encoding='utf-8') as f:
-                    _CONFIG_CACHE = json.load(f)
+                    config = json.load(f)
+                # 基准测试时指向本地模拟的教务系统（tools/fake_kingo.py）
+                if os.environ.get("kingo_root_url"):
+                    config['rootUrl'] = os.environ["kingo_root_url"]
+                _CONFIG_CACHE = config
     return _CONFIG_CACHE
 
 
+def load_data_file(path: str) -> Any:
+    """
+    读取 JSON 数据文件并按修改时间缓存
+
+    maintain.py 更新校历后无需重启即可生效；文件暂时无法解析时继续使用上一版本。
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _DATA_FILE_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with _INIT_LOCK:
+        cached = _DATA_FILE_CACHE.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError:
+            if cached is None:
+                raise
+            logger.warning(f"{path} 无法解析，继续使用上一版本")
+            data = cached[1]
+        _DATA_FILE_CACHE[path] = (mtime, data)
+        return data
+
+
 def load_timetable_config() -> Dict[str, Any]:
     """加载作息时间配置"""
-    global _TIMETABLE_CONFIG_CACHE
-    if _TIMETABLE_CONFIG_CACHE is None:
-        with _INIT_LOCK:
-            if _TIMETABLE_CONFIG_CACHE is None:
-                config_path = os.path.join(os.path.dirname(__file__), 'timetable.json')
-                try:
-                    with open(config_path, 'r', encoding='utf-8') as f:
-                        _TIMETABLE_CONFIG_CACHE = json.load(f)
-                except Exception:
-                    _TIMETABLE_CONFIG_CACHE = {}
-    return _TIMETABLE_CONFIG_CACHE
+    try:
+        return load_data_file(_TIMETABLE_PATH)
+    except Exception:
+        return {}
 
 
 def get_available_semesters() -> List[str]:
@@ -88,22 +149,237 @@ class XqeLibs:
         return base64.b64encode(data.encode('utf-8')).decode('utf-8')
 
 
+# ============ DES 加密（jkingo.des.js 的 Python 移植）============
+# jkingo.des.js 以 4 个 UTF-16 码元为一组（64 位）分组，密钥同样按 4 个码元切分，
+# 每个密钥分组依次对数据做一次 DES。以下置换表均按 JS 源码中的写法生成，
+# 比特序与 JS 数组一致：下标 0 为最高位。
+
+def _build_init_permute() -> List[int]:
+    table = [0] * 64
+    for i in range(4):
+        m, n = 2 * i + 1, 2 * i
+        for k in range(8):
+            j = 7 - k
+            table[i * 8 + k] = j * 8 + m
+            table[i * 8 + k + 32] = j * 8 + n
+    return table
+
+
+def _build_expand_permute() -> List[int]:
+    table = [0] * 48
+    for i in range(8):
+        table[i * 6 + 0] = 31 if i == 0 else i * 4 - 1
+        for t in range(4):
+            table[i * 6 + 1 + t] = i * 4 + t
+        table[i * 6 + 5] = 0 if i == 7 else i * 4 + 4
+    return table
+
+
+_DES_IP = _build_init_permute()
+_DES_E = _build_expand_permute()
+_DES_P = [15, 6, 19, 20, 28, 11, 27, 16, 0, 14, 22, 25, 4, 17, 30, 9,
+          1, 7, 23, 13, 31, 26, 2, 8, 18, 12, 29, 5, 21, 10, 3, 24]
+_DES_FP = [39, 7, 47, 15, 55, 23, 63, 31, 38, 6, 46, 14, 54, 22, 62, 30,
+           37, 5, 45, 13, 53, 21, 61, 29, 36, 4, 44, 12, 52, 20, 60, 28,
+           35, 3, 43, 11, 51, 19, 59, 27, 34, 2, 42, 10, 50, 18, 58, 26,
+           33, 1, 41, 9, 49, 17, 57, 25, 32, 0, 40, 8, 48, 16, 56, 24]
+_DES_PC1 = [8 * (7 - j) + i for i in range(7) for j in range(8)]
+_DES_PC2 = [13, 16, 10, 23, 0, 4, 2, 27, 14, 5, 20, 9, 22, 18, 11, 3,
+            25, 7, 15, 6, 26, 19, 12, 1, 40, 51, 30, 36, 46, 54, 29, 39,
+            50, 44, 32, 47, 43, 48, 38, 55, 33, 52, 45, 41, 49, 35, 28, 31]
+_DES_SHIFTS = [1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1]
+_DES_SBOXES = [
+    [[14, 4, 13, 1, 2, 15, 11, 8, 3, 10, 6, 12, 5, 9, 0, 7],
+     [0, 15, 7, 4, 14, 2, 13, 1, 10, 6, 12, 11, 9, 5, 3, 8],
+     [4, 1, 14, 8, 13, 6, 2, 11, 15, 12, 9, 7, 3, 10, 5, 0],
+     [15, 12, 8, 2, 4, 9, 1, 7, 5, 11, 3, 14, 10, 0, 6, 13]],
+    [[15, 1, 8, 14, 6, 11, 3, 4, 9, 7, 2, 13, 12, 0, 5, 10],
+     [3, 13, 4, 7, 15, 2, 8, 14, 12, 0, 1, 10, 6, 9, 11, 5],
+     [0, 14, 7, 11, 10, 4, 13, 1, 5, 8, 12, 6, 9, 3, 2, 15],
+     [13, 8, 10, 1, 3, 15, 4, 2, 11, 6, 7, 12, 0, 5, 14, 9]],
+    [[10, 0, 9, 14, 6, 3, 15, 5, 1, 13, 12, 7, 11, 4, 2, 8],
+     [13, 7, 0, 9, 3, 4, 6, 10, 2, 8, 5, 14, 12, 11, 15, 1],
+     [13, 6, 4, 9, 8, 15, 3, 0, 11, 1, 2, 12, 5, 10, 14, 7],
+     [1, 10, 13, 0, 6, 9, 8, 7, 4, 15, 14, 3, 11, 5, 2, 12]],
+    [[7, 13, 14, 3, 0, 6, 9, 10, 1, 2, 8, 5, 11, 12, 4, 15],
+     [13, 8, 11, 5, 6, 15, 0, 3, 4, 7, 2, 12, 1, 10, 14, 9],
+     [10, 6, 9, 0, 12, 11, 7, 13, 15, 1, 3, 14, 5, 2, 8, 4],
+     [3, 15, 0, 6, 10, 1, 13, 8, 9, 4, 5, 11, 12, 7, 2, 14]],
+    [[2, 12, 4, 1, 7, 10, 11, 6, 8, 5, 3, 15, 13, 0, 14, 9],
+     [14, 11, 2, 12, 4, 7, 13, 1, 5, 0, 15, 10, 3, 9, 8, 6],
+     [4, 2, 1, 11, 10, 13, 7, 8, 15, 9, 12, 5, 6, 3, 0, 14],
+     [11, 8, 12, 7, 1, 14, 2, 13, 6, 15, 0, 9, 10, 4, 5, 3]],
+    [[12, 1, 10, 15, 9, 2, 6, 8, 0, 13, 3, 4, 14, 7, 5, 11],
+     [10, 15, 4, 2, 7, 12, 9, 5, 6, 1, 13, 14, 0, 11, 3, 8],
+     [9, 14, 15, 5, 2, 8, 12, 3, 7, 0, 4, 10, 1, 13, 11, 6],
+     [4, 3, 2, 12, 9, 5, 15, 10, 11, 14, 1, 7, 6, 0, 8, 13]],
+    [[4, 11, 2, 14, 15, 0, 8, 13, 3, 12, 9, 7, 5, 10, 6, 1],
+     [13, 0, 11, 7, 4, 9, 1, 10, 14, 3, 5, 12, 2, 15, 8, 6],
+     [1, 4, 11, 13, 12, 3, 7, 14, 10, 15, 6, 8, 0, 5, 9, 2],
+     [6, 11, 13, 8, 1, 4, 10, 7, 9, 5, 0, 15, 14, 2, 3, 12]],
+    [[13, 2, 8, 4, 6, 15, 11, 1, 10, 9, 3, 14, 5, 0, 12, 7],
+     [1, 15, 13, 8, 10, 3, 7, 4, 12, 5, 6, 11, 0, 14, 9, 2],
+     [7, 11, 4, 1, 9, 12, 14, 2, 0, 6, 10, 13, 15, 3, 5, 8],
+     [2, 1, 14, 7, 4, 10, 8, 13, 15, 12, 9, 0, 3, 5, 6, 11]],
+]
+
+
+def _build_byte_tables(table: List[int], in_bits: int) -> List[List[int]]:
+    """把逐位置换展开为按输入字节查表：输出 = OR(tables[b][第 b 个输入字节])"""
+    out_bits = len(table)
+    tables = []
+    for b in range(in_bits // 8):
+        chunk = [0] * 256
+        for value in range(256):
+            out = 0
+            for o, src in enumerate(table):
+                if 8 * b <= src < 8 * b + 8 and (value >> (7 - (src - 8 * b))) & 1:
+                    out |= 1 << (out_bits - 1 - o)
+            chunk[value] = out
+        tables.append(chunk)
+    return tables
+
+
+def _build_sp_tables() -> List[List[int]]:
+    """S 盒与 P 置换合并为 8 张 64 项的表"""
+    tables = []
+    for m, sbox in enumerate(_DES_SBOXES):
+        chunk = [0] * 64
+        for six in range(64):
+            row = ((six >> 5) & 1) * 2 + (six & 1)
+            col = (six >> 1) & 0xF
+            s_out = sbox[row][col] << (28 - 4 * m)
+            out = 0
+            for o, src in enumerate(_DES_P):
+                if (s_out >> (31 - src)) & 1:
+                    out |= 1 << (31 - o)
+            chunk[six] = out
+        tables.append(chunk)
+    return tables
+
+
+_DES_IP_TABLES = _build_byte_tables(_DES_IP, 64)
+_DES_FP_TABLES = _build_byte_tables(_DES_FP, 64)
+_DES_E_TABLES = _build_byte_tables(_DES_E, 32)
+_DES_SP_TABLES = _build_sp_tables()
+
+
+def _permute(value: int, tables: List[List[int]], in_bits: int) -> int:
+    out = 0
+    shift = in_bits - 8
+    for chunk in tables:
+        out |= chunk[(value >> shift) & 0xFF]
+        shift -= 8
+    return out
+
+
+@lru_cache(maxsize=256)
+def _des_subkeys(key_block: int) -> Tuple[int, ...]:
+    """按 generateKeys 的规则生成 16 轮子密钥（48 位整数）"""
+    key = [(key_block >> (63 - src)) & 1 for src in _DES_PC1]
+    subkeys = []
+    for shift in _DES_SHIFTS:
+        key = key[shift:28] + key[:shift] + key[28 + shift:] + key[28:28 + shift]
+        subkey = 0
+        for src in _DES_PC2:
+            subkey = (subkey << 1) | key[src]
+        subkeys.append(subkey)
+    return tuple(subkeys)
+
+
+def _des_block(block: int, subkeys) -> int:
+    ip = _permute(block, _DES_IP_TABLES, 64)
+    left, right = ip >> 32, ip & 0xFFFFFFFF
+    sp = _DES_SP_TABLES
+    for subkey in subkeys:
+        x = _permute(right, _DES_E_TABLES, 32) ^ subkey
+        f = (sp[0][(x >> 42) & 63] | sp[1][(x >> 36) & 63] | sp[2][(x >> 30) & 63] | sp[3][(x >> 24) & 63]
+             | sp[4][(x >> 18) & 63] | sp[5][(x >> 12) & 63] | sp[6][(x >> 6) & 63] | sp[7][x & 63])
+        left, right = right, left ^ f
+    return _permute((right << 32) | left, _DES_FP_TABLES, 64)
+
+
+def _str_to_units(text: str) -> Tuple[int, ...]:
+    """JS 字符串按 UTF-16 码元计数，这里保持一致"""
+    raw = text.encode('utf-16-be', 'surrogatepass')
+    return struct.unpack(f'>{len(raw) // 2}H', raw)
+
+
+def _units_to_blocks(units) -> List[int]:
+    """对应 strToBt：每 4 个码元组成一个 64 位分组，不足补 0"""
+    blocks = []
+    for i in range(0, len(units), 4):
+        chunk = tuple(units[i:i + 4]) + (0,) * (4 - len(units[i:i + 4]))
+        blocks.append((chunk[0] << 48) | (chunk[1] << 32) | (chunk[2] << 16) | chunk[3])
+    return blocks
+
+
+def _key_schedules(first_key, second_key, third_key) -> List[Tuple[int, ...]]:
+    # 与 strEnc 的分支一致：只有前面的密钥非空时，后面的密钥才生效
+    keys = []
+    for key in (first_key, second_key, third_key):
+        if not key:
+            break
+        keys.append(key)
+    return [_des_subkeys(block) for key in keys for block in _units_to_blocks(_str_to_units(key))]
+
+
+def str_enc(data: str, first_key: str, second_key: str = None, third_key: str = None) -> str:
+    """jkingo.des.js strEnc 的等价实现，返回大写十六进制串"""
+    schedules = _key_schedules(first_key, second_key, third_key)
+    result = []
+    for block in _units_to_blocks(_str_to_units(data)):
+        for subkeys in schedules:
+            block = _des_block(block, subkeys)
+        result.append(f"{block:016X}")
+    return ''.join(result)
+
+
+def str_dec(data: str, first_key: str, second_key: str = None, third_key: str = None) -> str:
+    """jkingo.des.js strDec 的等价实现"""
+    schedules = _key_schedules(first_key, second_key, third_key)
+    units = []
+    for i in range(0, len(data) // 16 * 16, 16):
+        block = int(data[i:i + 16], 16)
+        for subkeys in reversed(schedules):
+            block = _des_block(block, subkeys[::-1])
+        units.extend(u for u in ((block >> shift) & 0xFFFF for shift in (48, 32, 16, 0)) if u)
+    return struct.pack(f'>{len(units)}H', *units).decode('utf-16-be', 'surrogatepass')
+
+
 class KingoDES:
-    """基于 JavaScript 的 DES 加密"""
+    """
+    喜鹊儿登录参数的 DES 加密
+
+    默认使用纯 Python 实现；config.json 中设置 "desBackend": "js" 时改用 execjs 执行 jkingo.des.js。
+    """
     
-    def __init__(self):
+    def __init__(self, backend: Optional[str] = None):
+        self.backend = backend or load_config().get('desBackend', 'python')
+        self.kingo_des_compiled = None
+        if self.backend == 'js':
+            self.kingo_des_compiled = self._compile_js()
+    
+    @staticmethod
+    def _compile_js():
         global _KINGO_DES_JS_CACHE
+        import execjs  # 仅 JS 后端需要，避免强制依赖 Node.js 运行时
+        
         if _KINGO_DES_JS_CACHE is None:
             with _INIT_LOCK:
                 if _KINGO_DES_JS_CACHE is None:
                     js_path = os.path.join(os.path.dirname(__file__), 'jkingo.des.js')
                     with open(js_path, 'r', encoding='utf-8') as f:
                         _KINGO_DES_JS_CACHE = f.read()
-        self.kingo_des_compiled = execjs.compile(_KINGO_DES_JS_CACHE)
+        return execjs.compile(_KINGO_DES_JS_CACHE)
     
+    @traced("des")
     def encrypt(self, data: str, des_key: str) -> str:
         """DES 加密"""
-        encrypted_hex = self.kingo_des_compiled.call("strEnc", data, des_key, None, None)
+        if self.kingo_des_compiled is not None:
+            encrypted_hex = self.kingo_des_compiled.call("strEnc", data, des_key, None, None)
+        else:
+            encrypted_hex = str_enc(data, des_key)
         encrypted_base64 = base64.b64encode(encrypted_hex.encode('utf-8')).decode('utf-8')
         return encrypted_base64
 
@@ -113,19 +389,25 @@ class SchoolCalendar:
     
     @staticmethod
     def load_calendar() -> Dict[str, Any]:
-        global _SCHOOL_CALENDAR_CACHE
-        if _SCHOOL_CALENDAR_CACHE is None:
-            with _INIT_LOCK:
-                if _SCHOOL_CALENDAR_CACHE is None:
-                    with open(_CALENDAR_PATH, 'r', encoding='utf-8') as f:
-                        _SCHOOL_CALENDAR_CACHE = json.load(f)
-        return _SCHOOL_CALENDAR_CACHE
+        return load_data_file(_CALENDAR_PATH)
     
     @staticmethod
     def get_term_info(school_year: str, term: str) -> Optional[Dict[str, Any]]:
         calendar = SchoolCalendar.load_calendar()
         return calendar.get(f"{school_year}-{term}")
     
+    @staticmethod
+    def is_term_finished(school_year: str, term: str) -> bool:
+        """学期结束日期已过，则该学期课表不会再变化"""
+        term_info = SchoolCalendar.get_term_info(school_year, term)
+        if not term_info or not term_info.get('termEndDate'):
+            return False
+        try:
+            end_date = datetime.strptime(term_info['termEndDate'], "%Y-%m-%d").date()
+        except ValueError:
+            return False
+        return end_date < datetime.now().date()
+    
     @staticmethod
     def get_first_monday(school_year: str, term: str) -> Optional[str]:
         term_info = SchoolCalendar.get_term_info(school_year, term)
@@ -141,30 +423,298 @@ class SchoolCalendar:
 
 
 # ============ 登录与课表获取 ============
-_thread_local = threading.local()
+# 按 rootUrl 共享的连接池，保持与教务系统的 keep-alive 连接；每个抓取线程最多同时获取 semesterConcurrency 个学期
+UPSTREAM_POOL_SIZE = int(os.environ.get("fetch_workers", "8"))
+_HTTP_ADAPTERS: Dict[str, HTTPAdapter] = {}
+_ADAPTER_LOCK = threading.Lock()
+
+# 已登录会话缓存：(rootUrl, 学号, 密码MD5) -> (cookies, 最近一次成功使用的时间戳)
+_SESSION_STORE: Dict[Tuple[str, str, str], Tuple[Dict[str, str], float]] = {}
+_SESSION_LOCK = threading.Lock()
+SESSION_MAX_AGE = 2 * 60 * 60
+# save_session 时清理过期会话的最短间隔
+SESSION_PRUNE_INTERVAL = 10 * 60
+_session_pruned_at = 0.0
+
+
+class KingoErrorPage(Exception):
+    """教务系统重定向到 /frame/errors/ 错误页面"""
+
+
+class LoginError(Exception):
+    """教务系统拒绝登录（账号或密码错误等），与网络错误区分"""
+
+
+class SessionExpiredError(Exception):
+    """复用的会话已失效（被重定向到登录页或错误页）"""
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发出即失败"""
+
+
+class TokenBucket:
+    """
+    令牌桶限流：按 rate 个/秒补充令牌，最多积攒 burst 个
+
+    acquire 采用预约方式：先扣令牌再在锁外等待，等待者按到达顺序依次放行。
+    max_wait 为请求愿意排队的最长时间，冷启动时大量用户同时抓取，排队应长于单次请求的超时。
+    """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, rate: float, burst: int, max_wait: float = 30):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self._tokens = float(burst)
+        self._updated = self.clock()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            yield
+
+    def _reserve(self, timeout: float) -> Optional[float]:
+        """预约一个令牌，返回需要等待的秒数；等待超过 timeout 时返回 None"""
+        with self._locked():
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0
+            if wait > timeout:
+                self.rejected += 1
+                return None
+            self._tokens -= 1
+            return wait
+
+    def acquire(self, timeout: float) -> bool:
+        """获取一个令牌，需要等待超过 timeout 秒时放弃并返回 False"""
+        wait = self._reserve(timeout)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+    def available(self) -> float:
+        with self._locked():
+            elapsed = self.clock() - self._updated
+            return min(self.burst, self._tokens + elapsed * self.rate)
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续 failure_threshold 次超时、连接错误、5xx 或错误页后打开，reset_timeout 秒内直接拒绝请求；
+    之后进入半开状态放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        # 探测请求的放行时间，0 表示没有探测在进行；超过 reset_timeout 仍无结果（如进程退出）时重新放行
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            yield
+
+    def allow(self) -> bool:
+        with self._locked():
+            now = self.clock()
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_started = 0.0
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and now - self._probe_started >= self.reset_timeout:
+                self._probe_started = now
+                return True
+            self.rejected += 1
+            return False
+
+    def cancel(self):
+        """放行后请求未实际发出（如限流排队超时），归还半开状态的探测名额"""
+        with self._locked():
+            self._probe_started = 0.0
+
+    def record_success(self):
+        with self._locked():
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_started = 0.0
+
+    def record_failure(self):
+        with self._locked():
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"教务系统连续失败 {self.failures} 次，熔断 {self.reset_timeout}s")
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+                self._probe_started = 0.0
+
+    def retry_after(self) -> float:
+        with self._locked():
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (self.clock() - self.opened_at))
+
+
+class _SharedStateMixin:
+    """
+    把 _shared_fields 中的属性保存在 state_path 文件中，每次操作时持有 fcntl 排他锁读出、改完写回，
+    使多个 worker 进程共用同一个限流器/熔断器。跨进程比较时间，因此使用 time.time。
+    """
+
+    _shared_fields: Tuple[str, ...] = ()
+    clock = staticmethod(time.time)
+    state_path: str
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(os.read(fd, 65536) or b"{}")
+                except ValueError:  # 写入中途进程退出，状态作废
+                    state = {}
+                for name in self._shared_fields:
+                    if name in state:
+                        setattr(self, name, state[name])
+                yield
+                data = json.dumps({name: getattr(self, name) for name in self._shared_fields}).encode()
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+
+class SharedTokenBucket(_SharedStateMixin, TokenBucket):
+    _shared_fields = ('_tokens', '_updated')
+
+    def __init__(self, rate: float, burst: int, max_wait: float, state_path: str):
+        self.state_path = state_path
+        super().__init__(rate, burst, max_wait)
+
+
+class SharedCircuitBreaker(_SharedStateMixin, CircuitBreaker):
+    _shared_fields = ('state', 'failures', 'opened_at', '_probe_started')
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, state_path: str):
+        self.state_path = state_path
+        super().__init__(failure_threshold, reset_timeout)
+
+
+# 每个 rootUrl 一组限流器与熔断器，进程内所有客户端共享；
+# 设置 upstream_state_dir 时状态保存在该目录下，同一台机器上的所有 worker 进程共享
+UPSTREAM_STATE_DIR = os.environ.get("upstream_state_dir", "")
+_HOST_GUARDS: Dict[str, Tuple[TokenBucket, CircuitBreaker]] = {}
+_HOST_GUARD_LOCK = threading.Lock()
+
+
+def get_host_guard(base_url: str) -> Tuple[TokenBucket, CircuitBreaker]:
+    """
+    获取 rootUrl 对应的限流器与熔断器，参数取自 config.json 的 rateLimit / circuitBreaker
+
+    未配置 rateLimit 时按每秒 5 个请求、突发 5 个限流，与原先逐个学期间隔 0.2 秒请求的节奏相当
+    """
+    with _HOST_GUARD_LOCK:
+        guard = _HOST_GUARDS.get(base_url)
+        if guard is None:
+            config = load_config()
+            rate_limit = config.get('rateLimit', {})
+            breaker = config.get('circuitBreaker', {})
+            bucket_args = (rate_limit.get('rate', 5), rate_limit.get('burst', 5), rate_limit.get('maxWait', 30))
+            breaker_args = (breaker.get('failureThreshold', 5), breaker.get('resetSeconds', 60))
+            if UPSTREAM_STATE_DIR and fcntl:
+                os.makedirs(UPSTREAM_STATE_DIR, exist_ok=True)
+                prefix = os.path.join(UPSTREAM_STATE_DIR, hashlib.sha1(base_url.encode('utf-8')).hexdigest()[:16])
+                guard = (
+                    SharedTokenBucket(*bucket_args, f"{prefix}.bucket.json"),
+                    SharedCircuitBreaker(*breaker_args, f"{prefix}.breaker.json")
+                )
+            else:
+                guard = (TokenBucket(*bucket_args), CircuitBreaker(*breaker_args))
+            _HOST_GUARDS[base_url] = guard
+        return guard
+
+
+def get_upstream_status() -> Dict[str, Dict[str, Any]]:
+    """各 rootUrl 的限流与熔断状态，供监控使用"""
+    with _HOST_GUARD_LOCK:
+        guards = dict(_HOST_GUARDS)
+    status = {}
+    for base_url, (bucket, breaker) in guards.items():
+        # 先调用 retry_after，共享状态的熔断器会在其中读取其他进程写入的最新状态
+        retry_after = breaker.retry_after()
+        status[base_url] = {
+            "circuit": breaker.state,
+            "consecutive_failures": breaker.failures,
+            "retry_after": round(retry_after, 1),
+            "circuit_rejected": breaker.rejected,
+            "tokens": round(bucket.available(), 2),
+            "rate_limited": bucket.rejected,
+        }
+    return status
+
+
+def get_http_adapter(base_url: str) -> HTTPAdapter:
+    """获取 rootUrl 对应的共享连接池"""
+    with _ADAPTER_LOCK:
+        adapter = _HTTP_ADAPTERS.get(base_url)
+        if adapter is None:
+            pool_size = UPSTREAM_POOL_SIZE * max(1, int(load_config().get('semesterConcurrency', 4)))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _HTTP_ADAPTERS[base_url] = adapter
+        return adapter
 
 
 class XqeClient:
     """喜鹊儿登录与课表操作客户端
     
-    线程安全：每个线程拥有独立的 requests.Session
+    每个客户端（即每次登录）拥有独立的 requests.Session 与 cookie，
+    底层 TCP 连接则通过按 rootUrl 共享的连接池复用
     """
     
     DEFAULT_TIMEOUT = 5
     
-    def __init__(self, base_url: str, timeout: Optional[int] = None):
+    def __init__(self, base_url: str, timeout: Optional[int] = None, kingo_des: Optional['KingoDES'] = None):
         self.base_url = base_url.rstrip('/')
         self.timeout = timeout or self.DEFAULT_TIMEOUT
-        self.kingo_des = KingoDES()
-    
-    @property
-    def session(self) -> requests.Session:
-        if not hasattr(_thread_local, 'session'):
-            _thread_local.session = requests.Session()
-        return _thread_local.session
+        self.kingo_des = kingo_des or KingoDES()
+        self.restored = False
+        self.session = requests.Session()
+        self.session.mount(self.base_url, get_http_adapter(self.base_url))
     
     def _request(self, method: str, url: str, **kwargs) -> requests.Response:
         timeout = kwargs.pop('timeout', self.timeout)
+        bucket, breaker = get_host_guard(self.base_url)
+        # 熔断期间直接失败，不再等待超时
+        if not breaker.allow():
+            _count_error("circuit_open")
+            raise CircuitOpenError(f"教务系统暂时不可用，{breaker.retry_after():.0f}s 后重试")
+        if not bucket.acquire(bucket.max_wait):
+            breaker.cancel()
+            _count_error("rate_limited")
+            raise Timeout(f"教务系统请求排队超时({bucket.max_wait:g}s)")
         try:
             response = self.session.request(method, url, timeout=timeout, **kwargs)
             response.raise_for_status()
@@ -173,15 +723,34 @@ class XqeClient:
                 parsed = urlparse(response.url)
                 qs = parse_qs(parsed.query)
                 errormsg = unquote(qs.get('errormsg', [''])[0])
-                raise Exception(f"教务系统返回错误：{errormsg or '未知错误'}")
+                _count_error("error_page")
+                if self.restored:
+                    # 复用的会话过期也会被重定向到错误页（get_timetable 转为 SessionExpiredError），不计入熔断
+                    breaker.cancel()
+                else:
+                    # 访问过于频繁、系统繁忙等错误页说明教务系统已过载，计入熔断
+                    breaker.record_failure()
+                raise KingoErrorPage(f"教务系统返回错误：{errormsg or '未知错误'}")
+            breaker.record_success()
             return response
         except Timeout:
+            breaker.record_failure()
+            _count_error("timeout")
             raise Timeout(f"教务系统服务器超时({self.timeout}s)")
         except RequestsConnectionError as e:
+            breaker.record_failure()
+            _count_error("connection")
             raise RequestsConnectionError(f"教务系统服务状态异常({str(e)})") from e
         except RequestException as e:
+            if e.response is not None and e.response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            _count_error("http")
             raise RequestException(f"连接到教务系统时出错({str(e)})") from e
     
+    @traced("login")
+    @_timed("login")
     def login(self, username: str, password: str) -> 'requests.Session':
         """
         完成登录流程并返回会话
@@ -189,6 +758,8 @@ class XqeClient:
         合并步骤：获取动态参数 → 组合登录参数 → 提交登录
         """
         logger.debug("正在获取登录页面...")
+        self.session.cookies.clear()
+        self.restored = False
         response = self._request('GET', f"{self.base_url}/cas/login.action")
         
         jsessionid = self.session.cookies.get('JSESSIONID')
@@ -225,45 +796,268 @@ class XqeClient:
             'Content-Type': 'application/x-www-form-urlencoded',
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
             'Referer': f"{self.base_url}/cas/login.action",
-            'Cookie': f"JSESSIONID={jsessionid}"
         }
         
         response = self._request('POST', f"{self.base_url}/cas/logon.action", data=params, headers=headers)
         result = response.json()
         if result.get("status") != "200":
             logger.warning(f"用户 {username} 登录失败：{result.get('message', '未知错误')}")
-            raise Exception(f"登录失败: {result.get('message', '未知错误')}")
+            raise LoginError(f"登录失败: {result.get('message', '未知错误')}")
         
         logger.info(f"用户 {username} 登录成功")
+        self.save_session(username, password)
         return self.session
     
+    def fork(self) -> 'XqeClient':
+        """
+        复制当前的登录状态：新客户端有自己的 requests.Session 与 cookie 副本，底层共用同一个连接池
+
+        requests.Session 不保证线程安全，并发获取多个学期时每个线程使用一个副本
+        """
+        client = XqeClient(self.base_url, self.timeout, self.kingo_des)
+        client.session.cookies.update(self.session.cookies)
+        return client
+    
+    def _session_key(self, username: str, password: str) -> Tuple[str, str, str]:
+        return (self.base_url, username, password)
+    
+    def save_session(self, username: str, password: str):
+        """记录当前会话的 cookies，供同一用户下次抓取时跳过登录，并定期清理过期的会话"""
+        global _session_pruned_at
+        now = time.time()
+        with _SESSION_LOCK:
+            _SESSION_STORE[self._session_key(username, password)] = (
+                self.session.cookies.get_dict(), now
+            )
+            if now - _session_pruned_at >= SESSION_PRUNE_INTERVAL:
+                _session_pruned_at = now
+                expired = [key for key, (_, saved_at) in _SESSION_STORE.items() if now - saved_at > SESSION_MAX_AGE]
+                for key in expired:
+                    del _SESSION_STORE[key]
+    
+    def restore_session(self, username: str, password: str) -> bool:
+        """尝试复用之前登录得到的会话，是否有效要等第一次请求才能确定"""
+        key = self._session_key(username, password)
+        with _SESSION_LOCK:
+            saved = _SESSION_STORE.get(key)
+            if saved and time.time() - saved[1] > SESSION_MAX_AGE:
+                del _SESSION_STORE[key]
+                saved = None
+        if not saved:
+            return False
+        
+        self.session.cookies.clear()
+        self.session.cookies.update(saved[0])
+        self.restored = True
+        logger.debug(f"复用用户 {username} 的已登录会话")
+        return True
+    
+    def discard_session(self, username: str, password: str):
+        with _SESSION_LOCK:
+            _SESSION_STORE.pop(self._session_key(username, password), None)
+    
+    @traced("semester")
+    @_timed("semester")
     def get_timetable(self, school_year: str, term: str, user_code: str) -> str:
         """获取指定学期的课表 HTML"""
-        jsessionid = self.session.cookies.get('JSESSIONID')
-        
         headers = {
             "Referer": f"{self.base_url}/student/xkjg.wdkb.jsp?menucode=S20301",
-            "Cookie": f"JSESSIONID={jsessionid}",
         }
         
         params_raw = f"xn={school_year}&xq={term}&xh={user_code}"
         params_encoded = XqeLibs.base64_encode(params_raw)
         
         url = f"{self.base_url}/student/wsxk.xskcb10319.jsp?params={params_encoded}"
-        response = self._request('GET', url, headers=headers)
+        try:
+            response = self._request('GET', url, headers=headers)
+        except KingoErrorPage as e:
+            if self.restored:
+                raise SessionExpiredError(str(e)) from e
+            raise
+        
+        if '/cas/login' in response.url:
+            raise SessionExpiredError("会话已失效，被重定向到登录页")
         
         return response.text
 
 
 # ============ HTML 解析 ============
+class _MyTableNode:
+    """#mytable 子树中的元素节点，children 为子节点或文本"""
+    
+    __slots__ = ('name', 'attrs', 'children')
+    
+    def __init__(self, name: str, attrs: Dict[str, str]):
+        self.name = name
+        self.attrs = attrs
+        self.children: List[Any] = []
+    
+    def iter(self, name: str):
+        """按文档顺序遍历名为 name 的后代元素（同 find_all）"""
+        for child in self.children:
+            if isinstance(child, _MyTableNode):
+                if child.name == name:
+                    yield child
+                yield from child.iter(name)
+    
+    def strings(self):
+        for child in self.children:
+            if isinstance(child, _MyTableNode):
+                yield from child.strings()
+            else:
+                yield child
+    
+    def has_class(self, cls: str) -> bool:
+        value = self.attrs.get('class')
+        return value is not None and (value == cls or cls in value.split())
+
+
+class _MyTableDone(Exception):
+    """#mytable 已闭合，无需继续解析"""
+
+
+class _MyTableParser(HTMLParser):
+    """
+    只为 #mytable 建树的流式解析器
+
+    表格外只记录打开的标签名：结束标签按 BeautifulSoup（html.parser）的规则弹栈到最近的同名标签，
+    表格外未闭合的标签也可能提前关闭表格，因此仍需跟踪。表格闭合后立即停止解析。
+    """
+    
+    VOID_ELEMENTS = frozenset((
+        'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+        'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+        'spacer', 'track', 'wbr',
+    ))
+    # 这些标签内的文本不计入 get_text()
+    STRING_CONTAINERS = frozenset(('script', 'style', 'template', 'rt', 'rp'))
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.table: Optional[_MyTableNode] = None
+        self._stack: List[str] = []
+        self._open: Dict[str, int] = {}
+        self._nodes: List[_MyTableNode] = []
+        self._table_depth = -1
+        self._containers = 0
+        self._closed_void: Dict[str, int] = {}
+        self._text: List[str] = []
+    
+    def _flush(self):
+        if self._text:
+            if self._nodes and not self._containers:
+                self._nodes[-1].children.append(''.join(self._text))
+            self._text = []
+    
+    def _push(self, name: str, attrs: Dict[str, str]):
+        if self._nodes:
+            node = _MyTableNode(name, attrs)
+            self._nodes[-1].children.append(node)
+            self._nodes.append(node)
+        elif self.table is None and name == 'table' and attrs.get('id') == 'mytable':
+            self.table = _MyTableNode(name, attrs)
+            self._nodes.append(self.table)
+            self._table_depth = len(self._stack)
+        self._stack.append(name)
+        self._open[name] = self._open.get(name, 0) + 1
+        if name in self.STRING_CONTAINERS:
+            self._containers += 1
+    
+    def _pop_to(self, name: str):
+        if not self._open.get(name):
+            return
+        while True:
+            popped = self._stack.pop()
+            self._open[popped] -= 1
+            if popped in self.STRING_CONTAINERS:
+                self._containers -= 1
+            if len(self._stack) == self._table_depth:
+                raise _MyTableDone()
+            if self._nodes and len(self._stack) > self._table_depth:
+                self._nodes.pop()
+            if popped == name:
+                return
+    
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        self._push(tag, {key: value or '' for key, value in attrs})
+        if tag in self.VOID_ELEMENTS:
+            self._pop_to(tag)
+            # 之后出现的同名结束标签（如 </br>）会被忽略，与 BeautifulSoup 一致
+            self._closed_void[tag] = self._closed_void.get(tag, 0) + 1
+    
+    def handle_startendtag(self, tag, attrs):
+        self._flush()
+        self._push(tag, {key: value or '' for key, value in attrs})
+        self.handle_endtag(tag)
+    
+    def handle_endtag(self, tag):
+        if self._closed_void.get(tag):
+            self._closed_void[tag] -= 1
+            return
+        self._flush()
+        self._pop_to(tag)
+    
+    def handle_data(self, data):
+        if self._nodes:
+            self._text.append(data)
+    
+    def handle_charref(self, name):
+        # html.unescape 会丢弃控制字符等码位，BeautifulSoup 则原样保留
+        code = int(name[1:], 16) if name[:1] in 'xX' else int(name)
+        self.handle_data(html.unescape(f"&#{name};") or chr(code))
+    
+    def handle_entityref(self, name):
+        self.handle_data(html.entities.html5.get(f"{name};", f"&{name}"))
+    
+    def handle_comment(self, data):
+        self._flush()
+    
+    def handle_decl(self, decl):
+        self._flush()
+    
+    def handle_pi(self, data):
+        self._flush()
+    
+    def unknown_decl(self, data):
+        self._flush()
+        if data.upper().startswith('CDATA[') and self._nodes:
+            self._nodes[-1].children.append(data[len('CDATA['):])
+    
+    @classmethod
+    def parse(cls, html_content: str) -> Optional[_MyTableNode]:
+        parser = cls()
+        try:
+            parser.feed(html_content)
+            parser.close()
+            parser._flush()
+        except _MyTableDone:
+            pass
+        return parser.table
+
+
 class Table2Json:
-    """将 HTML 课表解析为 JSON 格式"""
+    """
+    将 HTML 课表解析为 JSON 格式
+
+    config.json 中 "timetableParser" 选择解析后端：
+    - "bs4"（默认）：BeautifulSoup 构建整页文档树
+    - "stream"：只为 #mytable 建立轻量节点树的流式解析，输出与 bs4 一致
+    """
+    
+    WEEKDAYS_MAPPING = {0: 1, 1: 2, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7}
+    COURSE_DIV_STYLE = 'padding-bottom:5px;clear:both;'
+    TITLE_STYLE = 'font-weight: bolder'
     
     @staticmethod
-    def parse_course_schedule(html_content: str) -> List[Dict[str, Any]]:
+    @traced("parse")
+    def parse_course_schedule(html_content: str, parser: Optional[str] = None) -> List[Dict[str, Any]]:
         """解析 HTML 并提取课程信息"""
+        parser = parser or load_config().get('timetableParser', 'bs4')
+        if parser == 'stream':
+            return Table2Json._parse_stream(html_content)
+        
         soup = BeautifulSoup(html_content, 'html.parser')
-        weekdays_mapping = {0: 1, 1: 2, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7}
         
         courses = []
         
@@ -278,53 +1072,92 @@ class Table2Json:
             course_cells = row.find_all('td', class_='td')[:7]
             
             for i, cell in enumerate(course_cells[:7]):
-                weekday = weekdays_mapping[i]
+                weekday = Table2Json.WEEKDAYS_MAPPING[i]
                 
-                for div in cell.find_all('div', style=lambda v: v and 'padding-bottom:5px;clear:both;' in v):
+                for div in cell.find_all('div', style=lambda v: v and Table2Json.COURSE_DIV_STYLE in v):
                     course_info = Table2Json._parse_course_div(div, weekday)
                     if course_info:
                         courses.append(course_info)
         
         return courses
     
+    @staticmethod
+    def _parse_stream(html_content: str) -> List[Dict[str, Any]]:
+        courses = []
+        
+        table = _MyTableParser.parse(html_content)
+        if table is None:
+            return courses
+        
+        for row in list(table.iter('tr'))[1:]:
+            if not any(td.has_class('td1') for td in row.iter('td')):
+                continue
+            
+            course_cells = [td for td in row.iter('td') if td.has_class('td')][:7]
+            
+            for i, cell in enumerate(course_cells):
+                weekday = Table2Json.WEEKDAYS_MAPPING[i]
+                
+                for div in cell.iter('div'):
+                    if Table2Json.COURSE_DIV_STYLE not in div.attrs.get('style', ''):
+                        continue
+                    try:
+                        title_tag = next((font for font in div.iter('font')
+                                          if font.attrs.get('style') == Table2Json.TITLE_STYLE), None)
+                        if not title_tag:
+                            continue
+                        title = ''.join(s.strip() for s in title_tag.strings())
+                        course_info = Table2Json._build_course(title, div.strings(), weekday)
+                    except Exception:
+                        continue
+                    if course_info:
+                        courses.append(course_info)
+        
+        return courses
+    
     @staticmethod
     def _parse_course_div(div: BeautifulSoup, weekday: int) -> Optional[Dict[str, Any]]:
         """解析单个课程 div 元素"""
         try:
-            title_tag = div.find('font', style='font-weight: bolder')
+            title_tag = div.find('font', style=Table2Json.TITLE_STYLE)
             if not title_tag:
                 return None
             
             title = title_tag.get_text(strip=True)
-            text_lines = [line.strip() for line in div.get_text(separator='|').split('|') if line.strip()]
-            
-            teacher = text_lines[1] if len(text_lines) > 1 else ""
-            
-            week_time_info = text_lines[2] if len(text_lines) > 2 else ""
-            
-            teaching_weeks = ""
-            class_periods = ""
-            if '[' in week_time_info and ']' in week_time_info:
-                teaching_weeks = week_time_info.split('[')[0].strip()
-                class_periods = week_time_info.split('[')[1].split(']')[0].strip()
-            
-            location = text_lines[3] if len(text_lines) > 3 else ""
-            
-            course_data = {
-                "weekday": weekday,
-                "title": title,
-                "teacher": teacher.replace("教师:", "").strip(),
-                "teaching_weeks": teaching_weeks,
-                "class_periods": class_periods,
-                "location": location
-            }
-            
-            if not all([course_data["title"], course_data["teaching_weeks"], course_data["class_periods"]]):
-                return None
-            
-            return course_data
+            return Table2Json._build_course(title, [div.get_text(separator='|')], weekday)
         except Exception:
             return None
+    
+    @staticmethod
+    def _build_course(title: str, strings, weekday: int) -> Optional[Dict[str, Any]]:
+        """由标题与 div 内的文本片段组装课程信息（两种解析后端共用）"""
+        text_lines = [line.strip() for text in strings for line in text.split('|') if line.strip()]
+        
+        teacher = text_lines[1] if len(text_lines) > 1 else ""
+        
+        week_time_info = text_lines[2] if len(text_lines) > 2 else ""
+        
+        teaching_weeks = ""
+        class_periods = ""
+        if '[' in week_time_info and ']' in week_time_info:
+            teaching_weeks = week_time_info.split('[')[0].strip()
+            class_periods = week_time_info.split('[')[1].split(']')[0].strip()
+        
+        location = text_lines[3] if len(text_lines) > 3 else ""
+        
+        course_data = {
+            "weekday": weekday,
+            "title": title,
+            "teacher": teacher.replace("教师:", "").strip(),
+            "teaching_weeks": teaching_weeks,
+            "class_periods": class_periods,
+            "location": location
+        }
+        
+        if not all([course_data["title"], course_data["teaching_weeks"], course_data["class_periods"]]):
+            return None
+        
+        return course_data
 
 
 # ============ 主入口 ============
@@ -333,7 +1166,9 @@ def main(
     once_md5_password: str,
     school_year: str = None,
     term: str = None,
-    all_semesters: bool = True
+    all_semesters: bool = True,
+    frozen: Dict[str, List[Dict[str, Any]]] = None,
+    known: Dict[str, Dict[str, Any]] = None
 ) -> str:
     """
     主函数：获取课表并返回 JSON 字符串
@@ -344,9 +1179,13 @@ def main(
         school_year: 指定学年（如 "2025"）
         term: 指定学期（如 "1"）
         all_semesters: 是否获取所有可用学期的课表
+        frozen: 已结束学期的缓存课程 {"2024-1": [...]}，这些学期不再重新获取
+        known: 未结束学期上次的页面哈希与课程 {"2025-1": {"hash": ..., "courses": [...]}}，
+            页面哈希相同时直接沿用课程，不再解析
     
     返回:
-        包含课表数据的 JSON 字符串
+        包含课表数据的 JSON 字符串，frozen_semesters 列出已结束（不会再变化）的学期，
+        semester_hashes 为本次获取的各学期页面哈希
     """
     _init_logging()
     
@@ -358,25 +1197,76 @@ def main(
     
     logger.info(f"获取课表: 用户={username}, 全部学期={all_semesters}")
     
-    # 登录教务系统
-    client = XqeClient(base_url)
-    session = client.login(username, once_md5_password)
-    
     available_semesters = get_available_semesters()[:8]
     timetable_config = load_timetable_config()
     
+    # 登录教务系统：有可用的旧会话时先尝试复用，由第一次课表请求验证会话是否有效；
+    # 所有学期均已结束并有缓存时不再请求课表，但仍完整登录一次以校验密码
+    client = XqeClient(base_url)
+    has_pending = not all_semesters or any(sem_key not in (frozen or {}) for sem_key in available_semesters)
+    if not has_pending or not client.restore_session(username, once_md5_password):
+        client.login(username, once_md5_password)
+    
+    def fetch_timetable(sem_year: str, sem_term: str, sem_client: XqeClient = client) -> str:
+        try:
+            html = sem_client.get_timetable(sem_year, sem_term, username)
+        except SessionExpiredError:
+            if not sem_client.restored:
+                raise
+            logger.info(f"用户 {username} 的缓存会话已失效，重新登录")
+            sem_client.discard_session(username, once_md5_password)
+            sem_client.login(username, once_md5_password)
+            html = sem_client.get_timetable(sem_year, sem_term, username)
+        sem_client.restored = False
+        return html
+    
     if all_semesters:
         all_courses = []
+        frozen = frozen or {}
+        known = known or {}
+        frozen_semesters = []
+        semester_hashes = {}
+        
+        def load_semester(sem_key: str, sem_client: XqeClient = client) -> Tuple[str, List[Dict[str, Any]]]:
+            """获取并解析一个学期，在线程池中执行时解析与其他学期的网络请求重叠"""
+            sem_year, sem_term = sem_key.split('-')
+            logger.debug(f"获取学期: {sem_year}-{sem_term}")
+            html = fetch_timetable(sem_year, sem_term, sem_client)
+            page_hash = hashlib.sha256(html.encode('utf-8')).hexdigest()
+            if known.get(sem_key, {}).get('hash') == page_hash:
+                # 页面与上次完全相同，沿用上次解析的课程
+                logger.debug(f"学期 {sem_year}-{sem_term} 页面未变化，跳过解析")
+                return page_hash, [dict(course) for course in known[sem_key]['courses']]
+            return page_hash, Table2Json.parse_course_schedule(html)
+        
+        # 已结束的学期直接沿用缓存，不再请求教务系统；其余学期复制登录 cookie 后并发获取，速率受限流器约束
+        pending = [sem_key for sem_key in available_semesters if sem_key not in frozen]
+        loaded = {}
+        if pending and client.restored:
+            # 复用的会话是否有效要等第一次请求才能确定，先单独获取一个学期（失效时在这里重新登录）
+            loaded[pending[0]] = load_semester(pending[0])
+            pending = pending[1:]
+        if pending:
+            concurrency = max(1, min(int(config.get('semesterConcurrency', 4)), len(pending)))
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="xqe-semester") as executor:
+                # 每个任务复制一份当前上下文，计时数据才能记到发起请求的 Trace 上；
+                # 并各自使用一个复制了登录 cookie 的客户端，线程之间不共用 requests.Session
+                futures = [executor.submit(contextvars.copy_context().run, load_semester, sem_key, client.fork())
+                           for sem_key in pending]
+                loaded.update(zip(pending, (future.result() for future in futures)))
         
         for sem_key in available_semesters:
             sem_year, sem_term = sem_key.split('-')
             
-            logger.debug(f"获取学期: {sem_year}-{sem_term}")
-            html = client.get_timetable(sem_year, sem_term, username)
-            courses = Table2Json.parse_course_schedule(html)
+            if sem_key in frozen:
+                frozen_semesters.append(sem_key)
+                all_courses.extend(frozen[sem_key])
+                continue
+            
+            semester_hashes[sem_key], courses = loaded[sem_key]
             
-            # 学期间延迟，避免触发频率限制
-            time.sleep(0.2)
+            if SchoolCalendar.is_term_finished(sem_year, sem_term):
+                frozen_semesters.append(sem_key)
             
             if not courses:
                 logger.debug(f"学期 {sem_year}-{sem_term} 无课程数据")
@@ -394,7 +1284,9 @@ def main(
         
         result = {
             "timetable": timetable_config,
-            "courses": all_courses
+            "courses": all_courses,
+            "frozen_semesters": frozen_semesters,
+            "semester_hashes": semester_hashes
         }
     else:
         # 单学期模式
@@ -403,7 +1295,7 @@ def main(
             school_year, term = current_sem.split('-')
         
         logger.debug(f"获取单学期: {school_year}-{term}")
-        html = client.get_timetable(school_year, term, username)
+        html = fetch_timetable(school_year, term)
         courses = Table2Json.parse_course_schedule(html)
         
         logger.info(f"学期 {school_year}-{term} 获取到 {len(courses)} 门课程")
@@ -413,10 +1305,13 @@ def main(
             "courses": courses
         }
     
+    client.save_session(username, once_md5_password)
+    
     logger.info(f"课程总数: {len(result['courses'])}")
     return json.dumps(result, ensure_ascii=False, indent=4)
 
 
 # 兼容 xqe.py 的驼峰参数命名
-def Main(username: str, onceMd5Password: str, school_year: str = None, term: str = None, all_semesters: bool = True) -> str:
-    return main(username, onceMd5Password, school_year, term, all_semesters)
+def Main(username: str, onceMd5Password: str, school_year: str = None, term: str = None, all_semesters: bool = True,
+         frozen: Dict[str, List[Dict[str, Any]]] = None, known: Dict[str, Dict[str, Any]] = None) -> str:
+    return main(username, onceMd5Password, school_year, term, all_semesters, frozen, known)
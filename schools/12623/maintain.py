@@ -21,7 +21,7 @@ class SchoolCalendarSync:
             config_path = os.path.join(self.script_dir, config_path)
         self.config = self._load_config(config_path)
         # 从配置中获取 rootUrl
-        self.url = self.config.get("rootUrl", "")
+        self.url = os.environ.get("kingo_root_url") or self.config.get("rootUrl", "")
         if not self.url:
             raise ValueError("rootUrl not found in config")
         
@@ -207,8 +207,11 @@ if __name__ == "__main__":
     if not os.path.isabs(output_file):
         output_file = os.path.join(sync.script_dir, output_file)
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
+        # 先写临时文件再原子替换，运行中的服务不会读到写了一半的校历
+        tmp_file = f"{output_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
             json.dump(schoolCalendar, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_file, output_file)
         logging.info(f"Calendar data saved to {output_file}")
     except Exception as e:
         logging.error(f"Failed to save JSON file: {e}")
\ No newline at end of file
@@ -0,0 +1,343 @@
+"""
+用户数据存储后端
+
+保存每个用户的 user_info（访问/抓取时间等）与课表缓存，支持两种后端：
+- sqlite（默认）：单个 WAL 模式的数据库文件，按 (school_code, username) 建主键
+- file：旧版的 user/<school>/<id>/user_info.json 与 cache.json 目录结构
+
+通过环境变量 storage_backend 选择后端，storage_path 指定数据库路径。
+使用 sqlite 后端时，数据库中还没有用户而 user/ 下有旧版目录结构的数据，首次启动时自动导入。
+多个 worker 进程之间的用户级文件锁与其他每用户状态文件统一放在 user/locks/：
+文件锁按 (学校, 学号) 的哈希分到固定数量的锁文件上，每用户状态文件按哈希命名，过期后由 prune_user_state 删除。
+"""
+import os
+import sys
+import json
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Iterator, Tuple
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台只做进程内合并
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+USER_DIR_BASE = "user"
+DEFAULT_DB_PATH = os.path.join(USER_DIR_BASE, "xqe.db")
+LOCK_DIR = os.path.join(USER_DIR_BASE, "locks")
+# 锁文件数固定，不随（包括不存在的）学号增长；哈希到同一个锁文件的用户之间偶尔多等一次
+LOCK_STRIPES = 1024
+
+
+def _user_digest(school_code: str, username: str) -> str:
+    return hashlib.sha1(f"{school_code}/{username}".encode('utf-8')).hexdigest()
+
+
+def user_state_path(school_code: str, username: str, suffix: str) -> str:
+    """用户级状态文件的路径；不为用户创建目录，写入方负责过期后用 prune_user_state 删除"""
+    return os.path.join(LOCK_DIR, _user_digest(school_code, username) + suffix)
+
+
+def prune_user_state(suffix: str, max_age: float) -> int:
+    """删除超过 max_age 秒未更新的用户级状态文件，返回删除的文件数"""
+    removed = 0
+    now = time.time()
+    try:
+        names = os.listdir(LOCK_DIR)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(LOCK_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+@contextmanager
+def user_lock(school_code: str, username: str):
+    """
+    用户级文件锁，多个 worker 进程（以及同一进程的多个线程）之间互斥
+
+    持有期间不能再获取其他用户的锁，两者可能落在同一个锁文件上
+    """
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    stripe = int(_user_digest(school_code, username)[:8], 16) % LOCK_STRIPES
+    with open(os.path.join(LOCK_DIR, f"{stripe:04d}.lock"), "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class FileStore:
+    """旧版目录结构：每个用户一个目录，两个 JSON 文件"""
+
+    def __init__(self, base_dir: str = USER_DIR_BASE):
+        self.base_dir = base_dir
+
+    def _user_dir(self, school_code: str, username: str) -> str:
+        return os.path.join(self.base_dir, school_code, username)
+
+    def _load(self, path: str) -> Dict[str, Any]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save(self, school_code: str, username: str, name: str, data: Dict[str, Any]):
+        # 先写临时文件再原子替换，读者不会看到写了一半的文件，因此读写都无需加锁
+        user_dir = self._user_dir(school_code, username)
+        os.makedirs(user_dir, exist_ok=True)
+        path = os.path.join(user_dir, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+
+    def user_exists(self, school_code: str, username: str) -> bool:
+        return os.path.exists(os.path.join(self._user_dir(school_code, username), "user_info.json"))
+
+    def load_user_info(self, school_code: str, username: str) -> Dict[str, Any]:
+        return self._load(os.path.join(self._user_dir(school_code, username), "user_info.json"))
+
+    def save_user_info(self, school_code: str, username: str, info: Dict[str, Any]):
+        self._save(school_code, username, "user_info.json", info)
+
+    def load_cache(self, school_code: str, username: str) -> Dict[str, Any]:
+        return self._load(os.path.join(self._user_dir(school_code, username), "cache.json"))
+
+    def save_cache(self, school_code: str, username: str, data: Dict[str, Any]):
+        self._save(school_code, username, "cache.json", data)
+
+    def save_user(self, school_code: str, username: str, info: Dict[str, Any], cache: Dict[str, Any] = None):
+        """保存抓取结果；先写缓存再写 user_info，user_exists 为真时缓存一定已经存在"""
+        if cache is not None:
+            self.save_cache(school_code, username, cache)
+        self.save_user_info(school_code, username, info)
+
+    def update_access_times(self, access_times: Dict[Tuple[str, str], str]):
+        """批量更新 last_access_time，读改写期间持有用户锁，不会覆盖同时写入的抓取结果"""
+        for (school_code, username), access_time in access_times.items():
+            with user_lock(school_code, username):
+                info = self.load_user_info(school_code, username)
+                if info:
+                    info["last_access_time"] = access_time
+                    self.save_user_info(school_code, username, info)
+
+    def iter_users(self) -> Iterator[Tuple[str, str]]:
+        """遍历所有 (school_code, username)"""
+        if not os.path.isdir(self.base_dir):
+            return
+        for school_code in sorted(os.listdir(self.base_dir)):
+            school_dir = os.path.join(self.base_dir, school_code)
+            if not os.path.isdir(school_dir):
+                continue
+            for username in sorted(os.listdir(school_dir)):
+                if self.user_exists(school_code, username):
+                    yield school_code, username
+
+
+class SQLiteStore:
+    """
+    SQLite 存储：WAL 模式支持多个读者与一个写者并发，多个 worker 进程可共享同一文件
+
+    时间戳单独存列并建索引，便于按最近访问/抓取时间筛选用户。
+    update_access_times 不加用户锁，因此写入 user_info 时保留库中较新的 last_access_time，
+    调用方拿着较早读出的 info 保存也不会让访问时间倒退。
+    """
+
+    # 新旧 last_access_time 取较新者，info 中的同名字段随之修正
+    _MERGE_INFO = """
+        info = CASE
+            WHEN users.last_access_time IS NOT NULL AND (excluded.last_access_time IS NULL
+                                                         OR users.last_access_time > excluded.last_access_time)
+            THEN json_set(excluded.info, '$.last_access_time', users.last_access_time)
+            ELSE excluded.info END,
+        last_access_time = COALESCE(MAX(excluded.last_access_time, users.last_access_time),
+                                    excluded.last_access_time, users.last_access_time),
+        last_fetch_time = excluded.last_fetch_time
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            school_code TEXT NOT NULL,
+            username TEXT NOT NULL,
+            info TEXT NOT NULL DEFAULT '{}',
+            cache TEXT,
+            last_access_time TEXT,
+            last_fetch_time TEXT,
+            PRIMARY KEY (school_code, username)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_users_last_access ON users (last_access_time);
+        CREATE INDEX IF NOT EXISTS idx_users_last_fetch ON users (last_fetch_time);
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn.executescript(self.SCHEMA)
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程使用，每个线程各自打开一个
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _load_column(self, column: str, school_code: str, username: str) -> Optional[str]:
+        row = self._conn.execute(
+            f"SELECT {column} FROM users WHERE school_code = ? AND username = ?",
+            (school_code, username)
+        ).fetchone()
+        return row[0] if row else None
+
+    def user_exists(self, school_code: str, username: str) -> bool:
+        return self._load_column("1", school_code, username) is not None
+
+    def load_user_info(self, school_code: str, username: str) -> Dict[str, Any]:
+        raw = self._load_column("info", school_code, username)
+        return json.loads(raw) if raw else {}
+
+    def save_user_info(self, school_code: str, username: str, info: Dict[str, Any]):
+        self._conn.execute(
+            """
+            INSERT INTO users (school_code, username, info, last_access_time, last_fetch_time)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (school_code, username) DO UPDATE SET
+            """ + self._MERGE_INFO,
+            (school_code, username, json.dumps(info, ensure_ascii=False),
+             info.get("last_access_time"), info.get("last_fetch_time"))
+        )
+
+    def load_cache(self, school_code: str, username: str) -> Dict[str, Any]:
+        raw = self._load_column("cache", school_code, username)
+        return json.loads(raw) if raw else {}
+
+    def save_cache(self, school_code: str, username: str, data: Dict[str, Any]):
+        self._conn.execute(
+            """
+            INSERT INTO users (school_code, username, cache) VALUES (?, ?, ?)
+            ON CONFLICT (school_code, username) DO UPDATE SET cache = excluded.cache
+            """,
+            (school_code, username, json.dumps(data, ensure_ascii=False))
+        )
+
+    def save_user(self, school_code: str, username: str, info: Dict[str, Any], cache: Dict[str, Any] = None):
+        """在一条语句中同时写入 user_info 与课表缓存（cache 为 None 时保留原有缓存）"""
+        self._conn.execute(
+            """
+            INSERT INTO users (school_code, username, info, cache, last_access_time, last_fetch_time)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (school_code, username) DO UPDATE SET
+                cache = COALESCE(excluded.cache, users.cache),
+            """ + self._MERGE_INFO,
+            (school_code, username, json.dumps(info, ensure_ascii=False),
+             None if cache is None else json.dumps(cache, ensure_ascii=False),
+             info.get("last_access_time"), info.get("last_fetch_time"))
+        )
+
+    def update_access_times(self, access_times: Dict[Tuple[str, str], str]):
+        """批量更新 last_access_time，一个事务完成"""
+        with self.transaction():
+            self._conn.executemany(
+                """
+                UPDATE users SET last_access_time = ?, info = json_set(info, '$.last_access_time', ?)
+                WHERE school_code = ? AND username = ?
+                """,
+                [(t, t, school_code, username) for (school_code, username), t in access_times.items()]
+            )
+
+    def iter_users(self) -> Iterator[Tuple[str, str]]:
+        yield from self._conn.execute("SELECT school_code, username FROM users").fetchall()
+
+    def import_from(self, src: FileStore, only_if_empty: bool = False) -> int:
+        """
+        在一个事务中导入 src 中的全部用户（已存在的用户会被覆盖），返回导入的用户数
+
+        only_if_empty 时数据库中已有用户则不导入；事务持有写锁，多个 worker 同时启动时只有一个进程导入
+        """
+        count = 0
+        with self.transaction():
+            if only_if_empty and self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+                return 0
+            for school_code, username in src.iter_users():
+                self.save_user(school_code, username, src.load_user_info(school_code, username),
+                               src.load_cache(school_code, username))
+                count += 1
+        return count
+
+    @contextmanager
+    def transaction(self):
+        """批量写入时合并为一个事务"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def create_store(backend: str = None, path: str = None):
+    backend = backend or os.environ.get("storage_backend", "sqlite")
+    if backend == "file":
+        return FileStore(path or USER_DIR_BASE)
+    if backend == "sqlite":
+        return SQLiteStore(path or os.environ.get("storage_path", DEFAULT_DB_PATH))
+    raise ValueError(f"未知的存储后端 {backend}")
+
+
+def get_store():
+    """按环境变量创建的全局存储实例"""
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                store = create_store()
+                if isinstance(store, SQLiteStore):
+                    count = store.import_from(FileStore(USER_DIR_BASE), only_if_empty=True)
+                    if count:
+                        logger.info(f"已从 {USER_DIR_BASE}/ 下的旧版目录结构导入 {count} 个用户到 {store.db_path}")
+                _STORE = store
+    return _STORE
+
+
+def migrate(src_dir: str = USER_DIR_BASE, db_path: str = DEFAULT_DB_PATH) -> int:
+    """将旧版目录结构中的用户数据导入 SQLite，已存在的用户会被覆盖"""
+    return SQLiteStore(db_path).import_from(FileStore(src_dir))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        src_dir = sys.argv[2] if len(sys.argv) > 2 else USER_DIR_BASE
+        db_path = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_DB_PATH
+        print(f"已导入 {migrate(src_dir, db_path)} 个用户到 {db_path}")
+    else:
+        print("用法: python storage.py migrate [user_dir] [db_path]")
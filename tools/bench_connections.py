@@ -0,0 +1,84 @@
+"""
+学校模块与教务系统之间的 TCP 连接数统计
+
+用模拟教务系统依次（或 --concurrency 个线程并发）为 --fetches 个不同学号调用学校模块的 main()，
+统计模拟教务系统接受的 TCP 连接数，换算为每 100 次抓取新建的连接数。
+--baseline 指定 git 提交时，用该提交中的 schools/<学校代码>/main.py 跑同样的抓取做对比
+（如每个线程一个 requests.Session、不共享连接池的版本）。
+
+用法:
+    python tools/bench_connections.py [--fetches 100] [--concurrency 1] [--baseline <git 提交>]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_kingo import FakeKingo, user_password
+from loadgen import REPO_DIR
+
+
+def load_school_revision(school_code: str, revision: str, kingo_url: str, workdir: str):
+    """把学校目录复制到 workdir（rootUrl 指向模拟教务系统），main.py 换成指定提交中的版本后加载"""
+    school_dir = os.path.join(workdir, school_code)
+    shutil.copytree(os.path.join(REPO_DIR, 'schools', school_code), school_dir,
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    if revision:
+        source = subprocess.run(["git", "-C", REPO_DIR, "show", f"{revision}:schools/{school_code}/main.py"],
+                                check=True, capture_output=True).stdout
+        with open(os.path.join(school_dir, 'main.py'), 'wb') as f:
+            f.write(source)
+    config_path = os.path.join(school_dir, 'config.json')
+    with open(config_path, encoding='utf-8') as f:
+        config = json.load(f)
+    # 不让客户端限流影响连接数；旧版本会忽略这一项
+    config.update(rootUrl=kingo_url, rateLimit={"rate": 1000, "burst": 1000})
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    spec = importlib.util.spec_from_file_location(f"school_{school_code}_{revision or 'current'}",
+                                                  os.path.join(school_dir, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_variant(name: str, revision: str, kingo: FakeKingo, args, first_id: int):
+    with tempfile.TemporaryDirectory() as workdir:
+        school = load_school_revision(args.school, revision, kingo.base_url, workdir)
+        usernames = [str(first_id + i) for i in range(args.fetches)]
+        kingo.counts.clear()
+        connections_before = kingo.connections
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(lambda username: school.main(username, user_password(username)), usernames))
+        elapsed = time.perf_counter() - started
+        connections = kingo.connections - connections_before
+        requests_total = sum(count for endpoint, count in kingo.counts.items() if endpoint != "errors")
+        print(f"{name}: {args.fetches} 次抓取（{args.concurrency} 并发）耗时 {elapsed:.1f}s，上游请求 {requests_total} 次，"
+              f"新建 TCP 连接 {connections} 个（每 100 次抓取 {connections * 100 / args.fetches:.1f} 个）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="学校模块的 TCP 连接数统计")
+    parser.add_argument("--school", default="12623")
+    parser.add_argument("--fetches", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--baseline", help="对比的 git 提交")
+    args = parser.parse_args()
+
+    kingo = FakeKingo(school_code=args.school).start()
+    try:
+        if args.baseline:
+            run_variant(args.baseline, args.baseline, kingo, args, 2040000000)
+        run_variant("当前", None, kingo, args, 2050000000)
+    finally:
+        kingo.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+慢抓取期间缓存用户的延迟压测
+
+模拟教务系统注入较大延迟，一组线程不断为新用户发起冷抓取，另一组线程同时轮询已有缓存的用户，
+比较没有抓取时与抓取进行中缓存用户请求的 p50/p99 延迟。上游抓取在独立线程池中执行时，
+缓存用户的 p99 应基本不变。
+
+--baseline 指定一个 git 提交（如在事件循环中直接执行 Main 的版本）时，
+用该提交根目录下的 .py 文件启动同样的服务对比（学校模块取自当前目录）。
+
+用法:
+    python tools/bench_executor.py [--cached-users 20] [--pollers 8] [--slow-latency 1.0]
+                                   [--slow-fetchers 8] [--duration 10] [--baseline <git 提交>]
+"""
+import argparse
+import itertools
+import tempfile
+import threading
+import time
+
+import requests
+
+from fake_kingo import FakeKingo, user_password
+from loadgen import REPO_DIR, export_revision, free_port, percentile, start_api
+
+
+def get(session: requests.Session, base_url: str, username: str, **params) -> requests.Response:
+    params = {"pwd": user_password(username), "school_code": "12623", **params}
+    return session.get(f"{base_url}/{username}.ics", params=params, timeout=300)
+
+
+def poll_cached(base_url: str, users, pollers: int, duration: float):
+    """pollers 个线程轮询已缓存的用户，返回各请求延迟（秒）与失败次数"""
+    latencies, failures = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset: int):
+        with requests.Session() as session:
+            for username in itertools.islice(itertools.cycle(users), offset, None):
+                if time.monotonic() >= deadline:
+                    return
+                started = time.perf_counter()
+                ok = get(session, base_url, username).status_code == 200
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+                    failures[0] += not ok
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(pollers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, failures[0]
+
+
+class SlowFetchers:
+    """后台不断为从未访问过的学号发起冷抓取"""
+
+    def __init__(self, base_url: str, count: int):
+        self.base_url = base_url
+        self.count = count
+        self.ids = itertools.count(2030000000)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.completed = 0
+        self.threads = []
+
+    def _run(self):
+        with requests.Session() as session:
+            while not self.stopped.is_set():
+                with self.lock:
+                    username = str(next(self.ids))
+                get(session, self.base_url, username)
+                with self.lock:
+                    self.completed += 1
+
+    def __enter__(self):
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(self.count)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        return False
+
+
+def report(title: str, latencies, failures: int):
+    print(f"   {title}: {len(latencies)} 次请求，失败 {failures} 次，"
+          f"p50={percentile(latencies, 0.5) * 1000:.1f}ms p99={percentile(latencies, 0.99) * 1000:.1f}ms "
+          f"最大={max(latencies, default=0) * 1000:.1f}ms")
+
+
+def run_variant(name: str, app_dir: str, kingo: FakeKingo, args):
+    users = [str(2020000000 + i) for i in range(args.cached_users)]
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        # 客户端限流调高，避免冷抓取在限流器中排队超时
+        process = start_api(workdir, kingo.base_url, port, client_rate=1000, app_dir=app_dir)
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            kingo.latency = 0.0
+            with requests.Session() as session:
+                for username in users:
+                    get(session, base_url, username).raise_for_status()
+            print(f"== {name}")
+            report("无上游抓取", *poll_cached(base_url, users, args.pollers, args.duration))
+            kingo.latency = args.slow_latency
+            with SlowFetchers(base_url, args.slow_fetchers) as fetchers:
+                latencies, failures = poll_cached(base_url, users, args.pollers, args.duration)
+            report(f"{args.slow_fetchers} 个慢抓取进行中", latencies, failures)
+            print(f"   期间完成冷抓取 {fetchers.completed} 次")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="慢抓取期间缓存用户的延迟压测")
+    parser.add_argument("--cached-users", type=int, default=20)
+    parser.add_argument("--pollers", type=int, default=8, help="轮询缓存用户的线程数")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="慢抓取阶段教务系统每个请求的延迟（秒）")
+    parser.add_argument("--slow-fetchers", type=int, default=8, help="同时进行的冷抓取数")
+    parser.add_argument("--duration", type=float, default=10, help="每个阶段的轮询时长（秒）")
+    parser.add_argument("--baseline", help="对比的 git 提交")
+    args = parser.parse_args()
+
+    kingo = FakeKingo().start()
+    try:
+        if args.baseline:
+            with tempfile.TemporaryDirectory() as app_dir:
+                run_variant(args.baseline, export_revision(args.baseline, app_dir), kingo, args)
+        run_variant("当前", REPO_DIR, kingo, args)
+    finally:
+        kingo.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+课表解析后端的一致性检查与吞吐量基准
+
+用法:
+    python tools/bench_parser.py [school_code] [页面目录]
+
+页面目录下放置保存的 wsxk.xskcb10319.jsp 响应（*.html / *.jsp），逐页比较 bs4 与 stream
+两种后端的输出并统计解析速度。保存的页面包含学生个人信息，请勿提交到仓库；
+不指定目录时使用随机生成的课表页面。
+"""
+import glob
+import importlib.util
+import os
+import random
+import sys
+import time
+
+COURSE_DIV = '<div style="padding-bottom:5px;clear:both;">'
+WEEKDAYS = ["星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日"]
+
+
+def load_school_module(school_code: str):
+    path = os.path.join(os.path.dirname(__file__), '..', 'schools', school_code, 'main.py')
+    spec = importlib.util.spec_from_file_location(f"school_{school_code}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synth_course(rng: random.Random) -> str:
+    title = rng.choice(["高等数学", "大学英语&nbsp;II", "数据结构", "线性代数", "体育<br>（篮球）", "C&amp;C++ 程序设计"])
+    start = rng.randint(1, 8)
+    weeks = f"{start}-{start + rng.randint(4, 10)}{rng.choice(['', '单', '双'])}"
+    periods = rng.choice(["1-2", "3-4", "5-6", "7-8", "9-10", "1-4"])
+    parts = [
+        f'<font style="font-weight: bolder">{title}</font>',
+        f'教师:{rng.choice(["张三", "李四", "王五 ", ""])}',
+        f'{weeks}[{periods}]',
+        rng.choice(["A101", "B-203", "实验楼&#32;305", "", "操场|东区"]),
+    ]
+    if rng.random() < 0.2:
+        parts.insert(2, "<!-- 调课 -->")
+    return COURSE_DIV + "<br>".join(parts) + "</div>"
+
+
+def synth_page(rng: random.Random, rows: int = 6) -> str:
+    """生成结构与教务系统课表页相近的页面"""
+    html = ['<html><head><script>var a = "<td class=\'td\'>";</script></head><body>',
+            '<div class="toolbar"><table id="other"><tr><td class="td">无关</td></tr></table>']
+    html.append('<table id="mytable" width="100%"><tr><td>节次</td>' +
+                "".join(f"<td>{day}</td>" for day in WEEKDAYS) + "</tr>")
+    for row in range(rows):
+        html.append(f'<tr><td class="td1" align="center">第{row * 2 + 1}-{row * 2 + 2}节</td>')
+        for _ in range(7):
+            cell = "".join(synth_course(rng) for _ in range(rng.choice([0, 0, 1, 1, 2])))
+            if rng.random() < 0.05:
+                cell += '<div style="color:red">备注</div>'
+            html.append(f'<td class="td" valign="top">{cell}</td>')
+        html.append("</tr>")
+    html.append('<tr><td colspan="8">备注：无</td></tr></table>')
+    html.append('<table><tr><td class="td1">页脚</td><td class="td">' + synth_course(rng) + '</td></tr></table>')
+    html.append('</div></body></html>')
+    return "\n".join(html)
+
+
+def main():
+    school_code = sys.argv[1] if len(sys.argv) > 1 else "12623"
+    module = load_school_module(school_code)
+    if len(sys.argv) > 2:
+        paths = sorted(glob.glob(os.path.join(sys.argv[2], '*.html')) + glob.glob(os.path.join(sys.argv[2], '*.jsp')))
+        pages = [open(p, 'r', encoding='utf-8').read() for p in paths]
+    else:
+        rng = random.Random(0)
+        pages = [synth_page(rng) for _ in range(200)]
+
+    mismatches = 0
+    for i, page in enumerate(pages):
+        if module.Table2Json.parse_course_schedule(page, 'bs4') != module.Table2Json.parse_course_schedule(page, 'stream'):
+            mismatches += 1
+            print(f"第 {i} 页解析结果不一致")
+    print(f"{len(pages)} 页，不一致 {mismatches} 页")
+
+    total_bytes = sum(len(page.encode('utf-8')) for page in pages)
+    for parser in ('bs4', 'stream'):
+        started = time.perf_counter()
+        for page in pages:
+            module.Table2Json.parse_course_schedule(page, parser)
+        elapsed = time.perf_counter() - started
+        print(f"{parser:>6}: {len(pages) / elapsed:8.1f} 页/s  {total_bytes / elapsed / 1e6:6.2f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+日历生成（ICSBuilder）的微基准
+
+用 bench_parser.synth_page 生成若干学期的课表页面并解析，组合成大量多学期用户（同一批教学周、
+节次字符串在用户之间大量重复，与真实情况相近），逐个用户调用 build_ics 生成事件并导出，报告每个用户的耗时，
+并用 tracemalloc 对前 --memory-users 个用户测量生成后 ICSBuilder 占用的内存与导出时的峰值内存。
+
+--baseline 指定一个 git 提交时，同时加载该提交中的 xqe.py 跑同样的用户，便于对比优化前后；
+两者的导出结果会逐个比较，不一致时报告。
+
+用法:
+    python tools/bench_render.py [--users 10000] [--rrule] [--no-export] [--memory-users 200]
+                                 [--baseline <git 提交>]
+"""
+import argparse
+import importlib.util
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from bench_parser import load_school_module, synth_page
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_DIR)
+
+DTSTAMP = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def load_xqe(revision: str = None):
+    """加载当前的 xqe，或指定 git 提交中的 xqe.py（依赖的其他模块仍取自当前目录）"""
+    if revision is None:
+        import xqe
+        return xqe
+    source = subprocess.run(["git", "-C", REPO_DIR, "show", f"{revision}:xqe.py"],
+                            check=True, capture_output=True).stdout
+    path = os.path.join(tempfile.mkdtemp(), "xqe_baseline.py")
+    with open(path, "wb") as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location("xqe_baseline", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_semester_pool(school_code: str, pages_per_semester: int, rng: random.Random):
+    """每个学期若干份解析好的课程列表，课程已带上 _schoolYear / _term / _first_monday"""
+    school = load_school_module(school_code)
+    pool = {}
+    for sem_key in list(school.SchoolCalendar.load_calendar())[:8]:
+        year, term = sem_key.split('-')
+        first_monday = school.SchoolCalendar.get_first_monday(year, term)
+        pool[sem_key] = []
+        for _ in range(pages_per_semester):
+            courses = school.Table2Json.parse_course_schedule(synth_page(rng), 'stream')
+            for course in courses:
+                course.update(_schoolYear=year, _term=term, _first_monday=first_monday)
+            pool[sem_key].append(courses)
+    return school.load_timetable_config(), pool
+
+
+def iter_users(count: int, timetable, pool, seed: int = 1):
+    rng = random.Random(seed)
+    for _ in range(count):
+        courses = []
+        for pages in pool.values():
+            courses.extend(rng.choice(pages))
+        yield {"timetable": timetable, "courses": courses}
+
+
+def run(xqe, users, school_code: str, rrule: bool, export: bool):
+    build_seconds = export_seconds = 0.0
+    events = 0
+    outputs = []
+    for school_data in users:
+        started = time.perf_counter()
+        builder = xqe.build_ics(school_data, "30", school_code, rrule, DTSTAMP)
+        built = time.perf_counter()
+        events += builder.event_count() if hasattr(builder, "event_count") else len(builder._events)
+        if export:
+            outputs.append(hash(builder.export()))
+        build_seconds += built - started
+        export_seconds += time.perf_counter() - built
+    return build_seconds, export_seconds, events, outputs
+
+
+def measure_memory(xqe, users, school_code: str, rrule: bool):
+    """返回平均每个日历的 (生成后保留的字节数, 导出期间的额外峰值字节数)"""
+    retained = peak = count = 0
+    tracemalloc.start()
+    try:
+        for school_data in users:
+            before = tracemalloc.get_traced_memory()[0]
+            builder = xqe.build_ics(school_data, "30", school_code, rrule, DTSTAMP)
+            built = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            builder.export()
+            retained += built - before
+            peak += tracemalloc.get_traced_memory()[1] - built
+            count += 1
+            del builder
+    finally:
+        tracemalloc.stop()
+    return retained / count, peak / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日历生成微基准")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--school", default="12623")
+    parser.add_argument("--pages", type=int, default=20, help="每个学期生成的不同课表页面数")
+    parser.add_argument("--rrule", action="store_true", help="使用 RRULE 合并每周重复的课程")
+    parser.add_argument("--no-export", action="store_true", help="只生成事件，不导出 ICS 文本")
+    parser.add_argument("--memory-users", type=int, default=200, help="测量内存的用户数，0 为不测量")
+    parser.add_argument("--baseline", help="对比的 git 提交")
+    args = parser.parse_args()
+
+    os.chdir(REPO_DIR)
+    timetable, pool = build_semester_pool(args.school, args.pages, random.Random(0))
+    variants = [("当前", load_xqe())]
+    if args.baseline:
+        variants.insert(0, (args.baseline, load_xqe(args.baseline)))
+
+    results = {}
+    for name, xqe in variants:
+        users = iter_users(args.users, timetable, pool)
+        build_seconds, export_seconds, events, outputs = run(xqe, users, args.school, args.rrule, not args.no_export)
+        results[name] = outputs
+        print(f"{name}: {args.users} 个用户，平均 {events / args.users:.0f} 个事件，"
+              f"生成事件 {build_seconds / args.users * 1000:.2f} ms/用户"
+              + ("" if args.no_export else f"，导出 {export_seconds / args.users * 1000:.2f} ms/用户"))
+        if args.memory_users:
+            # 计时之后再测，解析缓存已经预热，不计入单个日历
+            users = iter_users(args.memory_users, timetable, pool)
+            retained, peak = measure_memory(xqe, users, args.school, args.rrule)
+            print(f"{name}: 每个日历生成后占用 {retained / 1024:.0f} KiB，导出时额外峰值 {peak / 1024:.0f} KiB")
+    if args.baseline and not args.no_export:
+        baseline, current = results[args.baseline], results["当前"]
+        mismatches = sum(1 for a, b in zip(baseline, current) if a != b)
+        print(f"导出结果不一致的用户：{mismatches}")
+
+
+if __name__ == "__main__":
+    main()
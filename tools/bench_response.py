@@ -0,0 +1,121 @@
+"""
+缓存命中请求的吞吐量与服务进程 IO
+
+预热 --users 个用户后，--concurrency 个线程持续请求已缓存的日历（默认不带条件请求头，每次都返回完整的 ICS；
+--conditional 时带上 If-None-Match，每次都是 304），报告 req/s、p50/p99 延迟，
+以及服务进程在压测期间的 /proc/<pid>/io 增量折算到每个请求：
+读写系统调用次数（syscr/syscw）、读写字节数（rchar/wchar）与实际落盘字节数（write_bytes）。
+
+--baseline 指定 git 提交时，用该提交根目录下的 .py 文件启动同样的服务对比，例如
+先写临时文件再用 FileResponse 返回的版本，或每次命中都立即写入访问时间的版本
+（配合 --conditional 与 --storage file/sqlite）。访问时间按 access_flush_interval 批量写入，
+压测时长短于该间隔时不包含批量写入的开销。需要 Linux 的 /proc。
+
+用法:
+    python tools/bench_response.py [--users 50] [--concurrency 16] [--duration 10] [--conditional]
+                                   [--storage sqlite] [--baseline <git 提交>]
+"""
+import argparse
+import tempfile
+import threading
+import time
+
+import requests
+
+from fake_kingo import FakeKingo, user_password
+from loadgen import REPO_DIR, export_revision, free_port, percentile, start_api
+
+IO_FIELDS = ("syscr", "syscw", "rchar", "wchar", "write_bytes")
+
+
+def read_proc_io(pid: int):
+    with open(f"/proc/{pid}/io") as f:
+        values = dict(line.split(": ") for line in f.read().splitlines())
+    return {name: int(values[name]) for name in IO_FIELDS}
+
+
+def hammer(base_url: str, users, concurrency: int, duration: float, etags=None):
+    """etags 为学号到 ETag 的映射时发送条件请求，期望 304"""
+    latencies, failures = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset: int):
+        with requests.Session() as session:
+            i = offset
+            while time.monotonic() < deadline:
+                username = users[i % len(users)]
+                i += 1
+                headers = {"If-None-Match": etags[username]} if etags else {}
+                started = time.perf_counter()
+                response = session.get(f"{base_url}/{username}.ics", headers=headers, timeout=60,
+                                       params={"pwd": user_password(username), "school_code": "12623"})
+                if etags:
+                    ok = response.status_code == 304
+                else:
+                    ok = response.status_code == 200 and response.text.endswith("END:VCALENDAR")
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+                    failures[0] += not ok
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, failures[0]
+
+
+def run_variant(name: str, app_dir: str, kingo: FakeKingo, args):
+    users = [str(2060000000 + i) for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        process = start_api(workdir, kingo.base_url, port, client_rate=1000, app_dir=app_dir,
+                            extra_env={"storage_backend": args.storage})
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            etags = {}
+            with requests.Session() as session:
+                for username in users:
+                    response = session.get(f"{base_url}/{username}.ics", timeout=60,
+                                           params={"pwd": user_password(username), "school_code": "12623"})
+                    response.raise_for_status()
+                    etags[username] = response.headers.get("ETag")
+            # 再预热一轮，让各用户的日历进入渲染缓存
+            hammer(base_url, users, 1, 1)
+            before = read_proc_io(process.pid)
+            latencies, failures = hammer(base_url, users, args.concurrency, args.duration,
+                                         etags if args.conditional else None)
+            after = read_proc_io(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+    count = max(1, len(latencies))
+    per_request = "，".join(f"{field} {(after[field] - before[field]) / count:.1f}" for field in IO_FIELDS)
+    print(f"{name}: {len(latencies) / args.duration:.0f} req/s，失败 {failures} 次，"
+          f"p50={percentile(latencies, 0.5) * 1000:.1f}ms p99={percentile(latencies, 0.99) * 1000:.1f}ms")
+    print(f"   每个请求的服务进程 IO：{per_request}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="缓存命中请求的吞吐量与服务进程 IO")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--conditional", action="store_true", help="发送 If-None-Match，测量 304 命中")
+    parser.add_argument("--storage", default="sqlite", choices=["sqlite", "file"], help="服务使用的存储后端")
+    parser.add_argument("--baseline", help="对比的 git 提交")
+    args = parser.parse_args()
+
+    kingo = FakeKingo().start()
+    try:
+        if args.baseline:
+            with tempfile.TemporaryDirectory() as app_dir:
+                run_variant(args.baseline, export_revision(args.baseline, app_dir), kingo, args)
+        run_variant("当前", REPO_DIR, kingo, args)
+    finally:
+        kingo.stop()
+
+
+if __name__ == "__main__":
+    main()
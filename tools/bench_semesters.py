@@ -0,0 +1,39 @@
+"""
+全学期冷抓取耗时基准：对本地模拟教务系统注入延迟，比较不同 semesterConcurrency 下的耗时
+
+用法:
+    python tools/bench_semesters.py [latency] [school_code]
+"""
+import sys
+import time
+
+from bench_parser import load_school_module
+from fake_kingo import FakeKingo, user_password
+
+
+def main():
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    school_code = sys.argv[2] if len(sys.argv) > 2 else "12623"
+    module = load_school_module(school_code)
+    kingo = FakeKingo(latency=latency).start()
+    config = module.load_config()
+    config['rootUrl'] = kingo.base_url
+    rate_limit = config.get('rateLimit')
+    limit = f"限流 {rate_limit.get('rate', 5)}/s 突发 {rate_limit.get('burst', 10)}" if rate_limit else "不限流"
+    print(f"注入延迟 {latency * 1000:.0f}ms，{limit}")
+
+    for concurrency in (1, 2, 4, 8):
+        config['semesterConcurrency'] = concurrency
+        # 每轮都从登录开始，限流器也重新填满
+        module._SESSION_STORE.clear()
+        module._HOST_GUARDS.clear()
+        kingo.counts.clear()
+        started = time.perf_counter()
+        module.main("2020001", user_password("2020001"), all_semesters=True)
+        elapsed = time.perf_counter() - started
+        print(f"semesterConcurrency={concurrency}: {elapsed * 1000:7.1f}ms  上游请求 {sum(kingo.counts.values())} 次")
+    kingo.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+存储后端（sqlite / file）的读写基准
+
+用 bench_render 的随机课表为 --users 个用户（默认 1 万）生成多学期缓存，对每个后端依次测量：
+- 写入：每个用户一次 save_user（user_info 与课表缓存一起写入，与抓取成功时相同）；
+- 读取：随机顺序读取 user_info（缓存命中路径）以及 user_info + 课表缓存（渲染缓存未命中时）；
+- 访问时间：update_access_times 批量写入全部用户的 last_access_time；
+报告每秒操作数与占用的磁盘空间。数据写在临时目录中。
+
+用法:
+    python tools/bench_storage.py [--users 10000] [--reads 20000] [--backend sqlite --backend file]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from bench_render import REPO_DIR, build_semester_pool, iter_users
+
+sys.path.insert(0, REPO_DIR)
+import storage  # noqa: E402
+
+
+def disk_usage(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def run_backend(backend: str, users, reads: int):
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "xqe.db") if backend == "sqlite" else os.path.join(workdir, "user")
+        store = storage.create_store(backend, path)
+        # file 后端批量更新访问时间时使用用户锁，锁文件同样放在临时目录中
+        storage.LOCK_DIR = os.path.join(workdir, "locks")
+        now = datetime.now().isoformat()
+
+        started = time.perf_counter()
+        for i, school_data in enumerate(users):
+            info = {"last_fetch_time": now, "last_access_time": now, "data_hash": f"{i:064x}"}
+            store.save_user("12623", str(2070000000 + i), info, school_data)
+        write_seconds = time.perf_counter() - started
+        count = len(users)
+
+        rng = random.Random(0)
+        keys = [("12623", str(2070000000 + rng.randrange(count))) for _ in range(reads)]
+        started = time.perf_counter()
+        for school_code, username in keys:
+            store.load_user_info(school_code, username)
+        info_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        for school_code, username in keys:
+            store.load_user_info(school_code, username)
+            store.load_cache(school_code, username)
+        cache_seconds = time.perf_counter() - started
+
+        access = {("12623", str(2070000000 + i)): now for i in range(count)}
+        started = time.perf_counter()
+        store.update_access_times(access)
+        access_seconds = time.perf_counter() - started
+
+        print(f"{backend}: {count} 个用户占用 {disk_usage(workdir) / 1024 / 1024:.1f} MiB")
+        print(f"   写入 save_user {count / write_seconds:.0f} 次/秒，"
+              f"读取 user_info {reads / info_seconds:.0f} 次/秒，user_info + 缓存 {reads / cache_seconds:.0f} 次/秒，"
+              f"批量更新访问时间 {count / access_seconds:.0f} 个/秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="存储后端读写基准")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--reads", type=int, default=20000, help="随机读取次数")
+    parser.add_argument("--backend", action="append", choices=["sqlite", "file"], help="默认两个后端都测")
+    args = parser.parse_args()
+
+    os.chdir(REPO_DIR)
+    timetable, pool = build_semester_pool("12623", 20, random.Random(0))
+    users = list(iter_users(args.users, timetable, pool))
+    for backend in args.backend or ["sqlite", "file"]:
+        run_backend(backend, users, args.reads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+纯 Python DES（str_enc / str_dec）与 jkingo.des.js 的一致性检查及速度对比
+
+tools/des_vectors.json 保存一批由 jkingo.des.js（execjs + Node.js）生成的测试向量：
+登录参数形式的明文、随机的 ASCII / 中文 / 代理对字符、长度不是 4 的倍数的明文，以及 1~3 个密钥。
+检查时逐个比较 Python 实现的加密结果与 JS 的结果，并确认 str_dec 与 JS 的 strDec 解出相同的明文；
+这一步不需要 Node.js。
+
+--regenerate 用 JS 重新生成向量（需要 PyExecJS 与 Node.js）。安装了 execjs 时，
+同时对比每次加密一个登录参数的耗时：Python 实现、KingoDES("js")（即 "desBackend": "js"）。
+
+用法:
+    python tools/check_des.py [--school 12623] [--regenerate] [--count 100] [--iterations 2000]
+"""
+import argparse
+import json
+import os
+import random
+import string
+import time
+
+from bench_parser import load_school_module
+
+VECTORS_PATH = os.path.join(os.path.dirname(__file__), 'des_vectors.json')
+
+# 一次调用完成全部向量，避免 execjs 为每个向量启动一次 Node.js
+BATCH_JS = """
+function batch(items) {
+    return items.map(function (item) {
+        var enc = strEnc(item.data, item.keys[0], item.keys[1], item.keys[2]);
+        return {enc: enc, dec: strDec(enc, item.keys[0], item.keys[1], item.keys[2])};
+    });
+}
+"""
+
+
+def login_params(rng: random.Random) -> str:
+    """与 XqeClient.login 中 params_v1 结构相同的明文"""
+    username = "".join(rng.choices(string.digits, k=10))
+    session_id = "".join(rng.choices("0123456789ABCDEF", k=32))
+    password = "".join(rng.choices("0123456789abcdef", k=32))
+    return (f"_u={username};;{session_id}&_p={password}&randnumber=&isPasswordPolicy=1&"
+            "txt_mm_expression=14&txt_mm_length=15&txt_mm_userzh=0&hid_flag=1&hidlag=1&hid_dxyzm=")
+
+
+def random_text(rng: random.Random) -> str:
+    alphabet = string.ascii_letters + string.digits + "=&;_-+/ " + "课表喜鹊儿登录" + "\U0001F600"
+    return "".join(rng.choices(alphabet, k=rng.randint(1, 60)))
+
+
+def random_key(rng: random.Random) -> str:
+    # 教务系统下发的 deskey 为十几位数字字母，这里也覆盖短密钥、长密钥与中文密钥
+    return "".join(rng.choices(string.ascii_letters + string.digits + "密钥", k=rng.choice([1, 3, 4, 8, 13, 16, 21])))
+
+
+def generate_inputs(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        data = login_params(rng) if i % 2 == 0 else random_text(rng)
+        keys = [random_key(rng)] + [random_key(rng) if rng.random() < 0.3 else None for _ in range(2)]
+        items.append({"data": data, "keys": keys})
+    return items
+
+
+def regenerate(school, count: int):
+    import execjs
+    with open(os.path.join(os.path.dirname(school.__file__), 'jkingo.des.js'), encoding='utf-8') as f:
+        ctx = execjs.compile(f.read() + BATCH_JS)
+    items = generate_inputs(count)
+    for item, result in zip(items, ctx.call("batch", items)):
+        item.update(result)
+    with open(VECTORS_PATH, 'w', encoding='utf-8') as f:
+        json.dump({"runtime": execjs.get().name, "vectors": items}, f, ensure_ascii=False, indent=1)
+    print(f"已用 jkingo.des.js 生成 {len(items)} 个向量: {VECTORS_PATH}")
+
+
+def check(school) -> int:
+    with open(VECTORS_PATH, encoding='utf-8') as f:
+        vectors = json.load(f)["vectors"]
+    mismatches = 0
+    for item in vectors:
+        enc = school.str_enc(item["data"], *item["keys"])
+        dec = school.str_dec(item["enc"], *item["keys"])
+        if enc != item["enc"] or dec != item["dec"]:
+            mismatches += 1
+            print(f"不一致: data={item['data']!r} keys={item['keys']!r}")
+    print(f"{len(vectors)} 个向量，加密/解密与 jkingo.des.js 不一致 {mismatches} 个")
+    return mismatches
+
+
+def bench(school, iterations: int):
+    rng = random.Random(1)
+    data, key = login_params(rng), random_key(rng)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        school.str_enc(data, key)
+    python_seconds = (time.perf_counter() - started) / iterations
+    print(f"Python str_enc: {python_seconds * 1e6:.0f} µs/次（{len(data)} 个字符的登录参数）")
+    try:
+        des = school.KingoDES('js')
+    except ImportError:
+        print("未安装 execjs，跳过 JS 后端对比")
+        return
+    js_iterations = max(1, iterations // 100)
+    started = time.perf_counter()
+    for _ in range(js_iterations):
+        des.encrypt(data, key)
+    js_seconds = (time.perf_counter() - started) / js_iterations
+    print(f"KingoDES('js').encrypt: {js_seconds * 1e6:.0f} µs/次（{js_iterations} 次），"
+          f"为 Python 的 {js_seconds / python_seconds:.0f} 倍")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DES 实现与 jkingo.des.js 的一致性检查")
+    parser.add_argument("--school", default="12623")
+    parser.add_argument("--regenerate", action="store_true", help="用 jkingo.des.js 重新生成测试向量")
+    parser.add_argument("--count", type=int, default=100, help="重新生成时的向量数")
+    parser.add_argument("--iterations", type=int, default=2000, help="速度对比中 Python 实现的加密次数")
+    args = parser.parse_args()
+
+    school = load_school_module(args.school)
+    if args.regenerate:
+        regenerate(school, args.count)
+    mismatches = check(school)
+    bench(school, args.iterations)
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+RRULE 导出与逐周导出的等价性检查
+
+用 bench_render 的随机课表组合出多学期用户（部分课程的教学周改为 "1-4,6-9"、"2,5,11" 这类不连续的写法，
+覆盖 EXDATE），分别以逐周（每次上课一个 VEVENT）和 RRULE 两种方式导出，
+把 RRULE 事件按 FREQ=WEEKLY;INTERVAL;COUNT 展开并去掉 EXDATE，比较两边得到的上课集合
+（标题、描述、地点、开始与结束时间）是否完全一致，同时报告两种方式的 VEVENT 数、ICS 大小与生成耗时。
+
+用法:
+    python tools/check_rrule.py [--users 500] [--school 12623]
+"""
+import argparse
+import os
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bench_render import DTSTAMP, REPO_DIR, build_semester_pool, iter_users, load_xqe
+
+OCCURRENCE_FIELDS = ("SUMMARY", "DESCRIPTION", "LOCATION")
+IRREGULAR_WEEKS = ["1-4,6-9", "2,5,11", "1-3,5-8,10-16", "3,5,7,13", "1-15单,16", "2-6双,9-10"]
+
+
+def with_irregular_weeks(users, rng: random.Random, ratio: float = 0.3):
+    """把每个用户约 ratio 比例课程的教学周换成不连续的写法（复制课程，不修改共享的课表池）"""
+    for school_data in users:
+        courses = [dict(course, teaching_weeks=rng.choice(IRREGULAR_WEEKS)) if rng.random() < ratio else course
+                   for course in school_data["courses"]]
+        yield {**school_data, "courses": courses}
+
+
+def parse_events(ics: str):
+    """返回各 VEVENT 的属性字典（属性名去掉参数部分）"""
+    events, current = [], None
+    for line in ics.split('\n'):
+        if line == "BEGIN:VEVENT":
+            current = {}
+        elif line == "END:VEVENT":
+            events.append(current)
+            current = None
+        elif current is not None and ':' in line:
+            name, _, value = line.partition(':')
+            current.setdefault(name.split(';')[0], value)
+    return events
+
+
+def _parse_time(value: str) -> datetime:
+    return datetime.strptime(value, "%Y%m%dT%H%M%S") if 'T' in value else datetime.strptime(value, "%Y%m%d")
+
+
+def expand(event):
+    """把一个 VEVENT 展开为各次上课的 (标题, 描述, 地点, 开始, 结束)，只支持导出中用到的 RRULE 子集"""
+    start, end = _parse_time(event["DTSTART"]), _parse_time(event["DTEND"])
+    fields = tuple(event.get(name, "") for name in OCCURRENCE_FIELDS)
+    rule = dict(part.split('=') for part in event["RRULE"].split(';')) if "RRULE" in event else {}
+    if rule:
+        assert rule["FREQ"] == "WEEKLY", rule
+        step = timedelta(weeks=int(rule.get("INTERVAL", 1)))
+        starts = [start + step * i for i in range(int(rule["COUNT"]))]
+    else:
+        starts = [start]
+    excluded = {_parse_time(value) for value in event.get("EXDATE", "").split(',') if value}
+    return [fields + (s, s + (end - start)) for s in starts if s not in excluded]
+
+
+def occurrences(ics: str) -> Counter:
+    return Counter(occurrence for event in parse_events(ics) for occurrence in expand(event))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RRULE 导出与逐周导出的等价性检查")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--school", default="12623")
+    parser.add_argument("--pages", type=int, default=20, help="每个学期生成的不同课表页面数")
+    args = parser.parse_args()
+
+    os.chdir(REPO_DIR)
+    xqe = load_xqe()
+    timetable, pool = build_semester_pool(args.school, args.pages, random.Random(0))
+    totals = {False: Counter(), True: Counter()}
+    mismatches = 0
+    for school_data in with_irregular_weeks(iter_users(args.users, timetable, pool), random.Random(1)):
+        exports = {}
+        for rrule in (False, True):
+            started = time.perf_counter()
+            ics = xqe.build_ics(school_data, "30", args.school, rrule, DTSTAMP).export()
+            totals[rrule]["seconds"] += time.perf_counter() - started
+            totals[rrule]["bytes"] += len(ics.encode('utf-8'))
+            totals[rrule]["events"] += ics.count("BEGIN:VEVENT")
+            exports[rrule] = ics
+        weekly, expanded = occurrences(exports[False]), occurrences(exports[True])
+        totals[False]["occurrences"] += sum(weekly.values())
+        totals[True]["exdates"] += exports[True].count("EXDATE")
+        if weekly != expanded:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"不一致：仅逐周 {sorted(weekly - expanded)[:3]}，仅 RRULE {sorted(expanded - weekly)[:3]}")
+
+    print(f"{args.users} 个用户，共 {totals[False]['occurrences']} 次上课（RRULE 中带 EXDATE 的事件 "
+          f"{totals[True]['exdates']} 个），展开后不一致的用户：{mismatches}")
+    for rrule, name in ((False, "逐周"), (True, "RRULE")):
+        total = totals[rrule]
+        print(f"{name}: 平均每个日历 {total['events'] / args.users:.0f} 个 VEVENT，"
+              f"{total['bytes'] / args.users / 1024:.1f} KiB，生成并导出 {total['seconds'] / args.users * 1000:.2f} ms")
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+本地模拟的喜鹊儿教务系统，用于基准测试与压测
+
+实现的接口：
+- /cas/login.action、getTempDeskey、getTempNowtime、/cas/logon.action（用学校模块的 str_dec 解密并校验登录参数）
+- /student/wsxk.xskcb10319.jsp：课表页面，由 bench_parser.synth_page 按学号与学期生成
+- /frame/droplist/getDropLists.action、/public/SchoolCalendar.show.jsp：maintain.py 使用的校历接口
+- /frame/errors/：超过限流或随机注入错误时重定向到这里，与真实教务系统的行为一致
+
+任何学号都可以登录，正确的密码为学号的 MD5（即订阅链接中的 pwd=md5(md5(学号))）。
+配合环境变量 kingo_root_url 可让服务直接连接到模拟服务器。
+
+用法:
+    python tools/fake_kingo.py [--port 8801] [--latency 0.05] [--error-rate 0.01] [--rate-limit 20]
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+from bench_parser import load_school_module, synth_page
+
+
+def md5(text: str) -> str:
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def user_password(username: str) -> str:
+    """模拟教务系统中学号对应的密码（订阅链接中的 32 位 MD5）"""
+    return md5(username)
+
+
+class FakeKingo:
+    """
+    在后台线程运行的模拟教务系统
+
+    latency: 每个请求的注入延迟（秒）
+    error_rate: 随机重定向到 /frame/errors/ 的请求比例
+    rate_limit: 每秒允许的请求数，超过时重定向到 /frame/errors/（0 表示不限）
+    counts 按接口统计请求次数，connections 为已接受的 TCP 连接数
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 error_rate: float = 0.0, rate_limit: float = 0.0, school_code: str = "12623"):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.school = load_school_module(school_code)
+        self.calendar = self.school.SchoolCalendar.load_calendar()
+        self.counts = Counter()
+        self.connections = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._updated = time.monotonic()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeKingo':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _rate_limited(self) -> bool:
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._updated) * self.rate_limit)
+            self._updated = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    def verify_logon(self, session: str, body: str) -> dict:
+        """按客户端的加密方式还原登录参数并逐项校验"""
+        state = self._sessions.get(session)
+        if state is None:
+            return {"status": "401", "message": "会话无效"}
+        fields = dict(item.partition('=')[::2] for item in body.split('&'))
+        if fields.get('deskey') != state.get('deskey') or fields.get('ssessionid') != session:
+            return {"status": "401", "message": "动态参数不匹配"}
+        encrypted_hex = base64.b64decode(fields.get('params', '')).decode('utf-8')
+        params_v1 = self.school.str_dec(encrypted_hex, state['deskey'])
+        if fields.get('token') != md5(md5(params_v1) + md5(fields.get('timestamp', ''))):
+            return {"status": "401", "message": "token 校验失败"}
+        params = dict(item.partition('=')[::2] for item in params_v1.split('&'))
+        username, _, params_session = base64.b64decode(params.get('_u', '')).decode('utf-8').partition(';;')
+        if params_session != session:
+            return {"status": "401", "message": "会话不匹配"}
+        if params.get('_p') != md5(user_password(username) + md5("")):
+            return {"status": "401", "message": "密码错误"}
+        state['user'] = username
+        return {"status": "200", "message": "登录成功"}
+
+    def _make_handler(self):
+        kingo = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with kingo._lock:
+                    kingo.connections += 1
+
+            def _session(self):
+                for part in self.headers.get("Cookie", "").split(";"):
+                    name, _, value = part.strip().partition("=")
+                    if name == "JSESSIONID":
+                        return value
+                return None
+
+            def _send(self, status: int, body: str = "", content_type: str = "text/html;charset=UTF-8", headers=None):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_json(self, data):
+                self._send(200, json.dumps(data, ensure_ascii=False), "application/json;charset=UTF-8")
+
+            def _redirect_error(self, message: str):
+                with kingo._lock:
+                    kingo.counts["errors"] += 1
+                self._send(302, headers={"Location": f"/frame/errors/error.jsp?errormsg={quote(message)}"})
+
+            def _handle(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8") if length else ""
+                endpoint = query["method"][0] if "method" in query else url.path.rsplit("/", 1)[-1]
+
+                if url.path.startswith("/frame/errors/"):
+                    self._send(200, f"<html><body>{query.get('errormsg', [''])[0]}</body></html>")
+                    return
+                with kingo._lock:
+                    kingo.counts[endpoint] += 1
+                if kingo.latency:
+                    time.sleep(kingo.latency)
+                if kingo._rate_limited():
+                    self._redirect_error("访问过于频繁，请稍后再试")
+                    return
+                if kingo.error_rate and random.random() < kingo.error_rate:
+                    self._redirect_error("系统繁忙")
+                    return
+
+                session = self._session()
+                if url.path == "/cas/login.action":
+                    session = secrets.token_hex(16).upper()
+                    with kingo._lock:
+                        kingo._sessions[session] = {}
+                    self._send(200, f'<script>var _sessionid = "{session}";</script>',
+                               headers={"Set-Cookie": f"JSESSIONID={session}; Path=/"})
+                elif endpoint in ("getTempDeskey", "getTempNowtime"):
+                    with kingo._lock:
+                        state = kingo._sessions.get(session)
+                        if state is None:
+                            value = ""
+                        elif endpoint == "getTempDeskey":
+                            value = state["deskey"] = str(random.randint(10 ** 7, 10 ** 8 - 1))
+                        else:
+                            value = time.strftime("%Y-%m-%d %H:%M:%S")
+                    self._send(200, value)
+                elif url.path == "/cas/logon.action":
+                    with kingo._lock:
+                        result = kingo.verify_logon(session, body)
+                    self._send_json(result)
+                elif url.path == "/student/wsxk.xskcb10319.jsp":
+                    with kingo._lock:
+                        user = kingo._sessions.get(session, {}).get("user")
+                    if not user:
+                        self._send(302, headers={"Location": "/cas/login.action"})
+                        return
+                    params = base64.b64decode(query.get("params", [""])[0]).decode("utf-8")
+                    fields = dict(item.partition("=")[::2] for item in params.split("&"))
+                    rng = random.Random(f"{fields.get('xh')}-{fields.get('xn')}-{fields.get('xq')}")
+                    self._send(200, synth_page(rng))
+                elif url.path == "/frame/droplist/getDropLists.action":
+                    self._send_json([{"code": code, "name": code} for code in kingo.calendar])
+                elif url.path == "/public/SchoolCalendar.show.jsp":
+                    form = parse_qs(body)
+                    term = kingo.calendar.get(f"{form.get('xn', [''])[0]}-{form.get('xq_m', [''])[0]}", {})
+                    remark = "".join(
+                        f"{label}：{term[key]}\n" for label, key in (
+                            ("学期开始日期", "termStartDate"), ("学期结束日期", "termEndDate"),
+                            ("假期开始日期", "termVacationStartDate"), ("假期结束日期", "termVacationEndDate"),
+                        ) if key in term
+                    )
+                    self._send(200, f'<html><body><textarea id="bz">{remark}</textarea></body></html>')
+                elif url.path in ("", "/"):
+                    self._send(200, "<html><body>喜鹊儿</body></html>")
+                else:
+                    self._send(404, "not found")
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的喜鹊儿教务系统")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8801)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的注入延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机重定向到错误页的比例")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="每秒允许的请求数，0 表示不限")
+    parser.add_argument("--school", default="12623", help="提供校历数据的学校代码")
+    args = parser.parse_args()
+    kingo = FakeKingo(args.host, args.port, args.latency, args.error_rate, args.rate_limit, args.school)
+    print(f"模拟教务系统运行于 {kingo.base_url}，可设置 kingo_root_url={kingo.base_url}")
+    try:
+        kingo.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
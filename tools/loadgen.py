@@ -0,0 +1,211 @@
+"""
+端到端压测：启动本地模拟教务系统与 uvicorn 运行的 api:app，按设定的请求组合持续轮询订阅链接
+
+报告吞吐量、p50/p90/p99 延迟、状态码分布以及对教务系统的请求次数。
+服务在临时目录中运行（schools 复制自仓库），不会改动仓库内的 user 数据。
+客户端限流沿用 config.json 的 rateLimit（未设置时按默认的每秒 5 个请求）；
+--client-rate 在临时副本中设置限流速率，用于测量限流对冷抓取的影响。
+
+用法:
+    python tools/loadgen.py [--users 50] [--duration 20] [--concurrency 32] [--client-rate 100]
+                            [--conditional 0.6] [--force 0.01] [--bad-password 0.02]
+                            [--latency 0.05] [--error-rate 0] [--rate-limit 0]
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from fake_kingo import FakeKingo, user_password
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def export_revision(revision: str, dest_dir: str) -> str:
+    """把指定 git 提交中根目录下的 .py 文件（api.py、xqe.py 等）写到 dest_dir，用于启动旧版本的服务做对比"""
+    os.makedirs(dest_dir, exist_ok=True)
+    names = subprocess.run(["git", "-C", REPO_DIR, "ls-tree", "--name-only", revision],
+                           check=True, capture_output=True, text=True).stdout.split()
+    for name in names:
+        if not name.endswith(".py"):
+            continue
+        source = subprocess.run(["git", "-C", REPO_DIR, "show", f"{revision}:{name}"],
+                                check=True, capture_output=True).stdout
+        with open(os.path.join(dest_dir, name), "wb") as f:
+            f.write(source)
+    return dest_dir
+
+
+def start_api(workdir: str, kingo_url: str, port: int, client_rate: float = 0, extra_env=None,
+              workers: int = 1, app_dir: str = REPO_DIR) -> subprocess.Popen:
+    schools_dir = os.path.join(workdir, 'schools')
+    shutil.copytree(os.path.join(REPO_DIR, 'schools'), schools_dir,
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    if client_rate:
+        for config_path in glob.glob(os.path.join(schools_dir, '*', 'config.json')):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            config['rateLimit'] = {"rate": client_rate, "burst": max(1, int(client_rate))}
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, ensure_ascii=False, indent=4)
+    env = {**os.environ, "kingo_root_url": kingo_url, **(extra_env or {})}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--app-dir", app_dir,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", "--workers", str(workers)],
+        cwd=workdir, env=env
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100 * workers):
+        try:
+            requests.get(base_url + "/", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("api:app 启动失败")
+
+
+class LoadGen:
+    def __init__(self, base_url: str, users, args):
+        self.base_url = base_url
+        self.users = users
+        self.args = args
+        self.etags = {}
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = Counter()
+        self.kinds = Counter()
+
+    def poll(self, session: requests.Session, username: str, kind: str):
+        password = user_password(username)
+        params = {"pwd": password, "school_code": "12623"}
+        headers = {}
+        if kind == "force":
+            params["force"] = "true"
+        elif kind == "bad_password":
+            params["pwd"] = "f" * 32
+        elif kind == "conditional" and username in self.etags:
+            headers["If-None-Match"] = self.etags[username]
+        started = time.perf_counter()
+        response = session.get(f"{self.base_url}/{username}.ics", params=params, headers=headers, timeout=60)
+        elapsed = time.perf_counter() - started
+        if response.headers.get("ETag"):
+            self.etags[username] = response.headers["ETag"]
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.statuses[response.status_code] += 1
+            self.kinds[kind] += 1
+
+    def pick_kind(self, rng: random.Random) -> str:
+        r = rng.random()
+        for kind in ("force", "bad_password", "conditional"):
+            share = getattr(self.args, kind)
+            if r < share:
+                return kind
+            r -= share
+        return "plain"
+
+    def run(self, duration: float):
+        deadline = time.monotonic() + duration
+
+        def worker(seed: int):
+            rng = random.Random(seed)
+            with requests.Session() as session:
+                while time.monotonic() < deadline:
+                    self.poll(session, rng.choice(self.users), self.pick_kind(rng))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.args.concurrency)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+    def warm(self):
+        """每个用户先完整获取一次（冷抓取）"""
+        def worker(users):
+            with requests.Session() as session:
+                for username in users:
+                    self.poll(session, username, "plain")
+
+        chunks = [self.users[i::self.args.concurrency] for i in range(self.args.concurrency)]
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+    def report(self, title: str, elapsed: float):
+        total = len(self.latencies)
+        print(f"== {title}: {total} 次请求，{elapsed:.1f}s，{total / elapsed:.1f} req/s")
+        print(f"   延迟 p50={percentile(self.latencies, 0.5) * 1000:.1f}ms "
+              f"p90={percentile(self.latencies, 0.9) * 1000:.1f}ms "
+              f"p99={percentile(self.latencies, 0.99) * 1000:.1f}ms")
+        print(f"   状态码 {dict(self.statuses)}  请求类型 {dict(self.kinds)}")
+        self.latencies, self.statuses, self.kinds = [], Counter(), Counter()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="订阅服务端到端压测")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--conditional", type=float, default=0.6, help="携带 If-None-Match 的请求比例")
+    parser.add_argument("--force", type=float, default=0.01, help="force=true 的请求比例")
+    parser.add_argument("--bad-password", type=float, default=0.02, help="使用错误密码的请求比例")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟教务系统每个请求的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="模拟教务系统每秒允许的请求数")
+    parser.add_argument("--client-rate", type=float, default=0.0, help="覆盖服务端对教务系统的限流（次/秒）")
+    args = parser.parse_args()
+
+    kingo = FakeKingo(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit).start()
+    users = [str(2020000000 + i) for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        process = start_api(workdir, kingo.base_url, port, args.client_rate)
+        try:
+            load = LoadGen(f"http://127.0.0.1:{port}", users, args)
+            elapsed = load.warm()
+            print(f"上游请求 {dict(kingo.counts)}")
+            load.report("冷抓取", elapsed)
+            kingo.counts.clear()
+            elapsed = load.run(args.duration)
+            print(f"上游请求 {dict(kingo.counts)}")
+            load.report("轮询", elapsed)
+            print(f"服务状态 {requests.get(f'http://127.0.0.1:{port}/status', timeout=5).json()}")
+        finally:
+            process.terminate()
+            process.wait()
+            kingo.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+多 worker 进程压力测试：用 uvicorn --workers 启动服务，让多个进程同时处理同一批用户，检查
+- 同一用户的并发请求（新用户、过期后的后台刷新）跨进程只抓取一次；强制刷新只复用在请求到达之后
+  完成的抓取，抓取次数介于用户数与请求数之间；
+- 共享的限流器使所有进程合计不超过 rateLimit（模拟教务系统按 1.25 倍速率限流，超出即返回错误页）；
+- 结束后存储中每个用户的缓存与 user_info 完整，data_hash 与缓存内容一致，所有响应都是完整的日历。
+
+抓取次数取自 /metrics 中跨进程汇总的 xqe_fetches_total。
+
+用法:
+    python tools/stress_workers.py [--workers 4] [--users 8] [--burst 6] [--rate 20] [--latency 0.05]
+                                   [--no-shared-state]
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import requests
+
+from fake_kingo import FakeKingo, user_password
+from loadgen import REPO_DIR, free_port, start_api
+
+sys.path.insert(0, REPO_DIR)
+from xqe import compute_data_hash  # noqa: E402
+
+METRICS_FLUSH_SECONDS = 5
+
+
+def read_metric(base_url: str, name: str) -> float:
+    text = requests.get(f"{base_url}/metrics", timeout=10).text
+    return sum(float(value) for value in re.findall(rf"^{name}(?:{{[^}}]*}})? (\S+)$", text, re.M))
+
+
+class Stress:
+    def __init__(self, base_url: str, users, burst: int):
+        self.base_url = base_url
+        self.users = users
+        self.burst = burst
+        self.statuses = Counter()
+        self.broken = 0
+        self.lock = threading.Lock()
+
+    def request(self, username: str, force: bool):
+        params = {"pwd": user_password(username), "school_code": "12623"}
+        if force:
+            params["force"] = "true"
+        # 每次新建连接，让请求分散到不同的 worker 进程
+        response = requests.get(f"{self.base_url}/{username}.ics", params=params, timeout=120)
+        body = response.text
+        with self.lock:
+            self.statuses[response.status_code] += 1
+            if response.status_code == 200 and not (body.startswith("BEGIN:VCALENDAR") and body.endswith("END:VCALENDAR")):
+                self.broken += 1
+
+    def phase(self, force: bool = False) -> float:
+        """每个用户同时发出 burst 个请求"""
+        barrier = threading.Barrier(len(self.users) * self.burst)
+
+        def worker(username):
+            barrier.wait()
+            self.request(username, force)
+
+        threads = [threading.Thread(target=worker, args=(u,)) for u in self.users for _ in range(self.burst)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+    def settled_fetches(self, expected: float, timeout: float = 120) -> float:
+        """等待各进程的抓取与指标落盘完成，返回汇总的抓取次数"""
+        deadline = time.monotonic() + timeout
+        fetches = read_metric(self.base_url, "xqe_fetches_total")
+        while fetches < expected and time.monotonic() < deadline:
+            time.sleep(1)
+            fetches = read_metric(self.base_url, "xqe_fetches_total")
+        # 再等一个落盘周期，确认没有多余的抓取
+        time.sleep(METRICS_FLUSH_SECONDS + 1)
+        return read_metric(self.base_url, "xqe_fetches_total")
+
+
+def age_users(db_path: str, hours: float = 2):
+    """把所有用户的 last_fetch_time 改到 hours 小时前，使缓存过期"""
+    stale = (datetime.now() - timedelta(hours=hours)).isoformat()
+    with sqlite3.connect(db_path, timeout=30) as conn:
+        conn.execute(
+            "UPDATE users SET last_fetch_time = ?, info = json_set(info, '$.last_fetch_time', ?)",
+            (stale, stale)
+        )
+
+
+def check_store(db_path: str, users) -> list:
+    """逐个用户检查存储内容，返回发现的问题"""
+    problems = []
+    with sqlite3.connect(db_path, timeout=30) as conn:
+        rows = {username: (info, cache) for username, info, cache in
+                conn.execute("SELECT username, info, cache FROM users WHERE school_code = '12623'")}
+    for username in users:
+        if username not in rows:
+            problems.append(f"{username}: 缺少记录")
+            continue
+        try:
+            info, cache = json.loads(rows[username][0]), json.loads(rows[username][1] or "{}")
+        except ValueError as e:
+            problems.append(f"{username}: JSON 损坏 {e}")
+            continue
+        if not cache.get("courses"):
+            problems.append(f"{username}: 缓存没有课程")
+        elif info.get("data_hash") != compute_data_hash(cache):
+            problems.append(f"{username}: data_hash 与缓存不一致")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多 worker 进程压力测试")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--burst", type=int, default=6, help="每个用户同时发出的请求数")
+    parser.add_argument("--rate", type=float, default=20, help="服务端限流与模拟教务系统限流（次/秒）")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟教务系统每个请求的延迟（秒）")
+    parser.add_argument("--no-shared-state", action="store_true", help="不设置 upstream_state_dir（各进程各自限流）")
+    args = parser.parse_args()
+
+    # 模拟教务系统的限流留 25% 余量，吸收请求到达时间的抖动；各进程各自限流时合计可达 workers 倍
+    kingo = FakeKingo(latency=args.latency, rate_limit=args.rate * 1.25).start()
+    users = [str(2021000000 + i) for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as workdir:
+        env = {"metrics_dir": os.path.join(workdir, "user", "metrics")}
+        if not args.no_shared_state:
+            env["upstream_state_dir"] = os.path.join(workdir, "user", "upstream")
+        port = free_port()
+        process = start_api(workdir, kingo.base_url, port, args.rate, env, args.workers)
+        base_url = f"http://127.0.0.1:{port}"
+        db_path = os.path.join(workdir, "user", "xqe.db")
+        try:
+            stress = Stress(base_url, users, args.burst)
+            fetches = 0.0
+            for title, prepare, force in (
+                ("新用户", None, False),
+                ("强制刷新", None, True),
+                ("过期后台刷新", age_users, False),
+            ):
+                if prepare:
+                    prepare(db_path)
+                errors_before = kingo.counts["errors"]
+                elapsed = stress.phase(force)
+                total = stress.settled_fetches(fetches + len(users))
+                print(f"== {title}: {len(users) * args.burst} 个请求 {elapsed:.1f}s，"
+                      f"抓取 {total - fetches:.0f} 次（用户 {len(users)} 个），"
+                      f"教务系统错误页 {kingo.counts['errors'] - errors_before} 次")
+                fetches = total
+            problems = check_store(db_path, users)
+            print(f"状态码 {dict(stress.statuses)}，不完整的日历 {stress.broken} 个")
+            print("存储检查：" + ("全部正常" if not problems else "\n  ".join([""] + problems)))
+        finally:
+            process.terminate()
+            process.wait()
+            kingo.stop()
+
+
+if __name__ == "__main__":
+    main()
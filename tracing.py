@@ -0,0 +1,124 @@
+"""
+请求内分阶段计时
+
+api.py 为每个（被采样的）请求开启一个 Trace，放在 contextvars 中；各处用 span("阶段名") 包住
+登录、DES、学期获取、解析、存储读写、ICS 导出等步骤，耗时累加到当前 Trace，
+并记录到 metrics 的 xqe_stage_seconds 直方图。请求结束时 Trace 转为 Server-Timing 响应头。
+
+没有 Trace 的线程（未采样的请求、后台刷新）中 span 不做任何事情，开销只有一次 ContextVar 读取。
+线程池中执行的任务需要用 contextvars.copy_context().run 传递 Trace（见 api.run_fetch）。
+
+环境变量 trace_sample_rate 为采样比例（0~1），默认 1 即全部采样。
+"""
+import functools
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+TRACE_SAMPLE_RATE = float(os.environ.get("trace_sample_rate", "1"))
+
+_CURRENT_TRACE: ContextVar[Optional['Trace']] = ContextVar("xqe_trace", default=None)
+
+
+def observe(stage: str, value_ms: float):
+    metrics.observe("xqe_stage_seconds", value_ms / 1000, stage=stage)
+
+
+class Trace:
+    """一次请求内各阶段的累计耗时（同一阶段多次出现时累加，如多个学期）"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, value_ms: float):
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [value_ms, 1]
+            else:
+                entry[0] += value_ms
+                entry[1] += 1
+
+    def server_timing(self) -> str:
+        with self._lock:
+            items: List[Tuple[str, List[float]]] = list(self.stages.items())
+        parts = [
+            f'{stage};dur={total:.1f}' + (f';desc="x{int(count)}"' if count > 1 else '')
+            for stage, (total, count) in items
+        ]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ", ".join(parts)
+
+
+class _Span:
+    __slots__ = ('trace', 'stage', 'started')
+
+    def __init__(self, trace: Trace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = (time.perf_counter() - self.started) * 1000
+        self.trace.add(self.stage, elapsed)
+        observe(self.stage, elapsed)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(stage: str):
+    """计时一个阶段；当前上下文没有 Trace 时什么也不做"""
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, stage)
+
+
+def traced(stage: str):
+    """把整个函数作为一个阶段计时的装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_trace():
+    """按采样比例为当前请求开启 Trace，返回 (trace, token)；未采样时 trace 为 None"""
+    if TRACE_SAMPLE_RATE < 1 and random.random() >= TRACE_SAMPLE_RATE:
+        return None, None
+    trace = Trace()
+    return trace, _CURRENT_TRACE.set(trace)
+
+
+def finish_trace(trace: Optional[Trace], token) -> Optional[str]:
+    """结束 Trace，记录总耗时并返回 Server-Timing 头的值"""
+    if trace is None:
+        return None
+    _CURRENT_TRACE.reset(token)
+    observe("total", (time.perf_counter() - trace.started) * 1000)
+    return trace.server_timing()
@@ -1,77 +1,139 @@
 import os
 import sys
 import json
-from datetime import datetime, timedelta, timezone
+import glob
+import hashlib
+from array import array
+from collections import OrderedDict
+from email.utils import format_datetime
+from datetime import date, datetime, time as dt_time, timedelta, timezone
 from typing import Optional, List, Dict, Any, Tuple
 import importlib.util
+import atexit
+import logging
+import heapq
+import itertools
 import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+
+from storage import USER_DIR_BASE, get_store, prune_user_state, user_lock, user_state_path
+import metrics
+from tracing import traced
 
 # 全局缓存与线程锁
 _SCHOOL_MODULE_CACHE = {}
 _MODULE_LOCK = threading.Lock()
-_TIMETABLE_DATA_CACHE = None
-_TIMETABLE_LOCK = threading.Lock()
-_FILE_LOCK = threading.Lock()
+_MIDNIGHT_RANGE = (dt_time(0, 0), dt_time(0, 0))
 
-USER_DIR_BASE = "user"
 CACHE_MINUTES = 40
 STALE_DAYS = 14
+ICS_CACHE_MB = float(os.environ.get("ics_cache_mb", "64"))
+ICS_DISK_CACHE = bool(os.environ.get("ics_disk_cache"))
+ACCESS_FLUSH_SECONDS = float(os.environ.get("access_flush_interval", "60"))
+UPSTREAM_CONCURRENCY = int(os.environ.get("upstream_concurrency", "8"))
+REFRESH_WORKERS = int(os.environ.get("refresh_workers", "2"))
+REFRESH_INTERVAL = float(os.environ.get("refresh_interval", "0.5"))
+REFRESH_RETRY_MINUTES = 10
+LOGIN_BACKOFF_MINUTES = 5
+LOGIN_BACKOFF_MAX_HOURS = 24
+
+logger = logging.getLogger(__name__)
 
 
 def get_user_dir(school_code: str, username: str) -> str:
     return os.path.join(USER_DIR_BASE, school_code, username)
 
 
-def get_cache_path(school_code: str, username: str) -> str:
-    return os.path.join(get_user_dir(school_code, username), "cache.json")
-
-
-def get_user_info_path(school_code: str, username: str) -> str:
-    return os.path.join(get_user_dir(school_code, username), "user_info.json")
-
-
 def is_user_exists(school_code: str, username: str) -> bool:
-    return os.path.exists(get_user_info_path(school_code, username))
+    return get_store().user_exists(school_code, username)
 
 
+@traced("store")
 def load_user_info(school_code: str, username: str) -> Dict[str, Any]:
-    path = get_user_info_path(school_code, username)
-    if os.path.exists(path):
-        with _FILE_LOCK:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    return {}
+    return get_store().load_user_info(school_code, username)
 
 
+@traced("store")
 def save_user_info(school_code: str, username: str, info: Dict[str, Any]):
-    user_dir = get_user_dir(school_code, username)
-    os.makedirs(user_dir, exist_ok=True)
-    path = get_user_info_path(school_code, username)
-    with _FILE_LOCK:
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(info, f, ensure_ascii=False, indent=4)
+    get_store().save_user_info(school_code, username, info)
 
 
+@traced("store")
 def load_cache(school_code: str, username: str) -> Dict[str, Any]:
-    path = get_cache_path(school_code, username)
-    if os.path.exists(path):
-        with _FILE_LOCK:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    return {}
+    return get_store().load_cache(school_code, username)
 
 
+@traced("store")
 def save_cache(school_code: str, username: str, data: Dict[str, Any]):
-    user_dir = get_user_dir(school_code, username)
-    os.makedirs(user_dir, exist_ok=True)
-    path = get_cache_path(school_code, username)
-    with _FILE_LOCK:
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+    get_store().save_cache(school_code, username, data)
 
 
-def is_cache_fresh(school_code: str, username: str) -> bool:
-    info = load_user_info(school_code, username)
+@traced("store")
+def save_user(school_code: str, username: str, info: Dict[str, Any], cache: Dict[str, Any] = None):
+    get_store().save_user(school_code, username, info, cache)
+
+
+def compute_data_hash(school_data: Dict[str, Any]) -> str:
+    """课表数据的内容哈希，作为渲染缓存 key 的一部分（不含只用于跳过解析的页面哈希）"""
+    data = {key: value for key, value in school_data.items() if key != 'semester_hashes'}
+    raw = json.dumps(data, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AccessTracker:
+    """
+    缓冲 last_access_time 的更新
+
+    缓存命中时只记录在内存中，由后台线程定时（以及进程退出时）批量写入存储，
+    命中路径因此不产生任何磁盘写入。
+    """
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str], str] = {}
+        self._thread = None
+    
+    def touch(self, school_code: str, username: str, when: str = None):
+        with self._lock:
+            self._pending[(school_code, username)] = when or datetime.now().isoformat()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="xqe-access-flush", daemon=True)
+                self._thread.start()
+    
+    def get(self, school_code: str, username: str) -> Optional[str]:
+        """尚未写入存储的最近访问时间"""
+        with self._lock:
+            return self._pending.get((school_code, username))
+    
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            get_store().update_access_times(pending)
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"写入访问时间失败: {e}")
+
+
+_ACCESS_TRACKER = AccessTracker(ACCESS_FLUSH_SECONDS)
+atexit.register(_ACCESS_TRACKER.flush)
+
+
+def record_access(school_code: str, username: str):
+    _ACCESS_TRACKER.touch(school_code, username)
+
+
+def is_cache_fresh(school_code: str, username: str, info: Dict[str, Any] = None) -> bool:
+    if info is None:
+        info = load_user_info(school_code, username)
     last_fetch = info.get('last_fetch_time')
     if not last_fetch:
         return False
@@ -83,6 +145,416 @@ def is_cache_fresh(school_code: str, username: str) -> bool:
         return False
 
 
+def _group_courses(school_data: Dict[str, Any], keys) -> Dict[str, List[Dict[str, Any]]]:
+    grouped = {key: [] for key in keys}
+    if not grouped:
+        return grouped
+    for course in school_data.get('courses', []):
+        key = f"{course.get('_schoolYear')}-{course.get('_term')}"
+        if key in grouped:
+            grouped[key].append(course)
+    return grouped
+
+
+def get_frozen_semesters(school_data: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """按学期拆分缓存中已结束（不会再变化）的学期课程，供下次抓取时跳过"""
+    return _group_courses(school_data, school_data.get('frozen_semesters', []))
+
+
+def get_known_semesters(school_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """未结束学期上次抓取的页面哈希与课程，页面未变化时学校模块直接沿用，跳过解析"""
+    hashes = {
+        key: page_hash for key, page_hash in school_data.get('semester_hashes', {}).items()
+        if key not in school_data.get('frozen_semesters', [])
+    }
+    grouped = _group_courses(school_data, hashes)
+    return {key: {"hash": hashes[key], "courses": courses} for key, courses in grouped.items()}
+
+
+class FetchStats:
+    """抓取结果统计：课表有变化 / 无变化（无变化时不写缓存、不重新生成日历）"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.changed = 0
+        self.unchanged = 0
+    
+    def record(self, changed: bool):
+        with self._lock:
+            if changed:
+                self.changed += 1
+            else:
+                self.unchanged += 1
+        metrics.inc("xqe_fetches_total", result="changed" if changed else "unchanged")
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"changed": self.changed, "unchanged": self.unchanged}
+
+
+_FETCH_STATS = FetchStats()
+
+
+class SingleFlight:
+    """
+    合并同一 key 的并发调用
+
+    同一时刻只有一个调用方（leader）真正执行函数，其余调用方等待并共享其结果或异常。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, Future] = {}
+    
+    def do(self, key: Any, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+        
+        if not is_leader:
+            return future.result()
+        
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+_FETCH_FLIGHT = SingleFlight()
+_UPSTREAM_SEMAPHORE = threading.BoundedSemaphore(UPSTREAM_CONCURRENCY)
+
+
+def _password_hash(password: str) -> str:
+    """密码的 SHA-256，用于在 user_info 与内存中识别密码而不保存明文"""
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+
+class LoginFailedError(Exception):
+    """教务系统拒绝了账号或密码（网络错误、熔断等不属于此类）"""
+
+
+class LoginFailureCache:
+    """
+    登录失败的负缓存，按 (学校, 学号, 密码哈希) 记录
+
+    改密码后日历应用仍会用旧密码轮询，每次都完整登录只会失败并可能导致账号被锁。
+    连续失败时退避时间从 base_seconds 起翻倍，最长 max_seconds；退避期间不再访问教务系统。
+    失败记录同时写入用户锁目录下的 <哈希>.login.json（与是否已有 user_info 无关），其他 worker 进程在 check 时读取，
+    因此从未登录成功过的学号也能在进程之间共享退避。record_failure 与 clear 在持有用户锁时调用。
+    记录文件在最后一次失败 2 * max_seconds 后不再有意义（退避已结束，次数也不再累加），record_failure 时定期清理。
+    """
+
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, base_seconds: float, max_seconds: float):
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self._entries: Dict[Tuple[str, str, str], Tuple[int, float, str]] = {}
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.saved_logins = 0
+        self._pruned_at = 0.0
+
+    @staticmethod
+    def _key(school_code: str, username: str, password: str) -> Tuple[str, str, str]:
+        return (school_code, username, _password_hash(password))
+
+    @staticmethod
+    def _load_persisted(school_code: str, username: str) -> Dict[str, List]:
+        """读取该用户持久化的失败记录：{密码哈希: [次数, 退避截止时间, 原因]}"""
+        try:
+            with open(user_state_path(school_code, username, ".login.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _save_persisted(school_code: str, username: str, records: Dict[str, List]):
+        path = user_state_path(school_code, username, ".login.json")
+        if not records:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def check(self, school_code: str, username: str, password: str) -> Optional[str]:
+        """处于退避期时返回上次的失败原因（并计入省下的登录次数），否则返回 None"""
+        key = self._key(school_code, username, password)
+        now = time.time()
+        persisted = self._load_persisted(school_code, username).get(key[2])
+        with self._lock:
+            entry = self._entries.get(key)
+            if persisted and (entry is None or entry[1] < persisted[1]):
+                entry = self._entries[key] = tuple(persisted)
+            if entry and now < entry[1]:
+                self.saved_logins += 1
+            else:
+                return None
+        metrics.inc("xqe_login_saved_total", school=school_code)
+        return entry[2]
+
+    def record_failure(self, school_code: str, username: str, password: str, message: str):
+        """记录一次失败并写入该用户的失败记录文件"""
+        now = time.time()
+        key = self._key(school_code, username, password)
+        records = self._load_persisted(school_code, username)
+        with self._lock:
+            count = max(self._entries.get(key, (0, 0.0, ""))[0], records.get(key[2], [0])[0]) + 1
+            backoff = min(self.base_seconds * 2 ** (count - 1), self.max_seconds)
+            # 退避结束超过 max_seconds 的记录不再有意义，顺带清理
+            self._entries = {k: v for k, v in self._entries.items() if now - v[1] < self.max_seconds}
+            self._entries[key] = (count, now + backoff, message)
+            self.failures += 1
+        records = {k: v for k, v in records.items() if now - v[1] < self.max_seconds}
+        records[key[2]] = [count, now + backoff, message]
+        self._save_persisted(school_code, username, records)
+        logger.info(f"用户 {school_code}/{username} 登录失败 {count} 次，{backoff:.0f}s 内不再尝试")
+        if now - self._pruned_at >= self.PRUNE_INTERVAL:
+            self._pruned_at = now
+            removed = prune_user_state(".login.json", 2 * self.max_seconds)
+            if removed:
+                logger.info(f"清理过期的登录失败记录 {removed} 个")
+
+    def clear(self, school_code: str, username: str, password: str):
+        key = self._key(school_code, username, password)
+        with self._lock:
+            self._entries.pop(key, None)
+        # 登录成功只说明这个密码正确，其他密码（如改密码前的旧密码）的失败记录保留
+        records = self._load_persisted(school_code, username)
+        if key[2] in records:
+            del records[key[2]]
+            self._save_persisted(school_code, username, records)
+
+    def stats(self) -> Dict[str, int]:
+        now = time.time()
+        with self._lock:
+            return {
+                "blocked": sum(1 for v in self._entries.values() if now < v[1]),
+                "failures": self.failures,
+                "saved_logins": self.saved_logins,
+            }
+
+
+_LOGIN_FAILURES = LoginFailureCache(LOGIN_BACKOFF_MINUTES * 60, LOGIN_BACKOFF_MAX_HOURS * 3600)
+
+
+def user_fetch_lock(school_code: str, username: str):
+    """用户级文件锁，保证多个 worker 进程之间同一用户只有一个抓取在进行"""
+    return user_lock(school_code, username)
+
+
+def _fetch_exclusive(school_code: str, username: str, password: str,
+                     school_year: str, term: str, all_semesters: bool,
+                     only_if_stale: bool = False, requested_at: datetime = None, **kwargs) -> Dict[str, Any]:
+    started = requested_at or datetime.now()
+    with user_fetch_lock(school_code, username):
+        # 等锁期间其他进程已完成抓取（或后台刷新时缓存已被其他进程刷新），则直接复用其结果；
+        # 只复用同一密码登录成功得到的缓存，否则照常登录，由教务系统校验密码
+        info = load_user_info(school_code, username)
+        last_fetch = info.get("last_fetch_time")
+        if last_fetch and info.get("password_sha256") == _password_hash(password):
+            try:
+                if datetime.fromisoformat(last_fetch) >= started or (only_if_stale and is_cache_fresh(school_code, username, info)):
+                    school_data = load_cache(school_code, username)
+                    if school_data:
+                        return school_data
+            except (ValueError, TypeError):
+                pass
+        # 其他进程记录的登录失败
+        login_error = _LOGIN_FAILURES.check(school_code, username, password)
+        if login_error:
+            raise LoginFailedError(login_error)
+        
+        cached = load_cache(school_code, username)
+        frozen = get_frozen_semesters(cached) if all_semesters else None
+        known = get_known_semesters(cached) if all_semesters else None
+        # 前台抓取与后台刷新共用同一个上游并发上限
+        try:
+            with _UPSTREAM_SEMAPHORE:
+                school_data = SchoolDispatcher.get_timetable(
+                    school_code, username, password,
+                    school_year=school_year, term=term, all_semesters=all_semesters,
+                    frozen=frozen, known=known, **kwargs
+                )
+        except Exception as e:
+            if SchoolDispatcher.is_login_error(school_code, e):
+                _LOGIN_FAILURES.record_failure(school_code, username, password, str(e))
+                raise LoginFailedError(str(e)) from e
+            raise
+        _LOGIN_FAILURES.clear(school_code, username, password)
+        # 旧版本写在 user_info 中的失败记录
+        info.pop("login_failure", None)
+        info.pop("last_error", None)
+        info.pop("last_error_time", None)
+        info.pop("last_error_password_sha256", None)
+        info["last_fetch_time"] = datetime.now().isoformat()
+        info["password_sha256"] = _password_hash(password)
+        data_hash = compute_data_hash(school_data)
+        changed = data_hash != info.get("data_hash")
+        if changed or not info.get("data_update_time"):
+            info["data_update_time"] = info["last_fetch_time"]
+        info["data_hash"] = data_hash
+        # 课表与页面均未变化时只更新抓取时间；data_hash 不变，渲染缓存继续命中
+        save_user(school_code, username, info, school_data if school_data != cached else None)
+        _FETCH_STATS.record(changed)
+        return school_data
+
+
+@traced("fetch")
+def fetch_school_data(school_code: str, username: str, password: str,
+                      school_year: str = None, term: str = None, all_semesters: bool = True,
+                      only_if_stale: bool = False, requested_at: datetime = None, **kwargs) -> Dict[str, Any]:
+    """
+    从教务系统抓取课表并写入缓存，同一用户的并发抓取只会发起一次
+
+    key 不包含 remindTime（只影响 ICS 渲染），但包含密码，避免错误密码的请求共享他人的结果；
+    跨进程复用其他进程刚抓取的缓存时同样比较 user_info 中最近一次登录成功的密码哈希。
+    该密码最近登录失败且仍在退避期内时直接抛出 LoginFailedError，不访问教务系统。
+    only_if_stale 用于后台刷新：拿到用户锁时缓存已经新鲜（其他进程刚刷新过）则不再抓取。
+    requested_at 为请求到达时间（默认为当前时间），在此之后其他进程完成的抓取结果可以直接复用，
+    这样在线程池中排队的请求不会在别人刚抓完之后再抓一次。
+    """
+    # 学校代码不存在时在获取用户锁之前失败
+    SchoolDispatcher.load_school_module(school_code)
+    login_error = _LOGIN_FAILURES.check(school_code, username, password)
+    if login_error:
+        raise LoginFailedError(login_error)
+    key = (school_code, username, password, school_year, term, all_semesters, only_if_stale)
+    return _FETCH_FLIGHT.do(
+        key, _fetch_exclusive, school_code, username, password,
+        school_year, term, all_semesters, only_if_stale, requested_at, **kwargs
+    )
+
+
+class RefreshScheduler:
+    """
+    后台刷新调度器（stale-while-revalidate）
+
+    缓存过期时请求直接返回旧日历，刷新任务在这里排队：
+    - 同一用户、同一密码排队或执行中时不重复提交（key 为 (学校, 学号, 密码哈希)）；
+    - 按最近访问时间排序，越活跃的用户越先刷新；
+    - 固定数量的工作线程，且相邻两次启动至少间隔 interval 秒，把上游请求摊开。
+    """
+    
+    def __init__(self, workers: int, interval: float):
+        self.workers = workers
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, Tuple[str, str, str]]] = []
+        self._jobs: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self._running = set()
+        self._seq = itertools.count()
+        self._next_start = 0.0
+        self._threads: List[threading.Thread] = []
+    
+    def submit(self, school_code: str, username: str, password: str, priority: float, **job) -> bool:
+        key = (school_code, username, _password_hash(password))
+        with self._cond:
+            if key in self._jobs or key in self._running:
+                return False
+            self._jobs[key] = dict(job, password=password)
+            heapq.heappush(self._heap, (-priority, next(self._seq), key))
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._run, name=f"xqe-refresh-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            self._cond.notify()
+        return True
+    
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._jobs)
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                delay = self._next_start - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, _, key = heapq.heappop(self._heap)
+                job = self._jobs.pop(key)
+                self._running.add(key)
+                self._next_start = time.monotonic() + self.interval
+            try:
+                _refresh_user(key[0], key[1], **job)
+            except Exception as e:
+                logger.warning(f"后台刷新 {key[0]}/{key[1]} 失败: {e}")
+            finally:
+                with self._cond:
+                    self._running.discard(key)
+
+
+def _refresh_user(school_code: str, username: str, password: str, **kwargs):
+    try:
+        # 多个 worker 进程可能各自提交了同一用户的刷新，只有第一个真正访问教务系统
+        fetch_school_data(school_code, username, password, only_if_stale=True, **kwargs)
+    except LoginFailedError:
+        # 登录失败只与这个密码有关，已由 LoginFailureCache 按密码哈希记录，不写入所有请求共用的 user_info
+        raise
+    except Exception as e:
+        # 记录失败原因：一是避免每次请求都立即重试，二是过期太久时在日历中提示
+        # 持有用户锁读改写，避免覆盖其他进程同时写入的抓取结果
+        with user_fetch_lock(school_code, username):
+            info = load_user_info(school_code, username)
+            if info:
+                info["last_error"] = str(e)
+                info["last_error_time"] = datetime.now().isoformat()
+                info["last_error_password_sha256"] = _password_hash(password)
+                save_user_info(school_code, username, info)
+        raise
+
+
+_REFRESH_SCHEDULER = RefreshScheduler(REFRESH_WORKERS, REFRESH_INTERVAL)
+
+
+def _is_known_password(info: Dict[str, Any], password: str) -> bool:
+    """
+    password 是否为最近一次登录成功的密码
+
+    旧版本创建（或由 storage.py migrate 导入）的用户没有 password_sha256，
+    在下一次抓取成功记录哈希之前沿用原先的行为，视为已知密码
+    """
+    recorded = info.get("password_sha256")
+    return recorded is None or recorded == _password_hash(password)
+
+
+def _last_error_for(info: Dict[str, Any], password: str) -> Optional[str]:
+    """最近一次后台刷新的失败原因，只在失败时使用的是同一密码时返回"""
+    if info.get("last_error") and info.get("last_error_password_sha256") == _password_hash(password):
+        return info["last_error"]
+    return None
+
+
+def schedule_refresh(school_code: str, username: str, password: str, info: Dict[str, Any], **kwargs) -> bool:
+    """为缓存已过期的用户提交后台刷新，用同一密码刷新失败过的在 REFRESH_RETRY_MINUTES 内不再重试"""
+    last_error_time = _parse_local_time(info.get("last_error_time")) if _last_error_for(info, password) else None
+    if last_error_time and (datetime.now().astimezone() - last_error_time).total_seconds() < REFRESH_RETRY_MINUTES * 60:
+        return False
+    last_access = _parse_local_time(info.get("last_access_time"))
+    priority = last_access.timestamp() if last_access else 0.0
+    return _REFRESH_SCHEDULER.submit(school_code, username, password, priority, **kwargs)
+
+
 class SchoolDispatcher:
     @staticmethod
     def load_school_module(school_code: str):
@@ -102,22 +574,70 @@ class SchoolDispatcher:
             return module
     
     @staticmethod
+    @traced("dispatch")
     def get_timetable(school_code: str, username: str, password: str, 
-                      school_year: str = None, term: str = None, all_semesters: bool = False, **kwargs) -> Dict[str, Any]:
+                      school_year: str = None, term: str = None, all_semesters: bool = False,
+                      frozen: Dict[str, List[Dict[str, Any]]] = None,
+                      known: Dict[str, Dict[str, Any]] = None, **kwargs) -> Dict[str, Any]:
         module = SchoolDispatcher.load_school_module(school_code)
         
-        result_json = module.Main(username, password, school_year, term, all_semesters)
+        result_json = module.Main(username, password, school_year, term, all_semesters, frozen=frozen, known=known)
         
         if isinstance(result_json, str):
             return json.loads(result_json)
         return result_json
+    
+    @staticmethod
+    def is_login_error(school_code: str, error: Exception) -> bool:
+        """学校模块通过 LoginError 区分账号密码错误与网络错误"""
+        login_error = getattr(SchoolDispatcher.load_school_module(school_code), 'LoginError', None)
+        return login_error is not None and isinstance(error, login_error)
+    
+    @staticmethod
+    def get_upstream_status() -> Dict[str, Any]:
+        """已加载学校模块的教务系统限流/熔断状态"""
+        with _MODULE_LOCK:
+            modules = dict(_SCHOOL_MODULE_CACHE)
+        return {
+            school_code: module.get_upstream_status()
+            for school_code, module in modules.items()
+            if hasattr(module, 'get_upstream_status')
+        }
+
+
+def get_status() -> Dict[str, Any]:
+    """服务运行状态，供监控使用"""
+    return {
+        "upstream": SchoolDispatcher.get_upstream_status(),
+        "refresh_pending": _REFRESH_SCHEDULER.pending(),
+        "login_backoff": _LOGIN_FAILURES.stats(),
+        "fetches": _FETCH_STATS.stats(),
+    }
+
+
+def _circuit_gauge() -> Dict[Tuple[Tuple[str, str], ...], int]:
+    return {
+        (("host", host), ("school", school_code)): int(state["circuit"] == "open")
+        for school_code, hosts in SchoolDispatcher.get_upstream_status().items()
+        for host, state in hosts.items()
+    }
+
+
+metrics.gauge("xqe_refresh_queue_depth", _REFRESH_SCHEDULER.pending)
+metrics.gauge("xqe_circuit_open", _circuit_gauge)
 
 
 class TimetableParser:
+    """
+    解析教学周与节次字符串（如 "1-16单"、"3-4"）
+
+    同样的字符串在所有用户之间大量重复，解析结果按字符串缓存，返回不可变的元组。
+    """
     @staticmethod
-    def parse_weeks(weeks_str: str) -> List[int]:
+    @lru_cache(maxsize=4096)
+    def parse_weeks(weeks_str: str) -> Tuple[int, ...]:
         if not weeks_str:
-            return []
+            return ()
         
         numbers = []
         
@@ -148,12 +668,13 @@ class TimetableParser:
                 except ValueError:
                     pass
         
-        return numbers
+        return tuple(numbers)
     
     @staticmethod
-    def parse_periods(periods_str: str) -> List[int]:
+    @lru_cache(maxsize=4096)
+    def parse_periods(periods_str: str) -> Tuple[int, ...]:
         if not periods_str:
-            return []
+            return ()
         
         numbers = []
         parts = str(periods_str).split(',')
@@ -170,117 +691,311 @@ class TimetableParser:
                     numbers.append(int(part))
                 except ValueError:
                     pass
-        return numbers
+        return tuple(numbers)
+
+
+@lru_cache(maxsize=4096)
+def _week_offsets(weeks: Tuple[int, ...]) -> Tuple[int, ...]:
+    """各教学周相对第一周的天数"""
+    return tuple((week_num - 1) * 7 for week_num in weeks)
+
+
+@lru_cache(maxsize=4096)
+def _recurrence_shape(weeks: Tuple[int, ...]) -> Tuple[int, int, int, Tuple[int, ...]]:
+    """
+    教学周合并为每周重复事件的形状：(起始周, 间隔, 次数, 排除的周相对起始周的天数)
+
+    单/双周使用间隔 2；起止周之间不上课的周需要排除。
+    """
+    weeks = sorted(set(weeks))
+    gaps = [b - a for a, b in zip(weeks, weeks[1:])]
+    interval = 2 if gaps and all(gap % 2 == 0 for gap in gaps) else 1
+    count = (weeks[-1] - weeks[0]) // interval + 1
+    week_set = set(weeks)
+    excluded = tuple((week_num - weeks[0]) * 7
+                     for week_num in range(weeks[0], weeks[-1] + 1, interval) if week_num not in week_set)
+    return weeks[0], interval, count, excluded
+
+
+@lru_cache(maxsize=4096)
+def _format_day(ordinal: int) -> str:
+    """date.toordinal() 整数转为 ICS 的 YYYYMMDD"""
+    day = date.fromordinal(ordinal)
+    return f"{day.year:04d}{day.month:02d}{day.day:02d}"
+
+
+def _format_minute(minute: int) -> str:
+    """当天的分钟数转为 ICS 的 HHMMSS"""
+    return f"{minute // 60:02d}{minute % 60:02d}00"
+
+
+class CourseEvents:
+    """
+    一门课（同一星期、同一节次）的全部上课时间
+
+    标题、教师等字符串每门课只保存一份；各次上课的日期以 date.toordinal() 整数保存在 array 中，
+    上下课时间保存为当天的分钟数，导出时才格式化，不为每周创建 dict 与 datetime。
+    interval 不为 None 时表示合并后的重复事件：days 只有第一次上课的日期，
+    count 为重复次数，exdays 为排除的日期。
+    """
+    __slots__ = ('title', 'teacher', 'location', 'teaching_weeks', 'class_periods',
+                 'start_minute', 'end_minute', 'days', 'interval', 'count', 'exdays')
+
+    def __init__(self, course: Dict[str, Any], start_time: dt_time, end_time: dt_time, days: array,
+                 interval: int = None, count: int = 1, exdays: array = None):
+        self.title = course.get('title', '')
+        self.teacher = course.get('teacher', '')
+        self.location = course.get('location', '')
+        self.teaching_weeks = course.get('teaching_weeks', '')
+        self.class_periods = course.get('class_periods', '')
+        self.start_minute = start_time.hour * 60 + start_time.minute
+        self.end_minute = end_time.hour * 60 + end_time.minute
+        self.days = days
+        self.interval = interval
+        self.count = count
+        self.exdays = exdays
+
+
+@lru_cache(maxsize=256)
+def _parse_date(value: Optional[str]) -> Optional[date]:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_clock(value: str) -> Optional[dt_time]:
+    try:
+        return datetime.strptime(value, "%H:%M").time() if value else None
+    except ValueError:
+        return None
+
+
+def parse_timetable(timetable: Dict[str, str]) -> Dict[int, Tuple[Optional[dt_time], Optional[dt_time]]]:
+    """把作息表 {"1": "08:30-09:10", ...} 转为 {节次: (开始时间, 结束时间)}"""
+    periods = {}
+    for period, time_range in timetable.items():
+        try:
+            period = int(period)
+        except (TypeError, ValueError):
+            continue
+        start, _, end = str(time_range).partition('-')
+        periods[period] = (_parse_clock(start), _parse_clock(end))
+    return periods
 
 
 class SchoolCalendar:
-    def __init__(self, calendar_path: str = None):
-        self.calendar = {}
-        if calendar_path and os.path.exists(calendar_path):
-            with open(calendar_path, 'r', encoding='utf-8') as f:
-                self.calendar = json.load(f)
+    """校历：加载时按学期预先算好第一周的周一与学期起止日期"""
+    
+    def __init__(self, calendar_path: str = None, calendar: Dict[str, Any] = None):
+        if calendar is None:
+            calendar = {}
+            if calendar_path and os.path.exists(calendar_path):
+                with open(calendar_path, 'r', encoding='utf-8') as f:
+                    calendar = json.load(f)
+        self.calendar = calendar
+        self.term_bounds: Dict[str, Tuple[Optional[date], Optional[date]]] = {}
+        self.first_mondays: Dict[str, date] = {}
+        for key, term_info in calendar.items():
+            start = _parse_date(term_info.get('termStartDate'))
+            self.term_bounds[key] = (start, _parse_date(term_info.get('termEndDate')))
+            if start:
+                self.first_mondays[key] = start - timedelta(days=start.weekday())
+    
+    def get_first_monday_date(self, school_year: str, term: str) -> Optional[date]:
+        return self.first_mondays.get(f"{school_year}-{term}")
     
     def get_first_monday(self, school_year: str, term: str) -> Optional[str]:
-        key = f"{school_year}-{term}"
-        if key in self.calendar:
-            start_date = self.calendar[key].get('termStartDate')
-            if start_date:
-                first_monday = datetime.strptime(start_date, "%Y-%m-%d")
-                weekday = first_monday.weekday()
-                if weekday != 0:
-                    first_monday -= timedelta(days=weekday)
-                return first_monday.strftime("%Y-%m-%d")
-        return None
+        first_monday = self.get_first_monday_date(school_year, term)
+        return first_monday.strftime("%Y-%m-%d") if first_monday else None
+    
+    def get_term_bounds(self, school_year: str, term: str) -> Tuple[Optional[date], Optional[date]]:
+        return self.term_bounds.get(f"{school_year}-{term}", (None, None))
     
     def get_term_info(self, school_year: str, term: str) -> Optional[Dict[str, Any]]:
         key = f"{school_year}-{term}"
         return self.calendar.get(key)
 
 
+class SchoolResources:
+    """一所学校预处理好的校历与作息表，version 为来源文件的修改时间，modified 为其中最晚的一个（Unix 时间）"""
+    
+    __slots__ = ('calendar', 'periods', 'version', 'modified', 'mtimes', 'checked_at')
+    
+    def __init__(self, calendar: SchoolCalendar, periods: Dict[int, Tuple[Optional[dt_time], Optional[dt_time]]],
+                 mtimes: Tuple[int, ...]):
+        self.calendar = calendar
+        self.periods = periods
+        self.mtimes = mtimes
+        self.version = '-'.join(map(str, mtimes))
+        self.modified = max(mtimes) / 1e9
+        self.checked_at = time.monotonic()
+
+
+class SchoolRegistry:
+    """
+    各学校的校历与作息表，首次使用（或 preload）时读取并预处理，渲染时不再解析 JSON 与日期字符串
+
+    每隔 check_interval 秒检查一次文件修改时间，maintain.py 更新校历后无需重启即可生效；
+    文件正在写入、暂时无法解析时继续使用上一版本。
+    学校目录下没有 timetable.json 时使用仓库根目录的 timetable.json。
+    """
+    
+    def __init__(self, base_dir: str = 'schools', check_interval: float = 1.0):
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self._entries: Dict[str, SchoolResources] = {}
+        self._lock = threading.Lock()
+    
+    def _paths(self, school_code: str) -> Tuple[str, str, str]:
+        school_dir = os.path.join(self.base_dir, school_code)
+        return (os.path.join(school_dir, 'school_calendar.json'),
+                os.path.join(school_dir, 'timetable.json'),
+                'timetable.json')
+    
+    @staticmethod
+    def _mtime(path: str) -> int:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return 0
+    
+    @staticmethod
+    def _load_json(path: str) -> Dict[str, Any]:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def _load(self, school_code: str, mtimes: Tuple[int, ...]) -> SchoolResources:
+        calendar_path, timetable_path, default_timetable_path = self._paths(school_code)
+        calendar = self._load_json(calendar_path) if mtimes[0] else {}
+        if mtimes[1]:
+            timetable = self._load_json(timetable_path)
+        elif mtimes[2]:
+            timetable = self._load_json(default_timetable_path)
+        else:
+            timetable = {}
+        return SchoolResources(SchoolCalendar(calendar=calendar), parse_timetable(timetable), mtimes)
+    
+    def get(self, school_code: str) -> SchoolResources:
+        entry = self._entries.get(school_code)
+        if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+            return entry
+        mtimes = tuple(self._mtime(path) for path in self._paths(school_code))
+        if entry is not None and entry.mtimes == mtimes:
+            entry.checked_at = time.monotonic()
+            return entry
+        with self._lock:
+            entry = self._entries.get(school_code)
+            if entry is None or entry.mtimes != mtimes:
+                try:
+                    entry = self._entries[school_code] = self._load(school_code, mtimes)
+                    logger.info(f"已加载学校 {school_code} 的校历与作息表")
+                except (OSError, ValueError) as e:
+                    if entry is None:
+                        raise
+                    logger.warning(f"重新加载学校 {school_code} 的校历失败，继续使用旧版本: {e}")
+                    # 记下这次的修改时间，文件再次更新前不再重试；version 不变，渲染缓存继续有效
+                    entry.mtimes = mtimes
+                    entry.checked_at = time.monotonic()
+        return entry
+    
+    def preload(self):
+        """启动时加载所有学校"""
+        if not os.path.isdir(self.base_dir):
+            return
+        for school_code in sorted(os.listdir(self.base_dir)):
+            if school_code.isdigit():
+                self.get(school_code)
+
+
+_SCHOOL_REGISTRY = SchoolRegistry()
+
+
+def preload_schools():
+    _SCHOOL_REGISTRY.preload()
+
+
 class ICSBuilder:
-    def __init__(self, remind_time: str = "15", calendar_path: str = None, timetable_config: Dict[str, str] = None, school_code: str = None):
+    def __init__(self, remind_time: str = "15", calendar_path: str = None, timetable_config: Dict[str, str] = None, school_code: str = None,
+                 use_rrule: bool = False, dtstamp: datetime = None):
         self.remind_time = remind_time
-        self.calendar = SchoolCalendar(calendar_path)
-        self.timetable = timetable_config or self._load_default_timetable(school_code)
+        resources = _SCHOOL_REGISTRY.get(school_code) if school_code else None
+        if calendar_path:
+            self.calendar = SchoolCalendar(calendar_path)
+        else:
+            self.calendar = resources.calendar if resources else SchoolCalendar()
+        # 学校当前的作息表优先（随文件更新），没有时使用课表数据中保存的作息表
+        if resources and resources.periods:
+            self.periods = resources.periods
+        else:
+            self.periods = parse_timetable(timetable_config or {})
+        # 开启后每门课（同一星期、同一节次）只输出一个带 RRULE 的 VEVENT，而不是每周一个
+        self.use_rrule = use_rrule
+        # 固定 DTSTAMP 可使相同数据生成的日历逐字节一致（ETag 依赖这一点）
+        self.dtstamp = dtstamp
         
-        self._events: List[Dict[str, Any]] = []
+        self._courses: List[CourseEvents] = []
+        # 课表过期、登录失败等提示用的全天事件，导出在课程之后
+        self._notices: List[Dict[str, Any]] = []
     
-    def _load_default_timetable(self, school_code: str = None) -> Dict[str, str]:
-        global _TIMETABLE_DATA_CACHE
-        
-        if school_code:
-            school_timetable_path = os.path.join('schools', school_code, 'timetable.json')
-            if os.path.exists(school_timetable_path):
-                try:
-                    with open(school_timetable_path, "r", encoding="utf-8") as f:
-                        return json.load(f)
-                except Exception:
-                    pass
-        
-        with _TIMETABLE_LOCK:
-            if _TIMETABLE_DATA_CACHE is None:
-                try:
-                    with open("timetable.json", "r", encoding="utf-8") as f:
-                        _TIMETABLE_DATA_CACHE = json.load(f)
-                except Exception:
-                    _TIMETABLE_DATA_CACHE = {}
-        return _TIMETABLE_DATA_CACHE
+    def event_count(self) -> int:
+        """导出的 VEVENT 数量"""
+        return sum(len(course.days) for course in self._courses) + len(self._notices)
     
-    def get_time_range(self, periods: List[int]) -> Tuple[Optional[str], Optional[str]]:
+    def get_time_range(self, periods: Tuple[int, ...]) -> Tuple[Optional[dt_time], Optional[dt_time]]:
         if not periods:
             return None, None
         
-        start_period = min(periods)
-        end_period = max(periods)
-        
-        start_time = self.timetable.get(str(start_period), "00:00-00:00").split('-')[0]
-        end_time = self.timetable.get(str(end_period), "00:00-00:00").split('-')[1]
+        start_time = self.periods.get(min(periods), _MIDNIGHT_RANGE)[0]
+        end_time = self.periods.get(max(periods), _MIDNIGHT_RANGE)[1]
         
-        return start_time or None, end_time or None
+        return start_time, end_time
     
-    def calculate_date(self, week_num: int, weekday: int, first_monday: str) -> datetime.date:
-        first_monday_date = datetime.strptime(first_monday, "%Y-%m-%d").date()
+    def calculate_date(self, week_num: int, weekday: int, first_monday: date) -> date:
         delta_days = (week_num - 1) * 7 + (weekday - 1)
-        return first_monday_date + timedelta(days=delta_days)
+        return first_monday + timedelta(days=delta_days)
     
     def add_course(self, course: Dict[str, Any], school_year: str = None, term: str = None, 
                    first_monday: str = None):
+        """first_monday 为课表数据中保存的第一周周一，校历中有该学期时以校历为准"""
         teaching_weeks = TimetableParser.parse_weeks(course.get('teaching_weeks', ''))
         class_periods = TimetableParser.parse_periods(course.get('class_periods', ''))
         
         if not teaching_weeks or not class_periods:
             return
         
-        start_time_str, end_time_str = self.get_time_range(class_periods)
-        if not start_time_str or not end_time_str:
+        start_time, end_time = self.get_time_range(class_periods)
+        if not start_time or not end_time:
             return
         
-        if not first_monday and school_year and term:
-            first_monday = self.calendar.get_first_monday(school_year, term)
+        first_monday_date = None
+        if school_year and term:
+            first_monday_date = self.calendar.get_first_monday_date(school_year, term)
+        if not first_monday_date and first_monday:
+            first_monday_date = _parse_date(first_monday)
         
-        if not first_monday:
+        if not first_monday_date:
             return
         
         weekday = course.get('weekday', 1)
         
-        for week_num in teaching_weeks:
-            date = self.calculate_date(week_num, weekday, first_monday)
-            
-            start_datetime = datetime.strptime(f"{date} {start_time_str}", "%Y-%m-%d %H:%M")
-            end_datetime = datetime.strptime(f"{date} {end_time_str}", "%Y-%m-%d %H:%M")
-            
-            event = {
-                'title': course.get('title', ''),
-                'teacher': course.get('teacher', ''),
-                'location': course.get('location', ''),
-                'teaching_weeks': course.get('teaching_weeks', ''),
-                'class_periods': course.get('class_periods', ''),
-                'weekday': weekday,
-                'week_num': week_num,
-                'start_datetime': start_datetime,
-                'end_datetime': end_datetime,
-            }
-            self._events.append(event)
+        if self.use_rrule:
+            self._add_recurring_course(course, teaching_weeks, weekday, first_monday_date, start_time, end_time)
+            return
+        
+        # 第一周当天的日期序号，各周只需加上固定的天数
+        first_day = self.calculate_date(1, weekday, first_monday_date).toordinal()
+        days = array('i', [first_day + offset for offset in _week_offsets(teaching_weeks)])
+        self._courses.append(CourseEvents(course, start_time, end_time, days))
+    
+    def _add_recurring_course(self, course: Dict[str, Any], teaching_weeks: Tuple[int, ...], weekday: int,
+                              first_monday: date, start_time: dt_time, end_time: dt_time):
+        """将一门课的所有教学周合并为一个重复事件，形状见 _recurrence_shape"""
+        first_week, interval, count, excluded = _recurrence_shape(teaching_weeks)
+        first_day = self.calculate_date(first_week, weekday, first_monday).toordinal()
+        exdays = array('i', [first_day + offset for offset in excluded])
+        self._courses.append(CourseEvents(course, start_time, end_time, array('i', [first_day]),
+                                          interval, count, exdays))
     
     def add_courses_from_dict(self, courses_data: Dict[str, Any]):
         courses = courses_data.get('courses', [])
@@ -308,11 +1023,22 @@ class ICSBuilder:
         event = {
             'title': f'⚠️课表过期且无法更新⚠️-{reason}',
             'description': f"上次成功从教务系统获取时间：{last_fetch_display}\n\n\n当你看到这个那么代表课表已经超过{STALE_DAYS}天未更新，而且尝试更新时遇到了【{reason}】问题，导致无法更新。\n如需帮助请访问blog.hishutdown.cn/?p=201",
-            'is_all_day': True,
             'start_datetime': datetime.combine(start_datetime, datetime.min.time()),
             'end_datetime': datetime.combine(end_datetime, datetime.min.time()),
         }
-        self._events.append(event)
+        self._notices.append(event)
+        metrics.inc("xqe_stale_calendar_total", reason="stale")
+    
+    def add_login_error_event(self, reason: str):
+        today = datetime.now().date()
+        event = {
+            'title': f'⚠️教务系统登录失败⚠️-{reason}',
+            'description': "课表暂停更新：教务系统拒绝了订阅链接中的账号或密码。\n如果修改过教务系统密码，请使用新密码重新生成订阅链接。\n如需帮助请访问blog.hishutdown.cn/?p=201",
+            'start_datetime': datetime.combine(today, datetime.min.time()),
+            'end_datetime': datetime.combine(today + timedelta(days=1), datetime.min.time()),
+        }
+        self._notices.append(event)
+        metrics.inc("xqe_stale_calendar_total", reason="login")
     
     def _generate_alarm_component(self) -> List[str]:
         if self.remind_time == "-1" or int(self.remind_time) < 0:
@@ -339,6 +1065,7 @@ class ICSBuilder:
         text = text.replace('\n', '\\n')
         return text
     
+    @traced("export")
     def export(self) -> str:
         ics_lines = []
         
@@ -362,91 +1089,322 @@ class ICSBuilder:
             "END:VTIMEZONE"
         ])
         
-        dtstamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        dtstamp = (self.dtstamp or datetime.now(timezone.utc)).astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        dtstamp_line = f"DTSTAMP:{dtstamp}"
+        alarm = self._generate_alarm_component()
+        escape = self._escape_ics_text
+        for course in self._courses:
+            # 同一门课各次上课只有日期不同，其余各行只生成一次
+            head = [
+                "BEGIN:VEVENT",
+                f"SUMMARY:{escape(course.title)}",
+                f"DESCRIPTION:教师: {escape(course.teacher)}\\n教学周: {escape(course.teaching_weeks)}\\n节次: {escape(course.class_periods)}",
+                f"LOCATION:{escape(course.location)}",
+            ]
+            start_clock = _format_minute(course.start_minute)
+            end_clock = _format_minute(course.end_minute)
+            
+            if course.interval is not None:
+                day = _format_day(course.days[0])
+                ics_lines.extend(head)
+                ics_lines.append(f"DTSTART;TZID=Asia/Shanghai:{day}T{start_clock}")
+                ics_lines.append(f"DTEND;TZID=Asia/Shanghai:{day}T{end_clock}")
+                if course.count > 1:
+                    ics_lines.append(f"RRULE:FREQ=WEEKLY;INTERVAL={course.interval};COUNT={course.count}")
+                    if course.exdays:
+                        exdates = ','.join(f"{_format_day(exday)}T{start_clock}" for exday in course.exdays)
+                        ics_lines.append(f"EXDATE;TZID=Asia/Shanghai:{exdates}")
+                ics_lines.append(dtstamp_line)
+                ics_lines.append(f"UID:{course.title}_{day}T{start_clock}@courses")
+                ics_lines.extend(alarm)
+                ics_lines.append("END:VEVENT")
+                continue
+            
+            tail = alarm + ["END:VEVENT"]
+            for ordinal in course.days:
+                day = _format_day(ordinal)
+                ics_lines.extend(head)
+                ics_lines.append(f"DTSTART;TZID=Asia/Shanghai:{day}T{start_clock}")
+                ics_lines.append(f"DTEND;TZID=Asia/Shanghai:{day}T{end_clock}")
+                ics_lines.append(dtstamp_line)
+                ics_lines.append(f"UID:{course.title}_{day}@courses")
+                ics_lines.extend(tail)
         
-        for event in self._events:
+        for event in self._notices:
             start_datetime = event['start_datetime']
             end_datetime = event['end_datetime']
-            
-            is_all_day = event.get('is_all_day', False)
-            
-            event_uid = f"{event.get('title', 'event')}_{start_datetime.strftime('%Y%m%d')}@courses"
-            
             ics_lines.append("BEGIN:VEVENT")
-            ics_lines.append(f"SUMMARY:{self._escape_ics_text(event['title'])}")
-            if is_all_day:
-                ics_lines.append(f"DESCRIPTION:{self._escape_ics_text(event.get('description', ''))}")
-                ics_lines.append(f"DTSTART;VALUE=DATE:{start_datetime.strftime('%Y%m%d')}")
-                ics_lines.append(f"DTEND;VALUE=DATE:{end_datetime.strftime('%Y%m%d')}")
-            else:
-                ics_lines.append(f"DESCRIPTION:教师: {self._escape_ics_text(event.get('teacher', ''))}\\n教学周: {self._escape_ics_text(event.get('teaching_weeks', ''))}\\n节次: {self._escape_ics_text(event.get('class_periods', ''))}")
-                ics_lines.append(f"LOCATION:{self._escape_ics_text(event.get('location', ''))}")
-                ics_lines.append(f"DTSTART;TZID=Asia/Shanghai:{start_datetime.strftime('%Y%m%dT%H%M%S')}")
-                ics_lines.append(f"DTEND;TZID=Asia/Shanghai:{end_datetime.strftime('%Y%m%dT%H%M%S')}")
-            
-            ics_lines.append(f"DTSTAMP:{dtstamp}")
-            ics_lines.append(f"UID:{event_uid}")
-            
-            if not is_all_day:
-                ics_lines.extend(self._generate_alarm_component())
-            
+            ics_lines.append(f"SUMMARY:{escape(event['title'])}")
+            ics_lines.append(f"DESCRIPTION:{escape(event.get('description', ''))}")
+            ics_lines.append(f"DTSTART;VALUE=DATE:{start_datetime.strftime('%Y%m%d')}")
+            ics_lines.append(f"DTEND;VALUE=DATE:{end_datetime.strftime('%Y%m%d')}")
+            ics_lines.append(dtstamp_line)
+            ics_lines.append(f"UID:{event.get('title', 'event')}_{start_datetime.strftime('%Y%m%d')}@courses")
             ics_lines.append("END:VEVENT")
         
         ics_lines.append("END:VCALENDAR")
-        return '\n'.join(ics_lines)
+        ics = '\n'.join(ics_lines)
+        metrics.observe("xqe_ics_bytes", len(ics.encode('utf-8')))
+        metrics.observe("xqe_ics_events", self.event_count())
+        return ics
+
+
+def build_ics(school_data: Dict[str, Any], remindTime: str, school_code: str, use_rrule: bool = False,
+              dtstamp: datetime = None) -> ICSBuilder:
+    """根据缓存的课表数据创建已添加全部课程的 ICSBuilder"""
+    ics_builder = ICSBuilder(
+        remind_time=remindTime,
+        timetable_config=school_data.get('timetable', {}),
+        school_code=school_code,
+        use_rrule=use_rrule,
+        dtstamp=dtstamp
+    )
+    ics_builder.add_courses_from_dict(school_data)
+    return ics_builder
+
+
+class RenderCache:
+    """
+    已生成 ICS 的 LRU 缓存，保存 UTF-8 编码后的字节，按总字节数限制大小
+
+    逐周导出的日历一个就有几百 KB，按条数限制时内存占用无法预估；命中时直接作为响应体，不必重新编码。
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._size = 0
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            ics = self._entries.get(key)
+            if ics is not None:
+                self._entries.move_to_end(key)
+            return ics
+    
+    def put(self, key: str, ics: bytes):
+        if len(ics) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = ics
+            self._size += len(ics)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+_RENDER_CACHE = RenderCache(int(ICS_CACHE_MB * 1024 * 1024))
+
+
+def get_calendar_version(school_code: str) -> str:
+    """校历与作息表文件的版本（修改时间），文件更新后旧的渲染结果自动失效"""
+    return _SCHOOL_REGISTRY.get(school_code).version
+
+
+def get_calendar_modified(school_code: str) -> datetime:
+    """当前使用的校历与作息表文件中最晚的修改时间"""
+    return datetime.fromtimestamp(_SCHOOL_REGISTRY.get(school_code).modified, timezone.utc)
+
+
+def get_render_key(school_code: str, username: str, data_hash: str, remindTime: str,
+                   all_semesters: bool, rrule: bool) -> str:
+    """
+    渲染缓存 key，同时用作 ETag
+
+    包含学号：课表相同的同学 DTSTAMP（各自的 data_update_time）不同，共用一份结果会让同一 ETag 对应不同的内容
+    """
+    raw = f"{school_code}|{username}|{data_hash}|{remindTime}|{all_semesters}|{rrule}|{get_calendar_version(school_code)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _get_disk_ics_path(school_code: str, username: str, key: str) -> str:
+    return os.path.join(get_user_dir(school_code, username), f"calendar.{key[:16]}.ics")
+
+
+def _load_disk_ics(school_code: str, username: str, key: str) -> Optional[bytes]:
+    path = _get_disk_ics_path(school_code, username, key)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _save_disk_ics(school_code: str, username: str, key: str, ics: bytes):
+    path = _get_disk_ics_path(school_code, username, key)
+    # 每个用户只保留最近一次渲染的结果
+    for old_path in glob.glob(os.path.join(get_user_dir(school_code, username), "calendar.*.ics")):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(ics)
+    os.replace(tmp_path, path)
+
+
+def _parse_local_time(value: Optional[str]) -> Optional[datetime]:
+    """解析 user_info 中的本地时间字符串，返回带时区的 datetime"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).astimezone()
+    except (ValueError, TypeError):
+        return None
+
+
+def get_validators(school_code: str, username: str, info: Dict[str, Any], remindTime: str,
+                   all_semesters: bool = True, rrule: bool = False) -> Optional[Dict[str, str]]:
+    """
+    计算日历的 HTTP 缓存校验值，不需要生成日历
+
+    ETag 取自渲染缓存 key（学号 + 数据哈希 + 渲染参数 + 校历版本），相同 key 生成的日历逐字节一致；
+    Last-Modified 取 last_fetch_time 与校历、作息表文件修改时间中较晚的一个（热更新校历后日历内容也会变化）。
+    缺少 data_hash 时返回 None。
+    """
+    data_hash = info.get("data_hash")
+    if not data_hash:
+        return None
+    key = get_render_key(school_code, username, data_hash, remindTime, all_semesters, rrule)
+    validators = {"etag": f'"{key[:32]}"'}
+    last_fetch = _parse_local_time(info.get("last_fetch_time"))
+    if last_fetch:
+        last_modified = max(last_fetch.astimezone(timezone.utc), get_calendar_modified(school_code))
+        validators["last_modified"] = format_datetime(last_modified, usegmt=True)
+    return validators
+
+
+def get_cached_validators(username: str, remindTime: str, school_code: str,
+                          all_semesters: bool = True, rrule: bool = False) -> Optional[Dict[str, str]]:
+    """缓存新鲜时返回校验值，否则返回 None（此时日历可能还会变化）"""
+    info = load_user_info(school_code, username)
+    if not info or not is_cache_fresh(school_code, username, info):
+        return None
+    return get_validators(school_code, username, info, remindTime, all_semesters, rrule)
+
+
+def _needs_backfill(info: Dict[str, Any]) -> bool:
+    return not info.get("data_hash") or not info.get("data_update_time")
+
+
+def _backfill_info(school_code: str, username: str, info: Dict[str, Any],
+                   school_data: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+    """
+    为旧用户补算 data_hash 与 data_update_time（只在缺少时设置），返回加载过的课表数据
+
+    data_update_time 是 DTSTAMP 的来源，补上后同一 ETag 的日历在各次请求与各进程之间逐字节一致。
+    """
+    if not info.get("data_hash"):
+        if school_data is None:
+            school_data = load_cache(school_code, username)
+        info["data_hash"] = compute_data_hash(school_data)
+    if not info.get("data_update_time"):
+        info["data_update_time"] = info.get("last_fetch_time") or datetime.now().isoformat()
+    return school_data
+
+
+def _save_backfill(school_code: str, username: str, info: Dict[str, Any]):
+    """
+    写回补算的字段：持有用户锁重新读取 user_info，只补上仍然缺少的字段
+
+    请求开始时读出的 info 可能已经过时（其他进程完成了抓取、访问时间已批量写入），不能整份写回。
+    """
+    with user_fetch_lock(school_code, username):
+        current = load_user_info(school_code, username)
+        missing = [field for field in ("data_hash", "data_update_time") if not current.get(field)]
+        if current and missing:
+            current.update((field, info[field]) for field in missing)
+            save_user_info(school_code, username, current)
+
+
+@traced("render")
+def render_ics(school_code: str, username: str, info: Dict[str, Any], remindTime: str,
+               all_semesters: bool = True, rrule: bool = False, school_data: Dict[str, Any] = None) -> bytes:
+    """
+    生成日历（UTF-8 编码的字节），命中渲染缓存时直接返回已生成的 ICS
+
+    key 由学号、课表数据哈希（user_info 中的 data_hash）、渲染参数和校历文件版本组成，DTSTAMP 取自 data_update_time；
+    缺少这两项的旧用户会在这里补齐并写回 info，由调用方保存。
+    """
+    if _needs_backfill(info):
+        school_data = _backfill_info(school_code, username, info, school_data)
+    
+    key = get_render_key(school_code, username, info["data_hash"], remindTime, all_semesters, rrule)
+    ics = _RENDER_CACHE.get(key)
+    if ics is None and ICS_DISK_CACHE:
+        ics = _load_disk_ics(school_code, username, key)
+        if ics is not None:
+            _RENDER_CACHE.put(key, ics)
+    if ics is not None:
+        return ics
+    
+    if school_data is None:
+        school_data = load_cache(school_code, username)
+    ics = build_ics(school_data, remindTime, school_code, rrule,
+                    _parse_local_time(info["data_update_time"])).export().encode('utf-8')
+    _RENDER_CACHE.put(key, ics)
+    if ICS_DISK_CACHE:
+        _save_disk_ics(school_code, username, key, ics)
+    return ics
 
 
 def Main(username: str, onceMd5Password: str, remindTime: str,
          school_code: str, school_year: str = None, term: str = None, 
-         all_semesters: bool = True, force: bool = False, **kwargs) -> str:
+         all_semesters: bool = True, force: bool = False, rrule: bool = False,
+         requested_at: datetime = None, **kwargs) -> bytes:
     
-    now = datetime.now().isoformat()
-    school_calendar_path = os.path.join('schools', school_code, 'school_calendar.json')
-    user_exists = is_user_exists(school_code, username)
+    info = load_user_info(school_code, username)
+    user_exists = bool(info)
     
     if not user_exists or force:
+        metrics.inc("xqe_cache_requests_total", school=school_code, outcome="force" if user_exists else "miss")
         try:
-            school_data = SchoolDispatcher.get_timetable(
+            school_data = fetch_school_data(
                 school_code, username, onceMd5Password,
-                school_year=school_year, term=term, all_semesters=all_semesters, **kwargs
+                school_year=school_year, term=term, all_semesters=all_semesters,
+                requested_at=requested_at, **kwargs
             )
         except Exception as e:
             if force:
                 if user_exists:
-                    info = load_user_info(school_code, username)
-                    info["last_access_time"] = now
-                    save_user_info(school_code, username, info)
+                    record_access(school_code, username)
                 raise e
             raise e
         
-        save_cache(school_code, username, school_data)
-        
-        info = {
-            "last_access_time": now,
-            "last_fetch_time": now
-        }
-        save_user_info(school_code, username, info)
-    else:
         info = load_user_info(school_code, username)
-        
-        if is_cache_fresh(school_code, username):
-            school_data = load_cache(school_code, username)
-            info["last_access_time"] = now
-            save_user_info(school_code, username, info)
+        record_access(school_code, username)
+    else:
+        if is_cache_fresh(school_code, username, info):
+            metrics.inc("xqe_cache_requests_total", school=school_code, outcome="fresh")
+            record_access(school_code, username)
+            backfill = _needs_backfill(info)
+            ics = render_ics(school_code, username, info, remindTime, all_semesters, rrule)
+            if backfill:
+                _save_backfill(school_code, username, info)
+            return ics
         else:
+            metrics.inc("xqe_cache_requests_total", school=school_code, outcome="stale")
             try:
-                school_data = SchoolDispatcher.get_timetable(
+                school_data = fetch_school_data(
                     school_code, username, onceMd5Password,
-                    school_year=school_year, term=term, all_semesters=all_semesters, **kwargs
+                    school_year=school_year, term=term, all_semesters=all_semesters,
+                    requested_at=requested_at, **kwargs
                 )
                 
-                save_cache(school_code, username, school_data)
-                info["last_access_time"] = now
-                info["last_fetch_time"] = now
-                save_user_info(school_code, username, info)
+                info = load_user_info(school_code, username)
+                record_access(school_code, username)
                 
             except Exception as e:
                 last_fetch = info.get("last_fetch_time", "")
+                # 旧课表只返回给最近一次登录成功的密码
+                if not _is_known_password(info, onceMd5Password):
+                    raise e
                 
                 if last_fetch:
                     try:
@@ -460,35 +1418,105 @@ def Main(username: str, onceMd5Password: str, remindTime: str,
                 if days_since >= STALE_DAYS:
                     school_data = load_cache(school_code, username)
                     if school_data and school_data.get('courses'):
-                        timetable_config = school_data.get('timetable', {})
-                        ics_builder = ICSBuilder(
-                            remind_time=remindTime,
-                            calendar_path=school_calendar_path,
-                            timetable_config=timetable_config,
-                            school_code=school_code
-                        )
-                        ics_builder.add_courses_from_dict(school_data)
+                        ics_builder = build_ics(school_data, remindTime, school_code, rrule)
                         ics_builder.add_error_event(str(e), last_fetch)
                         
-                        info["last_access_time"] = now
-                        save_user_info(school_code, username, info)
+                        record_access(school_code, username)
                         
-                        return ics_builder.export()
+                        return ics_builder.export().encode('utf-8')
                 
                 raise e
     
-    timetable_config = school_data.get('timetable', {})
+    return render_ics(school_code, username, info, remindTime, all_semesters, rrule, school_data)
+
+
+def _days_since(time_str: Optional[str]) -> int:
+    if not time_str:
+        return 0
+    try:
+        return (datetime.now() - datetime.fromisoformat(time_str)).days
+    except (ValueError, TypeError):
+        return 0
+
+
+def render_cached(username: str, remindTime: str, school_code: str,
+                  all_semesters: bool = True, rrule: bool = False,
+                  not_modified=None, onceMd5Password: str = None,
+                  school_year: str = None, term: str = None, **kwargs) -> Optional[Dict[str, Any]]:
+    """
+    只用本地缓存生成日历，不在请求中访问教务系统
+
+    返回 {"ics": ..., "etag": ..., "last_modified": ...}；没有缓存时返回 None，由调用方改走 Main 的完整流程。
+    缓存过期时，只有密码与最近一次登录成功的密码（user_info 中的 password_sha256，旧用户没有时不比较）相同才直接返回旧日历
+    并提交后台刷新（stale-while-revalidate），其他密码返回 None，由 Main 实际登录校验；
+    过期超过 STALE_DAYS 天且用这个密码的最近一次刷新失败时，附带错误提示事件（此时不返回校验值）。
+    密码最近被教务系统拒绝时只返回登录失败提示：是最近登录成功的密码（之后在教务系统改了密码）则附带旧课表，
+    否则日历中只有提示，不读取课表缓存。
+    not_modified(validators) 返回 True 时跳过生成，ics 为 None。
+    整个过程只读取一次 user_info，访问时间由 AccessTracker 延迟写入。
+    """
+    info = load_user_info(school_code, username)
+    if not info:
+        return None
     
-    ics_builder = ICSBuilder(
-        remind_time=remindTime,
-        calendar_path=school_calendar_path,
-        timetable_config=timetable_config,
-        school_code=school_code
-    )
+    outcome = "fresh"
+    if not is_cache_fresh(school_code, username, info):
+        if not onceMd5Password:
+            return None
+        outcome = "stale"
+        
+        known_password = _is_known_password(info, onceMd5Password)
+        login_error = _LOGIN_FAILURES.check(school_code, username, onceMd5Password)
+        if login_error:
+            # 密码最近被教务系统拒绝：不提交刷新，提示更新密码；旧课表只给最近登录成功过的密码
+            school_data = load_cache(school_code, username) if known_password else {}
+            ics_builder = build_ics(school_data, remindTime, school_code, rrule)
+            ics_builder.add_login_error_event(login_error)
+            metrics.inc("xqe_cache_requests_total", school=school_code, outcome=outcome)
+            if known_password:
+                record_access(school_code, username)
+            return {"ics": ics_builder.export().encode('utf-8')}
+        if not known_password:
+            return None
+        
+        schedule_refresh(school_code, username, onceMd5Password, info,
+                         school_year=school_year, term=term, all_semesters=all_semesters)
+        
+        last_fetch = info.get("last_fetch_time", "")
+        last_error = _last_error_for(info, onceMd5Password)
+        if last_error and _days_since(last_fetch) >= STALE_DAYS:
+            school_data = load_cache(school_code, username)
+            if not school_data or not school_data.get('courses'):
+                return None
+            ics_builder = build_ics(school_data, remindTime, school_code, rrule)
+            ics_builder.add_error_event(last_error, last_fetch)
+            metrics.inc("xqe_cache_requests_total", school=school_code, outcome=outcome)
+            record_access(school_code, username)
+            return {"ics": ics_builder.export().encode('utf-8')}
     
-    ics_builder.add_courses_from_dict(school_data)
+    school_data = None
+    backfill = _needs_backfill(info)
+    if not info.get("data_hash"):
+        school_data = load_cache(school_code, username)
+        if not school_data:
+            return None
+    
+    result = {"ics": None}
+    validators = get_validators(school_code, username, info, remindTime, all_semesters, rrule)
+    if validators:
+        result.update(validators)
+    if validators and not_modified and not_modified(validators):
+        metrics.inc("xqe_not_modified_total")
+    else:
+        result["ics"] = render_ics(school_code, username, info, remindTime, all_semesters, rrule, school_data)
+        result.update(get_validators(school_code, username, info, remindTime, all_semesters, rrule))
+    metrics.inc("xqe_cache_requests_total", school=school_code, outcome=outcome)
     
-    return ics_builder.export()
+    if backfill:
+        # 旧缓存补算的 data_hash 与 data_update_time 需要写回
+        _save_backfill(school_code, username, info)
+    record_access(school_code, username)
+    return result
 
 
 if __name__ == "__main__":
@@ -506,10 +1534,10 @@ if __name__ == "__main__":
                  school_code=school_code, school_year=school_year, term=term, force=force)
         choice = input("save or print? (s/P): ").strip().lower()
         if choice == "s":
-            open("test.ics", "w", encoding="utf-8").write(o)
+            open("test.ics", "wb").write(o)
             print("File saved as test.ics")
         else:
-            print (o)
+            print (o.decode('utf-8'))
     else:
         print("用法: python xqe.py <username> <onceMd5Password> <remindTime> <school_code> [FORCE] [school_year] [term]")
     